@@ -1,6 +1,13 @@
 import itertools
-from imd3 import calcRating, loadVtxTable, getFrequencyWithChannel
+import os
+from imd import DEFAULT_MAX_ORDER, explain, patternName
 import argparse
+import metrics
+from channel_plan import get_channel_plan
+from create_secondary_ranking import (add_constraint_arguments, add_max_order_argument, add_threads_argument,
+                                      constraints_from_args, read_frequencies_from_file)
+from ranking_file import RANKING_FILE, RankingFile
+from score_cache import SCORE_CACHE_FILE, SCORE_CACHE_MAX_ENTRIES, ScoreCache, cachedEvaluateCombos
 
 def read_ranking_from_file(filename="secondary_ranking.txt"):
     """二次合成の順位リストをファイルから読み込む"""
@@ -41,199 +48,158 @@ def read_ranking_from_file(filename="secondary_ranking.txt"):
     
     return results
 
-def check_imd_differences(frequencies, threshold=20):
-    """imd3.pyのcalcRatingルーチン内で計算されるdifferenceをチェック（20MHz未満を排除対象）"""
-    from imd3 import calcRating
-    
-    # calcRatingの内部ロジックを模倣してdifferenceを計算
-    n = len(frequencies)
-    differences = []
-    
-    for row in range(n):
-        for column in range(n):
-            if row == column:
-                continue
-            
-            # 二次合成
-            thirdFrequency = frequencies[row] * 2 - frequencies[column]
-            if thirdFrequency >= 5100 and thirdFrequency <= 6099:  # isValidFrequency
-                nearest = min(frequencies, key=lambda f: abs(f - thirdFrequency))
-                difference = abs(thirdFrequency - nearest)
-                if difference < threshold:  # 20MHz未満
-                    differences.append((thirdFrequency, nearest, difference, f"二次合成: f{row+1}*2 - f{column+1}"))
-            
-            # 三次合成パターン（10パターン）
-            for k in range(n):
-                if k == row or k == column:
-                    continue
-                
-                # パターン1: f1 - f2 + f3
-                third_order = frequencies[row] - frequencies[column] + frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン1): f{row+1} - f{column+1} + f{k+1}"))
-                
-                # パターン2: f1 + f2 - f3
-                third_order = frequencies[row] + frequencies[column] - frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン2): f{row+1} + f{column+1} - f{k+1}"))
-                
-                # パターン3: 2*f1 - f2 - f3
-                third_order = 2 * frequencies[row] - frequencies[column] - frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン3): 2*f{row+1} - f{column+1} - f{k+1}"))
-                
-                # パターン4: f1 + f2 + f3
-                third_order = frequencies[row] + frequencies[column] + frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン4): f{row+1} + f{column+1} + f{k+1}"))
-                
-                # パターン5: -f1 + f2 + f3
-                third_order = -frequencies[row] + frequencies[column] + frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン5): -f{row+1} + f{column+1} + f{k+1}"))
-                
-                # パターン6: 2*f1 + f2 - f3
-                third_order = 2 * frequencies[row] + frequencies[column] - frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン6): 2*f{row+1} + f{column+1} - f{k+1}"))
-                
-                # パターン7: 2*f1 - f2 + f3
-                third_order = 2 * frequencies[row] - frequencies[column] + frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン7): 2*f{row+1} - f{column+1} + f{k+1}"))
-                
-                # パターン8: f1 - 2*f2 + f3
-                third_order = frequencies[row] - 2 * frequencies[column] + frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン8): f{row+1} - 2*f{column+1} + f{k+1}"))
-                
-                # パターン9: f1 + 2*f2 - f3
-                third_order = frequencies[row] + 2 * frequencies[column] - frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン9): f{row+1} + 2*f{column+1} - f{k+1}"))
-                
-                # パターン10: -f1 + 2*f2 + f3
-                third_order = -frequencies[row] + 2 * frequencies[column] + frequencies[k]
-                if third_order >= 5100 and third_order <= 6099:
-                    nearest = min(frequencies, key=lambda f: abs(f - third_order))
-                    difference = abs(third_order - nearest)
-                    if difference < threshold:
-                        differences.append((third_order, nearest, difference, f"三次合成(パターン10): -f{row+1} + 2*f{column+1} + f{k+1}"))
+def read_ranking(filename="secondary_ranking.txt", binary_filename=RANKING_FILE, freq_filename="freq.txt"):
+    """二次合成の順位リストを読み込む（バイナリ形式があればそちらを使い、なければテキストを解析する）
+
+    バイナリ形式は、周波数プールがfreq_filenameの周波数と一致し、テキスト形式より新しい場合だけ使う
+    （テキスト形式だけを作り直した場合や、freq.txtを変更した後に古いバイナリ形式を読まないように）。
+    """
+    if os.path.exists(binary_filename):
+        try:
+            ranking = RankingFile(binary_filename)
+        except ValueError as e:
+            print(f"警告: {e}。テキスト形式の順位リストを使用します")
+        else:
+            reason = stale_ranking_reason(ranking, filename, freq_filename)
+            if reason is None:
+                return list(ranking)
+            print(f"警告: {binary_filename} は{reason}ため、テキスト形式の順位リストを使用します")
+    return read_ranking_from_file(filename)
+
+def stale_ranking_reason(ranking, filename, freq_filename):
+    """バイナリ形式の順位リストを使えない理由（使える場合はNone）"""
+    if os.path.exists(filename) and os.path.getmtime(filename) > os.path.getmtime(ranking.filename):
+        return f" {filename} より古い"
+    if os.path.exists(freq_filename):
+        if ranking.pool.tolist() != sorted(set(read_frequencies_from_file(freq_filename))):
+            return f"周波数プールが {freq_filename} と異なる"
+    return None
+
+def check_imd_differences(frequencies, threshold=20, max_order=DEFAULT_MAX_ORDER):
+    """imd3.pyのexplainが返す合成波のdifferenceをチェック（20MHz未満を排除対象）
+
+    戻り値は [(合成周波数, 最近接周波数, 差, パターン名), ...] で、evaluateCombosの違反リストと同じ形式。
+    """
+    return [violation_from_term(term) for term in explain(frequencies, max_order=max_order) if term.difference < threshold]
+
+def violation_from_term(term):
+    """explainの記録を違反リストの1件（合成周波数, 最近接周波数, 差, パターン名）に変換"""
+    return (term.product, term.nearest, term.difference, patternName(term.pattern, term.indices))
+
+def make_filtered_result(rank, frequencies, secondary_rating, tertiary_rating, min_difference, imd_differences):
+    """1つの組み合わせの三次合成評価結果を記録"""
+    return {
+        'rank': rank,
+        'frequencies': frequencies,
+        'secondary_rating': secondary_rating,
+        'tertiary_rating': tertiary_rating,
+        'min_imd_difference': min_difference,
+        'imd_differences': imd_differences,
+        'should_exclude': len(imd_differences) > 0
+    }
+
+def print_filtered_details(filtered_results, imd_diff_threshold=20):
+    """元順位が上位20件の組み合わせの評価結果を表示"""
+    plan = get_channel_plan()
     
-    return differences
+    for result in filtered_results:
+        rank = result['rank']
+        if rank > 20:
+            continue
+        imd_differences = result['imd_differences']
+        freq_with_channel = [plan.label(f) for f in result['frequencies']]
+        print(f"{rank:3d}. 周波数: {freq_with_channel}")
+        print(f"    二次合成評価: {result['secondary_rating']}, 三次合成評価: {result['tertiary_rating']}")
+        
+        if imd_differences:
+            print(f"    ⚠️  IMD差{imd_diff_threshold}MHz未満検出: ", end="")
+            for third_freq, nearest, diff, pattern in imd_differences[:3]:  # 最初の3つまで表示
+                print(f"({pattern}: {third_freq}-{nearest}={diff}MHz) ", end="")
+            if len(imd_differences) > 3:
+                print(f"...他{len(imd_differences)-3}件 ", end="")
+            print("→ 排除対象")
+        else:
+            print(f"    ✅ IMD差{imd_diff_threshold}MHz未満なし → 採用候補")
+        print()
+
+def apply_tertiary_evaluation_and_filter(ranking_results, imd_diff_threshold=20, jobs=1, show_details=True, cache=None,
+                                         max_order=DEFAULT_MAX_ORDER, threads=1):
+    """三次合成による評価を行い、IMD差閾値未満の印を付ける
 
-def apply_tertiary_evaluation_and_filter(ranking_results, imd_diff_threshold=20):
-    """三次合成による評価を行い、IMD差閾値未満の印を付ける（重複排除付き）"""
-    vtx_table = loadVtxTable()
+    重複排除付き、jobs: 並列プロセス数、threads: 並列スレッド数、cache: ScoreCache、max_order: 合成波の次数の上限
+    """
     filtered_results = []
     seen = set()  # 重複排除用セット
     
     print(f"三次合成による評価とIMD差{imd_diff_threshold}MHz未満チェックを実行中...")
     print("-" * 80)
     
+    # 周波数セット（順不同）で重複排除
+    unique_results = []
     for rank, frequencies, secondary_rating in ranking_results:
-        # 周波数セット（順不同）で重複排除
         freq_key = tuple(sorted(frequencies))
         if freq_key in seen:
             continue
         seen.add(freq_key)
-        
-        # 三次合成による評価
-        tertiary_rating = calcRating(frequencies)
-        
-        # IMD differenceチェック（閾値未満を排除対象）
-        imd_differences = check_imd_differences(frequencies, threshold=imd_diff_threshold)
-        
+        unique_results.append((rank, frequencies, secondary_rating))
+    
+    if not unique_results:
+        return filtered_results
+    
+    # 三次合成による評価とIMD differenceチェック（閾値未満を排除対象）を一度の列挙で実行
+    with metrics.stage('tertiary_evaluation', combos=len(unique_results)):
+        tertiary_ratings, min_differences, all_imd_differences = cachedEvaluateCombos(
+            [frequencies for _, frequencies, _ in unique_results], cache, threshold=imd_diff_threshold, jobs=jobs,
+            max_order=max_order, threads=threads)
+    
+    for (rank, frequencies, secondary_rating), tertiary_rating, min_difference, imd_differences in zip(
+            unique_results, tertiary_ratings.tolist(), min_differences.tolist(), all_imd_differences):
         # 結果を記録
-        result = {
-            'rank': rank,
-            'frequencies': frequencies,
-            'secondary_rating': secondary_rating,
-            'tertiary_rating': tertiary_rating,
-            'imd_differences': imd_differences,
-            'should_exclude': len(imd_differences) > 0
-        }
-        
-        filtered_results.append(result)
-        
-        # 上位20件の詳細を表示
-        if rank <= 20:
-            freq_with_channel = [getFrequencyWithChannel(f, vtx_table) for f in frequencies]
-            print(f"{rank:3d}. 周波数: {freq_with_channel}")
-            print(f"    二次合成評価: {secondary_rating}, 三次合成評価: {tertiary_rating}")
-            
-            if imd_differences:
-                print(f"    ⚠️  IMD差{imd_diff_threshold}MHz未満検出: ", end="")
-                for third_freq, nearest, diff, pattern in imd_differences[:3]:  # 最初の3つまで表示
-                    print(f"({pattern}: {third_freq}-{nearest}={diff}MHz) ", end="")
-                if len(imd_differences) > 3:
-                    print(f"...他{len(imd_differences)-3}件 ", end="")
-                print("→ 排除対象")
-            else:
-                print(f"    ✅ IMD差{imd_diff_threshold}MHz未満なし → 採用候補")
-            print()
+        filtered_results.append(make_filtered_result(rank, frequencies, secondary_rating, tertiary_rating,
+                                                     min_difference, imd_differences))
+    
+    # 上位20件の詳細を表示
+    if show_details:
+        print_filtered_details(filtered_results, imd_diff_threshold)
     
     return filtered_results
 
-def save_filtered_results(results, filename="filtered_ranking.txt"):
-    """フィルタリング結果をファイルに保存"""
-    vtx_table = loadVtxTable()
+def constrain_ranking(ranking_results, constraints):
+    """順位リストから制約を満たす組み合わせだけを残す（三次合成の評価の前に絞り込み、元の順位はそのまま）"""
+    return [(rank, frequencies, secondary_rating) for rank, frequencies, secondary_rating in ranking_results
+            if constraints.accepts(frequencies)]
+
+def refilter_results(filtered_results, imd_diff_threshold):
+    """より大きい閾値で評価した結果から、imd_diff_threshold未満のIMD差だけを残した結果を作る（再評価は不要）"""
+    refiltered = []
+    for result in filtered_results:
+        imd_differences = [d for d in result['imd_differences'] if d[2] < imd_diff_threshold]
+        refiltered.append(dict(result, imd_differences=imd_differences, should_exclude=len(imd_differences) > 0))
+    return refiltered
+
+def format_filtered_result(result, plan):
+    """フィルタリング結果の1行（順位, 周波数(チャネル)[LED]..., 二次合成評価, 三次合成評価, 排除フラグ, IMD差詳細）"""
+    # 周波数にチャネル名とLED番号を付けて表示
+    freq_str = ", ".join(plan.label_with_led(freq) for freq in result['frequencies'])
+    led_numbers = [plan.led_number(freq) for freq in result['frequencies']]
     
-    # LEDテーブルを読み込み
-    def load_led_table():
-        """LED.txtから周波数レンジとLED数値の対応関係を読み込む"""
-        led_ranges = []
-        try:
-            with open('LED.txt', 'r') as f:
-                for line in f:
-                    parts = line.strip().split('\t')
-                    if len(parts) >= 3:
-                        range_str = parts[0]
-                        led_number = int(parts[2])
-                        range_parts = range_str.split(' <= ')
-                        if len(range_parts) == 2:
-                            min_freq = int(range_parts[0])
-                            max_freq = int(range_parts[1])
-                            led_ranges.append((min_freq, max_freq, led_number))
-        except FileNotFoundError:
-            print("警告: LED.txtが見つかりません")
-        return led_ranges
+    # LED番号の重複チェック
+    valid_led_numbers = [led for led in led_numbers if led is not None]
+    led_safe = len(valid_led_numbers) == 4 and len(set(valid_led_numbers)) == 4
     
-    def get_led_number(frequency, led_ranges):
-        """周波数に対応するLED数値を取得"""
-        for min_freq, max_freq, led_number in led_ranges:
-            if min_freq <= frequency <= max_freq:
-                return led_number
-        return None
+    exclude_flag = "EXCLUDE" if result['should_exclude'] else "KEEP"
+    if not result['should_exclude'] and led_safe:
+        exclude_flag = "KEEP LED safe"
     
-    led_ranges = load_led_table()
+    imd_details = ""
+    if result['imd_differences']:
+        imd_details = "; ".join([f"{pattern}: {third_freq}-{nearest}={diff}MHz" for third_freq, nearest, diff, pattern in result['imd_differences']])
+    
+    return f"{result['rank']:4d}, {freq_str}, {result['secondary_rating']}, {result['tertiary_rating']}, {exclude_flag}, {imd_details}\n"
+
+def save_filtered_results(results, filename="filtered_ranking.txt"):
+    """フィルタリング結果をファイルに保存"""
+    plan = get_channel_plan()
     
     with open(filename, 'w') as f:
         f.write("# 三次合成評価とIMD差フィルタリング結果\n")
@@ -241,37 +207,44 @@ def save_filtered_results(results, filename="filtered_ranking.txt"):
         f.write("-" * 140 + "\n")
         
         for result in results:
-            # 周波数にチャネル名とLED番号を付けて表示
-            freq_with_channel_led = []
-            led_numbers = []
-            for freq in result['frequencies']:
-                channel_str = getFrequencyWithChannel(freq, vtx_table)
-                led_num = get_led_number(freq, led_ranges)
-                if led_num is not None:
-                    freq_with_channel_led.append(f"{channel_str}[LED{led_num}]")
-                    led_numbers.append(led_num)
-                else:
-                    freq_with_channel_led.append(f"{channel_str}[LED?]")
-                    led_numbers.append(None)
-            
-            freq_str = ", ".join(freq_with_channel_led)
-            
-            # LED番号の重複チェック
-            valid_led_numbers = [led for led in led_numbers if led is not None]
-            led_safe = len(valid_led_numbers) == 4 and len(set(valid_led_numbers)) == 4
-            
-            exclude_flag = "EXCLUDE" if result['should_exclude'] else "KEEP"
-            if not result['should_exclude'] and led_safe:
-                exclude_flag = "KEEP LED safe"
-            
-            imd_details = ""
-            if result['imd_differences']:
-                imd_details = "; ".join([f"{pattern}: {third_freq}-{nearest}={diff}MHz" for third_freq, nearest, diff, pattern in result['imd_differences']])
-            
-            f.write(f"{result['rank']:4d}, {freq_str}, {result['secondary_rating']}, {result['tertiary_rating']}, {exclude_flag}, {imd_details}\n")
+            f.write(format_filtered_result(result, plan))
     
     print(f"フィルタリング結果を {filename} に保存しました")
 
+def save_kept_results(results, filename):
+    """採用候補（KEEP）の行だけをfilterN.txtの形式で保存"""
+    plan = get_channel_plan()
+    
+    with open(filename, 'w') as f:
+        for result in results:
+            if not result['should_exclude']:
+                f.write(format_filtered_result(result, plan))
+    
+    print(f"採用候補を {filename} に保存しました")
+
+def sweep_thresholds(filtered_results, thresholds):
+    """閾値ごとに採用候補をfilter{閾値}.txtへ保存し、閾値ごとの件数の表を表示・保存
+
+    filtered_resultsは閾値の最大値で評価した結果（各閾値の結果はそこから絞り込むだけで再評価しない）。
+    """
+    total = len(filtered_results)
+    rows = []
+    for threshold in sorted(thresholds):
+        results = refilter_results(filtered_results, threshold)
+        kept = sum(1 for r in results if not r['should_exclude'])
+        save_kept_results(results, f"filter{threshold}.txt")
+        rows.append(f"{threshold:8d}  {kept:8d}  {total - kept:8d}  {kept/total*100:6.1f}%")
+    
+    lines = ["閾値(MHz)  採用候補  排除対象  採用率", "-" * 40] + rows
+    print("-" * 80)
+    print("閾値ごとのフィルタリング結果:")
+    for line in lines:
+        print(line)
+    with open("filter_summary.txt", 'w') as f:
+        f.write(f"# 閾値ごとのフィルタリング結果（総組み合わせ数: {total}）\n")
+        f.write("\n".join(lines) + "\n")
+    print("閾値ごとの件数を filter_summary.txt に保存しました")
+
 def print_summary(results):
     """結果のサマリーを表示"""
     total = len(results)
@@ -289,31 +262,92 @@ def print_summary(results):
     print("\n採用候補（IMD差20MHz未満なし）の上位10件:")
     print("-" * 80)
     
+    plan = get_channel_plan()
     kept_results = [r for r in results if not r['should_exclude']]
     for i, result in enumerate(kept_results[:10], 1):
-        freq_with_channel = [getFrequencyWithChannel(f, loadVtxTable()) for f in result['frequencies']]
+        freq_with_channel = [plan.label(f) for f in result['frequencies']]
         print(f"{i:2d}. 元順位{result['rank']:3d}: {freq_with_channel}")
         print(f"    二次合成評価: {result['secondary_rating']}, 三次合成評価: {result['tertiary_rating']}")
 
-def main():
+def parse_thresholds(text):
+    """カンマ区切りの閾値の並び（例: "5,10,15"）を整数のリストに変換"""
+    try:
+        thresholds = sorted({int(t) for t in text.split(',') if t.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"閾値は整数のカンマ区切りで指定してください: {text}")
+    if not thresholds:
+        raise argparse.ArgumentTypeError("閾値を1つ以上指定してください")
+    return thresholds
+
+def main(argv=None):
     # コマンドライン引数のパース
     parser = argparse.ArgumentParser(description="三次合成IMD差フィルタリング")
     parser.add_argument('--imd-diff-threshold', type=int, default=20, help='IMD差フィルタの閾値（MHz未満で排除, デフォルト: 20）')
-    args = parser.parse_args()
-    imd_diff_threshold = args.imd_diff_threshold
+    parser.add_argument('--imd-diff-thresholds', type=parse_thresholds,
+                        help='複数の閾値をカンマ区切りで指定し、一度の評価で閾値ごとのfilterN.txtを作成（例: 5,10,15,18,20）')
+    parser.add_argument('--jobs', type=int, default=1, help='評価に使う並列プロセス数（デフォルト: 1）')
+    add_threads_argument(parser)
+    parser.add_argument('--score-cache', nargs='?', const=SCORE_CACHE_FILE,
+                        help=f'評価結果をSQLiteファイルにキャッシュして再利用する（ファイル省略時: {SCORE_CACHE_FILE}）')
+    parser.add_argument('--score-cache-size', type=int, default=SCORE_CACHE_MAX_ENTRIES,
+                        help=f'キャッシュに保持する組み合わせ数の上限（デフォルト: {SCORE_CACHE_MAX_ENTRIES}）')
+    add_max_order_argument(parser)
+    add_constraint_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    constraints = constraints_from_args(args)
+    if args.jobs > 1 and args.threads > 1:
+        parser.error("--jobs と --threads は同時に指定できません")
 
-    # 二次合成の順位リストを読み込み
-    ranking_results = read_ranking_from_file()
-    
-    if not ranking_results:
-        print("エラー: 順位リストを読み込めませんでした")
+    if args.metrics:
+        metrics.enable()
+    with metrics.profiled(args.profile):
+        # 二次合成の順位リストを読み込み
+        with metrics.stage('read_ranking'):
+            ranking_results = read_ranking()
+        
+        if not ranking_results:
+            print("エラー: 順位リストを読み込めませんでした")
+            return
+        
+        if constraints is not None:
+            # 制約を満たさない組み合わせは三次合成で評価しない
+            with metrics.stage('constrain_ranking', combos=len(ranking_results)):
+                ranking_results = constrain_ranking(ranking_results, constraints)
+            print(f"組み合わせの制約: {constraints.describe()}（満たす組み合わせ: {len(ranking_results)}件）")
+            if not ranking_results:
+                print("エラー: 制約を満たす組み合わせがありません")
+                return
+        
+        cache = ScoreCache(args.score_cache, args.score_cache_size, args.max_order) if args.score_cache else None
+        try:
+            run_filter(args, ranking_results, cache)
+        finally:
+            if cache is not None:
+                cache.print_stats()
+                cache.close()
+    if args.metrics:
+        metrics.write_json(args.metrics)
+
+def run_filter(args, ranking_results, cache=None):
+    """三次合成による評価とフィルタリングを実行し、結果を保存・表示"""
+    if args.imd_diff_thresholds:
+        # 最大の閾値で一度だけ評価し、各閾値の結果はIMD差の一覧を絞り込んで作る
+        filtered_results = apply_tertiary_evaluation_and_filter(
+            ranking_results, max(args.imd_diff_thresholds), jobs=args.jobs, show_details=False, cache=cache,
+            max_order=args.max_order, threads=args.threads)
+        if filtered_results:
+            with metrics.stage('threshold_sweep', combos=len(filtered_results)):
+                sweep_thresholds(filtered_results, args.imd_diff_thresholds)
         return
     
     # 三次合成による評価とフィルタリング
-    filtered_results = apply_tertiary_evaluation_and_filter(ranking_results, imd_diff_threshold)
+    filtered_results = apply_tertiary_evaluation_and_filter(ranking_results, args.imd_diff_threshold, jobs=args.jobs,
+                                                            cache=cache, max_order=args.max_order, threads=args.threads)
     
     # 結果をファイルに保存
-    save_filtered_results(filtered_results)
+    with metrics.stage('save_filtered', combos=len(filtered_results)):
+        save_filtered_results(filtered_results)
     
     # サマリーを表示
     print_summary(filtered_results)
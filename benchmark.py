@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+評価エンジンとワークフローのベンチマーク
+
+1. calcRatingの1回あたりの時間
+2. 一括評価（calcRatings、合成波テーブル参照）のスループットと最大メモリ使用量
+3. 完全なワークフローの実行時間
+4. 既知の出力ファイル（IMD1/6/9.txt、result.txt）との一致確認と、評価方法間の評価値の一致確認
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import imd
+from imd_engine import ProductTables, calcRatings
+from imd_stream import combinationIndexChunks
+
+# ベンチマーク用に周波数プールを作る範囲（MHz）
+POOL_RANGE = (5645, 5945)
+
+# 既知の出力ファイル（imd.py --debug の出力）
+DEBUG_TRACE_FILES = ['IMD1.txt', 'IMD6.txt', 'IMD9.txt']
+# 既知の出力ファイル（calculate_4freq_ratings.py の出力、先頭行の周波数プールで実行）
+RATINGS_RESULT_FILE = 'result.txt'
+
+# 作業ディレクトリにコピーするファイル
+WORKFLOW_FILES = ['vtxtable.txt', 'LED.txt', 'freq.txt', os.path.join('original_files', 'app.py')]
+
+
+def generate_pool(size: int, seed: int = 0):
+    """POOL_RANGEの範囲から重複なしにsize個の周波数を選んだプール（昇順）"""
+    rng = np.random.default_rng(seed + size)
+    return np.sort(rng.choice(np.arange(POOL_RANGE[0], POOL_RANGE[1] + 1), size, replace=False)).astype(np.int32)
+
+
+def leading_combinations(n: int, k: int, max_combos: int):
+    """itertools.combinations(range(n), k)の先頭からmax_combos個までの添字配列"""
+    blocks = []
+    count = 0
+    for block in combinationIndexChunks(n, k, min(max_combos, 65536)):
+        blocks.append(block[:max_combos - count])
+        count += len(blocks[-1])
+        if count >= max_combos:
+            break
+    return np.concatenate(blocks) if blocks else np.zeros((0, k), dtype=np.intp)
+
+
+def measure(func, *args):
+    """funcの実行時間（秒）と、もう一度実行した時のPythonヒープの最大使用量（MB、NumPy配列を含む）を測る"""
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak / 1024 / 1024
+
+
+def bench_calc_rating(pool, k: int, samples: int, rng):
+    """imd.calcRatingを1組み合わせずつ呼んだ場合の時間"""
+    combos = np.sort(np.array([rng.choice(pool, k, replace=False) for _ in range(samples)]), axis=1).tolist()
+
+    def run():
+        return [imd.calcRating(combo) for combo in combos]
+
+    _, seconds, peak = measure(run)
+    return {'combos': samples, 'seconds': seconds, 'peak_mb': peak}
+
+
+def bench_batch(pool, k: int, max_combos: int):
+    """calcRatingsと合成波テーブル参照による一括評価（組み合わせ数がmax_combosを超える場合は先頭の一部のみ）"""
+    total = math.comb(len(pool), k)
+    index_combos = leading_combinations(len(pool), k, max_combos)
+    combos = pool[index_combos]
+    results = {}
+
+    ratings, seconds, peak = measure(calcRatings, combos)
+    results['calcRatings'] = {'combos': len(combos), 'total': total, 'seconds': seconds, 'peak_mb': peak}
+
+    tables, build_seconds, build_peak = measure(ProductTables.build, pool)
+    table_ratings, seconds, peak = measure(tables.calcRatings, index_combos)
+    results['ProductTables'] = {'combos': len(combos), 'total': total, 'seconds': seconds, 'peak_mb': peak,
+                                'build_seconds': build_seconds, 'build_peak_mb': build_peak}
+    results['tables_match'] = bool(np.array_equal(ratings, table_ratings))
+    return results, combos, ratings
+
+
+def check_against_calc_rating(combos, ratings, samples: int, rng):
+    """一括評価の評価値をimd.calcRatingと比較（samples個を無作為に選ぶ）"""
+    if len(combos) == 0:
+        return True
+    picked = rng.choice(len(combos), min(samples, len(combos)), replace=False)
+    return all(imd.calcRating(combos[i].tolist()) == int(ratings[i]) for i in picked.tolist())
+
+
+def prepare_workdir(directory):
+    """スクリプトと入力ファイルを作業ディレクトリにコピー"""
+    for filename in glob.glob('*.py') + WORKFLOW_FILES:
+        target = os.path.join(directory, filename)
+        os.makedirs(os.path.dirname(target) or directory, exist_ok=True)
+        shutil.copy(filename, target)
+
+
+def run_script(directory, *args):
+    """作業ディレクトリでスクリプトを実行し、(標準出力, 実行時間) を返す"""
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable] + list(args), cwd=directory, capture_output=True, text=True, check=True)
+    return completed.stdout, time.perf_counter() - start
+
+
+def bench_workflow(jobs: int = 1):
+    """完全なワークフロー（run_complete_workflow.py --force）の実行時間"""
+    with tempfile.TemporaryDirectory() as directory:
+        prepare_workdir(directory)
+        _, seconds = run_script(directory, 'run_complete_workflow.py', '--force', '--jobs', str(jobs))
+    return {'seconds': seconds}
+
+
+def check_golden_files():
+    """既知の出力ファイルと現在のコードの出力を比較し、{ファイル名: 一致したか} を返す"""
+    results = {}
+    for filename in DEBUG_TRACE_FILES:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, 'r') as f:
+            expected = f.read()
+        plan_line = expected.splitlines()[0]
+        frequencies = [token.split(')')[-1].strip("'") for token in plan_line.split('[', 1)[1].rstrip(']').split(', ')]
+        output, _ = run_script('.', 'imd.py', '--debug', *frequencies)
+        results[filename] = output == expected
+
+    if os.path.exists(RATINGS_RESULT_FILE):
+        with open(RATINGS_RESULT_FILE, 'r') as f:
+            expected = f.read()
+        pool = expected.splitlines()[0].split('[', 1)[1].rstrip(']').split(', ')
+        with tempfile.TemporaryDirectory() as directory:
+            prepare_workdir(directory)
+            with open(os.path.join(directory, 'freq.txt'), 'w') as f:
+                f.write(" ".join(pool) + "\n")
+            output, _ = run_script(directory, 'calculate_4freq_ratings.py')
+        results[RATINGS_RESULT_FILE] = output == expected
+    return results
+
+
+def main(argv=None):
+    # コマンドライン引数のパース
+    parser = argparse.ArgumentParser(description="評価エンジンとワークフローのベンチマーク")
+    parser.add_argument('--pools', default='10,20,40,80', help='周波数プールの大きさ（カンマ区切り、デフォルト: 10,20,40,80）')
+    parser.add_argument('--channels', default='4,5,6', help='組み合わせの周波数数K（カンマ区切り、デフォルト: 4,5,6）')
+    parser.add_argument('--max-combos', type=int, default=200000,
+                        help='1ケースで評価する組み合わせ数の上限（超える場合は先頭の一部で測定、デフォルト: 200000）')
+    parser.add_argument('--samples', type=int, default=200, help='calcRatingの計測・照合に使う組み合わせ数（デフォルト: 200）')
+    parser.add_argument('--seed', type=int, default=0, help='周波数プールと抽出の乱数シード（デフォルト: 0）')
+    parser.add_argument('--jobs', type=int, default=1, help='ワークフローの並列プロセス数（デフォルト: 1）')
+    parser.add_argument('--skip-workflow', action='store_true', help='ワークフローの計測を省略')
+    parser.add_argument('--skip-golden', action='store_true', help='既知の出力ファイルとの比較を省略')
+    parser.add_argument('--json', help='計測結果をJSONファイルに保存')
+    args = parser.parse_args(argv)
+
+    pools = [int(size) for size in args.pools.split(',')]
+    channels = [int(k) for k in args.channels.split(',')]
+    rng = np.random.default_rng(args.seed)
+    report = {'cases': [], 'golden': {}, 'workflow': None}
+    ok = True
+
+    print(f"{'プール':>6} {'K':>2} {'組み合わせ数':>12} {'評価数':>8} {'calcRating[us/件]':>18} "
+          f"{'calcRatings[件/s]':>18} {'テーブル[件/s]':>15} {'最大メモリ[MB]':>15}  一致")
+    print("-" * 120)
+    for size in pools:
+        pool = generate_pool(size, args.seed)
+        for k in channels:
+            if k > size:
+                continue
+            single = bench_calc_rating(pool, k, args.samples, rng)
+            batch, combos, ratings = bench_batch(pool, k, args.max_combos)
+            matches = batch['tables_match'] and check_against_calc_rating(combos, ratings, args.samples, rng)
+            ok = ok and matches
+            report['cases'].append({'pool': size, 'k': k, 'calcRating': single, 'match': matches,
+                                    **{key: value for key, value in batch.items() if key != 'tables_match'}})
+            engine, tables = batch['calcRatings'], batch['ProductTables']
+            print(f"{size:6d} {k:2d} {engine['total']:12d} {engine['combos']:8d} "
+                  f"{single['seconds'] / single['combos'] * 1e6:18.1f} "
+                  f"{engine['combos'] / max(engine['seconds'], 1e-9):18.0f} "
+                  f"{tables['combos'] / max(tables['seconds'], 1e-9):15.0f} "
+                  f"{max(engine['peak_mb'], tables['peak_mb']):15.1f}  {'OK' if matches else 'NG'}")
+
+    if not args.skip_workflow:
+        report['workflow'] = bench_workflow(args.jobs)
+        print("-" * 120)
+        print(f"完全なワークフロー（freq.txt）: {report['workflow']['seconds']:.2f}秒")
+
+    if not args.skip_golden:
+        report['golden'] = check_golden_files()
+        print("-" * 120)
+        print("既知の出力ファイルとの比較:")
+        for filename, matched in report['golden'].items():
+            print(f"  {filename}: {'一致' if matched else '不一致'}")
+            ok = ok and matched
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"計測結果を {args.json} に保存しました")
+
+    if not ok:
+        print("エラー: 評価値が既知の出力または calcRating と一致しません")
+        sys.exit(1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
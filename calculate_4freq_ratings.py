@@ -1,34 +1,11 @@
-import itertools
-from imd import calcRating
-
-def load_led_table():
-    """LED.txtから周波数レンジとLED数値の対応関係を読み込む"""
-    led_ranges = []
-    try:
-        with open('LED.txt', 'r') as f:
-            for line in f:
-                parts = line.strip().split('\t')
-                if len(parts) >= 3:
-                    range_str = parts[0]
-                    color = parts[1]
-                    led_number = int(parts[2])
-                    
-                    # レンジ文字列を解析（例: "5100 <= 5672"）
-                    range_parts = range_str.split(' <= ')
-                    if len(range_parts) == 2:
-                        min_freq = int(range_parts[0])
-                        max_freq = int(range_parts[1])
-                        led_ranges.append((min_freq, max_freq, led_number))
-    except FileNotFoundError:
-        print("警告: LED.txtが見つかりません")
-    return led_ranges
-
-def get_led_number(frequency, led_ranges):
-    """周波数に対応するLED数値を取得"""
-    for min_freq, max_freq, led_number in led_ranges:
-        if min_freq <= frequency <= max_freq:
-            return led_number
-    return None
+import math
+import argparse
+import numpy as np
+from imd_engine import combinationArray
+from imd_parallel import parallelCalcRatings
+from imd_stream import ThresholdRanking, TopRanking, rankStream, streamRatings
+from score_cache import SCORE_CACHE_FILE, SCORE_CACHE_MAX_ENTRIES, ScoreCache, cachedCalcRatings
+from channel_plan import get_channel_plan
 
 def read_frequencies_from_file(filename):
     """freq.txtファイルから周波数を読み込む"""
@@ -40,36 +17,63 @@ def read_frequencies_from_file(filename):
             frequencies.extend(line_freqs)
     return frequencies
 
-def calculate_all_4freq_combinations(frequencies):
-    """全ての4周波数の組み合わせでcalRatingを実行"""
+def calculate_all_4freq_combinations(frequencies, jobs=1, top=None, min_rating=None, cache=None):
+    """全ての4周波数の組み合わせでcalRatingを実行（jobs: 並列プロセス数）
+
+    top, min_rating: 指定すると組み合わせをブロックごとに評価しながら上位top件・評価値min_rating以上だけを残す
+    cache: 評価結果を再利用するScoreCache
+    """
+    def score(combos):
+        return parallelCalcRatings(combos, jobs) if cache is None else cachedCalcRatings(combos, cache, jobs)
+
     # 重複を除去してソート
     unique_frequencies = sorted(list(set(frequencies)))
     
     print(f"読み込まれた周波数: {unique_frequencies}")
     print(f"総周波数数: {len(unique_frequencies)}")
-    print(f"4周波数の組み合わせ数: {len(list(itertools.combinations(unique_frequencies, 4)))}")
+    print(f"4周波数の組み合わせ数: {math.comb(len(unique_frequencies), 4)}")
     print("-" * 80)
     
-    results = []
+    if top is not None or min_rating is not None:
+        # 全組み合わせを保持せず、ブロックごとに評価して残す分だけ保持する
+        pool = np.array(unique_frequencies, dtype=np.int32)
+        stream = streamRatings(pool, 4, score=lambda index_combos: score(pool[index_combos]))
+        if min_rating is not None:
+            stream = ((index_combos[ratings >= min_rating], ratings[ratings >= min_rating]) for index_combos, ratings in stream)
+        sink = TopRanking(top) if top is not None else ThresholdRanking(min_rating)
+        return [(tuple(combo), rating) for combo, rating in rankStream(stream, sink).results(pool)]
     
-    # 全ての4周波数の組み合わせを生成
-    for combo in itertools.combinations(unique_frequencies, 4):
-        rating = calcRating(list(combo))
-        results.append((combo, rating))
+    # 全ての4周波数の組み合わせを生成し、まとめて評価
+    combos = combinationArray(unique_frequencies, 4)
+    ratings = score(combos)
+    results = [(tuple(combo), rating) for combo, rating in zip(combos.tolist(), ratings.tolist())]
     
     # 評価値でソート（降順）
     results.sort(key=lambda x: x[1], reverse=True)
     
     return results
 
-def main():
+def main(argv=None):
+    # コマンドライン引数のパース
+    parser = argparse.ArgumentParser(description="4周波数組み合わせの評価")
+    parser.add_argument('--jobs', type=int, default=1, help='評価に使う並列プロセス数（デフォルト: 1）')
+    parser.add_argument('--top', type=int, help='上位N件だけを保持して表示する（全組み合わせをメモリに載せない）')
+    parser.add_argument('--min-rating', type=int, help='評価値がR以上の組み合わせだけを保持して表示する')
+    parser.add_argument('--score-cache', nargs='?', const=SCORE_CACHE_FILE,
+                        help=f'評価結果をSQLiteファイルにキャッシュして再利用する（ファイル省略時: {SCORE_CACHE_FILE}）')
+    parser.add_argument('--score-cache-size', type=int, default=SCORE_CACHE_MAX_ENTRIES,
+                        help=f'キャッシュに保持する組み合わせ数の上限（デフォルト: {SCORE_CACHE_MAX_ENTRIES}）')
+    args = parser.parse_args(argv)
+    
     # LED.txtから周波数レンジとLED数値の対応関係を読み込み
-    led_ranges = load_led_table()
+    plan = get_channel_plan()
     
     # freq.txtから周波数を読み込み
     frequencies = read_frequencies_from_file('freq.txt')
     # 全ての4周波数の組み合わせでcalRatingを実行
-    results = calculate_all_4freq_combinations(sorted(frequencies))
+    cache = ScoreCache(args.score_cache, args.score_cache_size) if args.score_cache else None
+    results = calculate_all_4freq_combinations(sorted(frequencies), jobs=args.jobs,
+                                               top=args.top, min_rating=args.min_rating, cache=cache)
 
     # 結果を表示
     print("4周波数組み合わせの評価結果（評価値順）:")
@@ -79,7 +83,7 @@ def main():
         # 各周波数にLED数値を付けて表示
         freq_with_led = []
         for freq in combo:
-            led_num = get_led_number(freq, led_ranges)
+            led_num = plan.led_number(freq)
             if led_num is not None:
                 freq_with_led.append(f"{freq}(LED{led_num})")
             else:
@@ -93,6 +97,8 @@ def main():
     
     print("-" * 80)
     print(f"総組み合わせ数: {len(results)}")
+    if args.top is not None or args.min_rating is not None:
+        print(f"（評価した組み合わせ数: {math.comb(len(set(frequencies)), 4)}）")
     
     # 最高評価値の組み合わせを強調表示
     if results:
@@ -100,7 +106,7 @@ def main():
         # 最高評価の組み合わせにもLED数値を表示
         best_freq_with_led = []
         for freq in best_combo:
-            led_num = get_led_number(freq, led_ranges)
+            led_num = plan.led_number(freq)
             if led_num is not None:
                 best_freq_with_led.append(f"{freq}(LED{led_num})")
             else:
@@ -108,6 +114,10 @@ def main():
         
         print(f"\n最高評価値: {best_rating}")
         print(f"最適な4周波数組み合わせ: {best_freq_with_led}")
+    
+    if cache is not None:
+        cache.print_stats()
+        cache.close()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,244 @@
+import ast
+import os
+import threading
+
+import numpy as np
+
+from imd_enumerate import CombinationConstraints
+
+VTX_TABLE_FILE = 'vtxtable.txt'
+LED_TABLE_FILE = 'LED.txt'
+FPV_BANDS_FILE = os.path.join('original_files', 'app.py')
+
+# チャネル幅に加えて隣のチャネルとの間に空ける間隔（MHz）。app.pyの「チャネル幅 + 1MHz」の規則
+CHANNEL_GAP = 1
+
+
+def load_vtx_table(filename=VTX_TABLE_FILE):
+    """vtxtable.txtから周波数とチャネルの対応関係を読み込む"""
+    frequency_to_channel = {}
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                parts = line.strip().split()
+                if len(parts) >= 9:  # バンド名、周波数が含まれている行
+                    band_letter = parts[4]  # A, B, E, F, R
+                    frequencies = parts[6:]  # 周波数のリスト
+
+                    for i, freq in enumerate(frequencies):
+                        try:
+                            freq_int = int(freq)
+                            channel_name = f"{band_letter}{i+1}"
+                            frequency_to_channel[freq_int] = channel_name
+                        except ValueError:
+                            continue
+    except FileNotFoundError:
+        print(f"警告: {filename}が見つかりません")
+    return frequency_to_channel
+
+
+def load_led_table(filename=LED_TABLE_FILE):
+    """LED.txtから周波数レンジとLED数値の対応関係を読み込む"""
+    led_ranges = []
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                parts = line.strip().split('\t')
+                if len(parts) >= 3:
+                    range_str = parts[0]
+                    led_number = int(parts[2])
+
+                    # レンジ文字列を解析（例: "5100 <= 5672"）
+                    range_parts = range_str.split(' <= ')
+                    if len(range_parts) == 2:
+                        min_freq = int(range_parts[0])
+                        max_freq = int(range_parts[1])
+                        led_ranges.append((min_freq, max_freq, led_number))
+    except FileNotFoundError:
+        print(f"警告: {filename}が見つかりません")
+    return led_ranges
+
+
+def load_fpv_bands(filename=FPV_BANDS_FILE):
+    """app.pyのfpv_bands_*定義をスクリプトを実行せずに読み込む（例: {'analog': {'R': [(5658, 1), ...]}}）"""
+    fpv_bands = {}
+    try:
+        with open(filename, 'r') as f:
+            tree = ast.parse(f.read(), filename)
+    except FileNotFoundError:
+        return fpv_bands
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name) and target.id.startswith('fpv_bands_'):
+                fpv_bands[target.id[len('fpv_bands_'):]] = ast.literal_eval(node.value)
+    return fpv_bands
+
+
+def load_bandwidth_options(filename=FPV_BANDS_FILE):
+    """app.pyのBANDWIDTH_OPTIONS定義をスクリプトを実行せずに読み込む（例: {'analog': 17, 'hdzero': 27}）"""
+    try:
+        with open(filename, 'r') as f:
+            tree = ast.parse(f.read(), filename)
+    except FileNotFoundError:
+        return {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id == 'BANDWIDTH_OPTIONS' for target in node.targets):
+            return ast.literal_eval(node.value)
+    return {}
+
+
+class ChannelPlan:
+    """VTXテーブル、LEDテーブル、FPVバンド定義をまとめて保持し、周波数から配列参照で引けるようにする"""
+
+    def __init__(self, frequency_to_channel, led_ranges, fpv_bands, bandwidth_options=None):
+        self.frequency_to_channel = frequency_to_channel
+        self.led_ranges = led_ranges
+        self.fpv_bands = fpv_bands
+        self.bandwidth_options = bandwidth_options or {}
+
+        # 参照テーブルは既知の全周波数を含む範囲の配列（インデックス = 周波数 - base）
+        known = list(frequency_to_channel)
+        known += [freq for min_freq, max_freq, _ in led_ranges for freq in (min_freq, max_freq)]
+        known += [freq for bands in fpv_bands.values() for channels in bands.values() for freq, _ in channels]
+        self.base = min(known) if known else 0
+        size = max(known) - self.base + 1 if known else 0
+
+        self.channel_names = np.full(size, None, dtype=object)
+        self.bands = np.full(size, None, dtype=object)
+        for freq, channel_name in frequency_to_channel.items():
+            self.channel_names[freq - self.base] = channel_name
+            self.bands[freq - self.base] = channel_name[0]
+
+        # LED番号（0はLED不明）。レンジの境界が重なる場合は先に定義されたレンジを優先する
+        self.led_numbers = np.zeros(size, dtype=np.int32)
+        for min_freq, max_freq, led_number in reversed(led_ranges):
+            self.led_numbers[min_freq - self.base:max_freq - self.base + 1] = led_number
+
+        # モード（analog, hdzero）ごとの周波数 -> [(バンド, チャネル番号), ...]
+        self.band_channels = {}
+        for mode, bands in fpv_bands.items():
+            table = np.empty(size, dtype=object)
+            for i in range(size):
+                table[i] = []
+            for band_name, channels in bands.items():
+                for freq, ch in channels:
+                    table[freq - self.base].append((band_name, ch))
+            self.band_channels[mode] = table
+
+        # 作成後は変更しない（評価スレッドから共有して参照する）
+        for array in (self.channel_names, self.bands, self.led_numbers, *self.band_channels.values()):
+            array.flags.writeable = False
+
+    def _index(self, frequency):
+        index = frequency - self.base
+        if 0 <= index < len(self.channel_names):
+            return index
+        return None
+
+    def channel_name(self, frequency):
+        """周波数に対応するチャネル名（例: A8）を取得"""
+        index = self._index(frequency)
+        return None if index is None else self.channel_names[index]
+
+    def band(self, frequency):
+        """周波数に対応するバンド名（例: A）を取得"""
+        index = self._index(frequency)
+        return None if index is None else self.bands[index]
+
+    def led_number(self, frequency):
+        """周波数に対応するLED数値を取得"""
+        index = self._index(frequency)
+        if index is None or self.led_numbers[index] == 0:
+            return None
+        return int(self.led_numbers[index])
+
+    def led_number_array(self, frequencies):
+        """周波数配列に対応するLED数値の配列を取得（0はLED不明）"""
+        frequencies = np.asarray(frequencies)
+        index = frequencies - self.base
+        inside = (index >= 0) & (index < len(self.led_numbers))
+        result = np.zeros(frequencies.shape, dtype=np.int32)
+        result[inside] = self.led_numbers[index[inside]]
+        return result
+
+    def fpv_band_channels(self, frequency, mode='analog'):
+        """app.pyのバンド定義で周波数に対応する(バンド, チャネル番号)のリストを取得"""
+        index = self._index(frequency)
+        if index is None or mode not in self.band_channels:
+            return []
+        return self.band_channels[mode][index]
+
+    def band_names(self, frequency):
+        """周波数が属するバンド名の集合（vtxtable.txtとapp.pyの全モードのバンド定義から）"""
+        names = {band for mode in self.band_channels for band, _ in self.fpv_band_channels(frequency, mode)}
+        band = self.band(frequency)
+        if band is not None:
+            names.add(band)
+        return names
+
+    def frequencies_of(self, name):
+        """バンド名（例: R）またはapp.pyのチャネル定義のモード名（例: hdzero）に含まれる周波数のリスト（昇順）"""
+        if name in self.fpv_bands:
+            return sorted({freq for channels in self.fpv_bands[name].values() for freq, _ in channels})
+        frequencies = {freq for freq, channel_name in self.frequency_to_channel.items() if channel_name[0] == name}
+        frequencies.update(freq for bands in self.fpv_bands.values() for freq, _ in bands.get(name, []))
+        return sorted(frequencies)
+
+    def min_separation(self, bandwidth_mode):
+        """帯域幅モード（BANDWIDTH_OPTIONS）で隣り合うチャネルに必要な最小の間隔（チャネル幅 + CHANNEL_GAP）"""
+        if bandwidth_mode not in self.bandwidth_options:
+            raise ValueError(f"不明な帯域幅モード: {bandwidth_mode}（{', '.join(self.bandwidth_options)}）")
+        return self.bandwidth_options[bandwidth_mode] + CHANNEL_GAP
+
+    def combination_constraints(self, distinct_led=False, bandwidth_mode=None, bands=None, window=None):
+        """チャネルプランに基づく組み合わせの制約（LED番号が全て異なる、帯域幅モードの間隔、使うバンド、周波数の範囲）"""
+        return CombinationConstraints(
+            min_separation=0 if bandwidth_mode is None else self.min_separation(bandwidth_mode),
+            window=window,
+            bands=bands,
+            band_names=self.band_names,
+            groups=self.led_number if distinct_led else None,
+            group_name='LED番号')
+
+    def label(self, frequency):
+        """周波数にチャネル名を付けて返す（例: (A8)5725）"""
+        channel_name = self.channel_name(frequency)
+        if channel_name is not None:
+            return f"({channel_name}){frequency}"
+        return str(frequency)
+
+    def label_with_led(self, frequency):
+        """周波数にチャネル名とLED番号を付けて返す（例: (A8)5725[LED3]）"""
+        led_num = self.led_number(frequency)
+        if led_num is not None:
+            return f"{self.label(frequency)}[LED{led_num}]"
+        return f"{self.label(frequency)}[LED?]"
+
+
+_plan_cache = {}
+# 評価スレッドから同時に呼ばれても一度だけ読み込むためのロック
+_plan_lock = threading.Lock()
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_channel_plan(vtx_file=VTX_TABLE_FILE, led_file=LED_TABLE_FILE, fpv_bands_file=FPV_BANDS_FILE):
+    """チャネルプランを取得（各ファイルの更新時刻が変わった場合のみ再読み込み）"""
+    key = tuple(os.path.abspath(filename) for filename in (vtx_file, led_file, fpv_bands_file))
+    mtimes = tuple(_mtime(filename) for filename in key)
+    with _plan_lock:
+        cached = _plan_cache.get(key)
+        if cached is None or cached[0] != mtimes:
+            plan = ChannelPlan(load_vtx_table(vtx_file), load_led_table(led_file), load_fpv_bands(fpv_bands_file),
+                               load_bandwidth_options(fpv_bands_file))
+            cached = (mtimes, plan)
+            _plan_cache[key] = cached
+        return cached[1]
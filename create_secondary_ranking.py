@@ -1,5 +1,18 @@
-import itertools
-from imd import calcRating
+import math
+import os
+import argparse
+import numpy as np
+import metrics
+from channel_plan import get_channel_plan
+from imd import DEFAULT_MAX_ORDER, MAX_ORDER_LIMIT
+from imd_engine import combinationIndexArray
+from imd_enumerate import constrainedIndexArray
+from imd_parallel import ParallelScorer, parallelCalcRatings
+from imd_delta import grayCodeRanking
+from imd_stream import ThresholdRanking, TopRanking, rankStream, streamRatings
+from score_cache import SCORE_CACHE_FILE, SCORE_CACHE_MAX_ENTRIES, ScoreCache, cachedCalcRatings
+from incremental_ranking import is_full_ranking, rerank
+from ranking_file import RANKING_FILE, RankingFile, render_ranking_text, write_ranking_results
 
 def read_frequencies_from_file(filename):
     """freq.txtファイルから周波数を読み込む"""
@@ -11,92 +24,116 @@ def read_frequencies_from_file(filename):
             frequencies.extend(line_freqs)
     return frequencies
 
-def create_secondary_ranking(frequencies):
-    """全ての4周波数の組み合わせで二次合成による評価を行い、順位リストを作成"""
-    # 重複を除去してソート
-    unique_frequencies = sorted(list(set(frequencies)))
-    
+def print_pool_summary(unique_frequencies):
+    """周波数プールと組み合わせ数を表示"""
     print(f"読み込まれた周波数: {unique_frequencies}")
     print(f"総周波数数: {len(unique_frequencies)}")
-    print(f"4周波数の組み合わせ数: {len(list(itertools.combinations(unique_frequencies, 4)))}")
+    print(f"4周波数の組み合わせ数: {math.comb(len(unique_frequencies), 4)}")
     print("-" * 80)
+
+def create_secondary_ranking(frequencies, jobs=1, gray_code=False, top=None, min_rating=None, cache=None,
+                             max_order=DEFAULT_MAX_ORDER, constraints=None, threads=1):
+    """全ての4周波数の組み合わせで二次合成による評価を行い、順位リストを作成
+
+    jobs: 並列プロセス数、threads: 並列スレッド数（配列はコピーせずに共有する）、gray_code: 回転ドア順に列挙して1チャネルの入れ替えごとに差分で評価する
+    top, min_rating: 指定すると組み合わせをブロックごとに評価しながら上位top件・評価値min_rating以上だけを残す
+    cache: 評価結果を再利用するScoreCache（キャッシュにある組み合わせは評価を省略する）
+    max_order: 合成波の次数の上限
+    constraints: CombinationConstraintsを指定すると、制約を満たす組み合わせだけを列挙して評価する
+    """
+    # 重複を除去してソート
+    unique_frequencies = sorted(list(set(frequencies)))
+    
+    print_pool_summary(unique_frequencies)
+    if constraints is not None:
+        print(f"組み合わせの制約: {constraints.describe()}")
+    
+    if gray_code:
+        # 回転ドア順に列挙し、差分評価で順位リストを作成（並び順は通常の評価と同じ）
+        return grayCodeRanking(unique_frequencies, 4)
+    
+    # 合成波は組み合わせごとに係数の表から直接求める（プールの合成波テーブルを引くより速いため）
+    pool = np.asarray(unique_frequencies, dtype=np.int32)
     
-    results = []
+    evaluated = 0
+    # ワーカーは全ブロックの評価で使い回す
+    scorer = ParallelScorer(jobs, threads, max_order)
     
-    # 全ての4周波数の組み合わせを生成
-    for combo in itertools.combinations(unique_frequencies, 4):
-        rating = calcRating(list(combo))
-        results.append((list(combo), rating))
+    def score(index_combos):
+        nonlocal evaluated
+        evaluated += len(index_combos)
+        if cache is not None:
+            return cachedCalcRatings(pool[index_combos], cache, max_order=max_order, scorer=scorer)
+        return scorer.calcRatings(pool[index_combos])
+    
+    if top is not None or min_rating is not None:
+        # 全組み合わせを保持せず、ブロックごとに評価して残す分だけ保持する
+        stream = streamRatings(pool, 4, score=score, constraints=constraints)
+        if min_rating is not None:
+            stream = ((index_combos[ratings >= min_rating], ratings[ratings >= min_rating]) for index_combos, ratings in stream)
+        sink = TopRanking(top) if top is not None else ThresholdRanking(min_rating)
+        with metrics.stage('secondary_evaluation') as timer, scorer:
+            results = rankStream(stream, sink).results(pool)
+            timer.combos = evaluated
+        if constraints is not None:
+            print(f"制約を満たす組み合わせ数: {evaluated}")
+        return results
+    
+    if constraints is not None:
+        # 制約を満たす4周波数の組み合わせだけを列挙（満たさない枝は生成・評価しない）
+        index_combos = constrainedIndexArray(pool.tolist(), 4, constraints)
+        print(f"制約を満たす組み合わせ数: {len(index_combos)}")
+    else:
+        # 全ての4周波数の組み合わせを生成し、まとめて評価
+        index_combos = combinationIndexArray(len(unique_frequencies), 4)
+    with metrics.stage('secondary_evaluation', combos=len(index_combos)), scorer:
+        ratings = score(index_combos)
+    combos = pool[index_combos]
+    results = [(combo, rating) for combo, rating in zip(combos.tolist(), ratings.tolist())]
     
     # 評価値でソート（降順）
-    results.sort(key=lambda x: x[1], reverse=True)
+    with metrics.stage('sort', combos=len(results)):
+        results.sort(key=lambda x: x[1], reverse=True)
     
     return results
 
-def save_ranking_to_file(results, filename="secondary_ranking.txt"):
-    """順位リストをファイルに保存"""
-    from imd3 import loadVtxTable, getFrequencyWithChannel
-    
-    vtx_table = loadVtxTable()
-    
-    # LEDテーブルを読み込み
-    def load_led_table():
-        """LED.txtから周波数レンジとLED数値の対応関係を読み込む"""
-        led_ranges = []
-        try:
-            with open('LED.txt', 'r') as f:
-                for line in f:
-                    parts = line.strip().split('\t')
-                    if len(parts) >= 3:
-                        range_str = parts[0]
-                        led_number = int(parts[2])
-                        range_parts = range_str.split(' <= ')
-                        if len(range_parts) == 2:
-                            min_freq = int(range_parts[0])
-                            max_freq = int(range_parts[1])
-                            led_ranges.append((min_freq, max_freq, led_number))
-        except FileNotFoundError:
-            print("警告: LED.txtが見つかりません")
-        return led_ranges
-    
-    def get_led_number(frequency, led_ranges):
-        """周波数に対応するLED数値を取得"""
-        for min_freq, max_freq, led_number in led_ranges:
-            if min_freq <= frequency <= max_freq:
-                return led_number
+def update_secondary_ranking(frequencies, jobs=1, cache=None, binary_filename=RANKING_FILE, threads=1):
+    """保存済みの順位リストを新しい周波数プールに合わせて更新（追加された周波数を含む組み合わせだけを評価）
+
+    保存済みの順位リストがない・形式が古い・全組み合わせを含まない・評価パラメータ（合成波の次数、
+    評価方法のバージョンを含む）が異なる場合はNoneを返す。
+    """
+    if not os.path.exists(binary_filename):
+        print(f"{binary_filename} がないため、全ての組み合わせを評価します")
+        return None
+    try:
+        ranking = RankingFile(binary_filename)
+    except ValueError as e:
+        print(f"{e}。全ての組み合わせを評価します")
+        return None
+    if ranking.k != 4 or not is_full_ranking(ranking):
+        print(f"{binary_filename} は現在の設定での全組み合わせの順位リストではないため、全ての組み合わせを評価します")
         return None
     
-    led_ranges = load_led_table()
-    
-    with open(filename, 'w') as f:
-        f.write("# 二次合成による4周波数組み合わせ順位リスト\n")
-        f.write("# 形式: 順位, 周波数1(チャネル)[LED], 周波数2(チャネル)[LED], 周波数3(チャネル)[LED], 周波数4(チャネル)[LED], 評価値\n")
-        f.write("-" * 120 + "\n")
-        
-        for i, (combo, rating) in enumerate(results, 1):
-            # 周波数にチャネル名とLED番号を付けて表示
-            freq_with_channel_led = []
-            for freq in combo:
-                channel_str = getFrequencyWithChannel(freq, vtx_table)
-                led_num = get_led_number(freq, led_ranges)
-                if led_num is not None:
-                    freq_with_channel_led.append(f"{channel_str}[LED{led_num}]")
-                else:
-                    freq_with_channel_led.append(f"{channel_str}[LED?]")
-            
-            freq_str = ", ".join(freq_with_channel_led)
-            f.write(f"{i:4d}, {freq_str}, {rating}\n")
-    
-    print(f"順位リストを {filename} に保存しました")
-
-def main():
-    # freq.txtから周波数を読み込み
-    frequencies = read_frequencies_from_file('freq.txt')
+    unique_frequencies = sorted(list(set(frequencies)))
+    print_pool_summary(unique_frequencies)
+    removed_frequencies = sorted(set(ranking.pool.tolist()) - set(unique_frequencies))
+    added_frequencies = sorted(set(unique_frequencies) - set(ranking.pool.tolist()))
     
-    # 二次合成による評価と順位リスト作成
-    results = create_secondary_ranking(frequencies)
+    def score(combos):
+        if cache is None:
+            return parallelCalcRatings(combos, jobs, threads=threads)
+        return cachedCalcRatings(combos, cache, jobs, threads=threads)
     
-    # 結果を表示
+    with metrics.stage('incremental_rerank'):
+        pool, index_combos, ratings, removed, added = rerank(ranking, unique_frequencies, score)
+    print(f"前回の順位リストを更新: 削除した周波数 {removed_frequencies}, 追加した周波数 {added_frequencies}")
+    print(f"削除した組み合わせ: {removed}件, 新たに評価した組み合わせ: {added}件")
+    print("-" * 80)
+    return list(zip(pool[index_combos].tolist(), ratings.tolist()))
+
+def print_ranking_results(results, evaluated=None):
+    """順位リストの上位20件と最高評価値の組み合わせを表示（evaluated: 一部だけを保持した場合の評価した組み合わせ数）"""
     print("二次合成による4周波数組み合わせの評価結果（評価値順）:")
     print("-" * 80)
     
@@ -105,15 +142,140 @@ def main():
     
     print("-" * 80)
     print(f"総組み合わせ数: {len(results)}")
+    if evaluated is not None:
+        print(f"（評価した組み合わせ数: {evaluated}）")
     
     # 最高評価値の組み合わせを強調表示
     if results:
         best_combo, best_rating = results[0]
         print(f"\n最高評価値: {best_rating}")
         print(f"最適な4周波数組み合わせ: {best_combo}")
+
+def save_ranking_to_file(results, filename="secondary_ranking.txt", pool=None, binary_filename=RANKING_FILE,
+                         max_order=DEFAULT_MAX_ORDER):
+    """順位リストをバイナリ形式で保存し、テキスト形式はそこから書き出す（filename=Noneならテキストは省略）"""
+    write_ranking_results(binary_filename, results, pool, max_order)
+    print(f"順位リストを {binary_filename} に保存しました")
+    
+    if filename is not None:
+        render_ranking_text(RankingFile(binary_filename), filename)
+        print(f"順位リストを {filename} に保存しました")
+
+def add_threads_argument(parser):
+    """--threads のコマンドライン引数を追加"""
+    parser.add_argument('--threads', type=int, default=1,
+                        help='評価に使う並列スレッド数（デフォルト: 1）。プロセスを起動せず、合成波テーブルをコピーせずに共有する')
+
+def add_max_order_argument(parser):
+    """--max-order のコマンドライン引数を追加"""
+    parser.add_argument('--max-order', type=int, default=DEFAULT_MAX_ORDER,
+                        choices=range(DEFAULT_MAX_ORDER, MAX_ORDER_LIMIT + 1), metavar='N',
+                        help=f'評価する合成波の次数の上限（{DEFAULT_MAX_ORDER}〜{MAX_ORDER_LIMIT}、'
+                             f'デフォルト: {DEFAULT_MAX_ORDER}。5で五次の合成波を追加）')
+
+def parse_bands(text):
+    """カンマ区切りのバンド名（例: "R,F"）を大文字のバンド名の集合に変換"""
+    bands = {band.strip().upper() for band in text.split(',') if band.strip()}
+    if not bands:
+        raise argparse.ArgumentTypeError("バンド名を1つ以上指定してください")
+    return bands
+
+def parse_window(text):
+    """周波数の範囲（例: "5650-5900"）を (下限, 上限) に変換"""
+    try:
+        low, high = (int(part) for part in text.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"周波数の範囲は 下限-上限 の形式で指定してください: {text}")
+    if low > high:
+        raise argparse.ArgumentTypeError(f"周波数の範囲の下限が上限より大きくなっています: {text}")
+    return low, high
+
+def add_constraint_arguments(parser):
+    """組み合わせの制約（--distinct-led, --bandwidth-mode, --bands, --window）のコマンドライン引数を追加"""
+    parser.add_argument('--distinct-led', action='store_true',
+                        help='4周波数のLED番号（LED.txt）が全て異なる組み合わせだけを評価する')
+    parser.add_argument('--bandwidth-mode', choices=sorted(get_channel_plan().bandwidth_options),
+                        help='帯域幅モード（app.pyのBANDWIDTH_OPTIONS）のチャネル幅+1MHz以上離れた組み合わせだけを評価する')
+    parser.add_argument('--bands', type=parse_bands, help='使うバンドをカンマ区切りで指定（例: R,F）')
+    parser.add_argument('--window', type=parse_window, help='使う周波数の範囲（MHz、例: 5650-5900）')
+
+def constraints_from_args(args):
+    """コマンドライン引数から組み合わせの制約を作る（制約の指定がなければNone）"""
+    if not (args.distinct_led or args.bandwidth_mode or args.bands or args.window):
+        return None
+    return get_channel_plan().combination_constraints(distinct_led=args.distinct_led, bandwidth_mode=args.bandwidth_mode,
+                                                      bands=args.bands, window=args.window)
+
+def main(argv=None):
+    # コマンドライン引数のパース
+    parser = argparse.ArgumentParser(description="二次合成による4周波数組み合わせ順位リスト作成")
+    parser.add_argument('--jobs', type=int, default=1, help='評価に使う並列プロセス数（デフォルト: 1）')
+    add_threads_argument(parser)
+    parser.add_argument('--gray-code', action='store_true', help='回転ドア順に列挙し、1チャネルの入れ替えごとに差分で評価する')
+    parser.add_argument('--top', type=int, help='上位N件だけを保持して保存する（全組み合わせをメモリに載せない）')
+    parser.add_argument('--min-rating', type=int, help='評価値がR以上の組み合わせだけを保持して保存する')
+    parser.add_argument('--score-cache', nargs='?', const=SCORE_CACHE_FILE,
+                        help=f'評価結果をSQLiteファイルにキャッシュして再利用する（ファイル省略時: {SCORE_CACHE_FILE}）')
+    parser.add_argument('--score-cache-size', type=int, default=SCORE_CACHE_MAX_ENTRIES,
+                        help=f'キャッシュに保持する組み合わせ数の上限（デフォルト: {SCORE_CACHE_MAX_ENTRIES}）')
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'保存済みの {RANKING_FILE} を周波数プールの変更分だけ評価して更新する')
+    parser.add_argument('--no-text', action='store_true', help=f'テキスト形式の順位リストを書き出さない（{RANKING_FILE} のみ保存）')
+    add_max_order_argument(parser)
+    add_constraint_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    args.constraints = constraints_from_args(args)
+    if args.jobs > 1 and args.threads > 1:
+        parser.error("--jobs と --threads は同時に指定できません")
+    if args.gray_code and (args.top is not None or args.min_rating is not None):
+        parser.error("--gray-code は --top / --min-rating と同時に指定できません")
+    if args.incremental and (args.gray_code or args.top is not None or args.min_rating is not None):
+        parser.error("--incremental は --gray-code / --top / --min-rating と同時に指定できません")
+    if args.max_order != DEFAULT_MAX_ORDER and (args.gray_code or args.incremental):
+        parser.error("--max-order は --gray-code / --incremental と同時に指定できません")
+    if args.constraints is not None and (args.gray_code or args.incremental):
+        parser.error("--distinct-led / --bandwidth-mode / --bands / --window は --gray-code / --incremental と同時に指定できません")
+    
+    if args.metrics:
+        metrics.enable()
+    with metrics.profiled(args.profile):
+        results = run_secondary_ranking(args)
+    if args.metrics:
+        metrics.write_json(args.metrics)
+    return results
+
+def run_secondary_ranking(args):
+    """コマンドライン引数に従って二次合成の順位リストを作成し、表示・保存する"""
+    # freq.txtから周波数を読み込み
+    with metrics.stage('read_frequencies'):
+        frequencies = read_frequencies_from_file('freq.txt')
+    
+    # 二次合成による評価と順位リスト作成
+    cache = ScoreCache(args.score_cache, args.score_cache_size, args.max_order) if args.score_cache else None
+    results = None
+    if args.incremental:
+        results = update_secondary_ranking(frequencies, jobs=args.jobs, cache=cache, threads=args.threads)
+    if results is None:
+        results = create_secondary_ranking(frequencies, jobs=args.jobs, gray_code=args.gray_code,
+                                           top=args.top, min_rating=args.min_rating, cache=cache,
+                                           max_order=args.max_order, constraints=args.constraints,
+                                           threads=args.threads)
+    
+    # 結果を表示（制約を指定した場合は制約を満たす組み合わせ数を表示済み）
+    evaluated = None
+    if (args.top is not None or args.min_rating is not None) and args.constraints is None:
+        evaluated = math.comb(len(set(frequencies)), 4)
+    print_ranking_results(results, evaluated)
     
     # 順位リストをファイルに保存
-    save_ranking_to_file(results)
+    with metrics.stage('save_ranking', combos=len(results)):
+        save_ranking_to_file(results, None if args.no_text else "secondary_ranking.txt", pool=sorted(set(frequencies)),
+                             max_order=args.max_order)
+    
+    if cache is not None:
+        cache.print_stats()
+        cache.close()
     
     return results
 
@@ -1,3 +1,10 @@
+import functools
+import itertools
+from collections import namedtuple
+
+import metrics
+from channel_plan import get_channel_plan
+
 MIN_DISPLAY_FREQUENCY = 5100
 MAX_DISPLAY_FREQUENCY = 6099
 RATING_MAX_VALUE = 100
@@ -5,26 +12,8 @@ RATING_DIFF_LIMIT = 35
 
 
 def loadVtxTable():
-    """vtxtable.txtから周波数とチャネルの対応関係を読み込む"""
-    frequency_to_channel = {}
-    try:
-        with open('vtxtable.txt', 'r') as f:
-            for line in f:
-                parts = line.strip().split()
-                if len(parts) >= 9:  # バンド名、周波数が含まれている行
-                    band_letter = parts[4]  # A, B, E, F, R
-                    frequencies = parts[6:]  # 周波数のリスト
-                    
-                    for i, freq in enumerate(frequencies):
-                        try:
-                            freq_int = int(freq)
-                            channel_name = f"{band_letter}{i+1}"
-                            frequency_to_channel[freq_int] = channel_name
-                        except ValueError:
-                            continue
-    except FileNotFoundError:
-        print("警告: vtxtable.txtが見つかりません")
-    return frequency_to_channel
+    """vtxtable.txtから周波数とチャネルの対応関係を読み込む（チャネルプランのキャッシュを使用）"""
+    return get_channel_plan().frequency_to_channel
 
 
 def getFrequencyWithChannel(frequency: int, vtx_table: dict):
@@ -47,185 +36,217 @@ def findNearestFrequency(frequency: int, frequencies: list):
     return nearest
 
 
-def calcRating(frequencies: list, debug: bool = False):
-    vtx_table = loadVtxTable()
+# 合成パターン（calcRatingの列挙順）: (名前, 係数, 式の書式)
+# パターン0は二次合成で (f1, f2) に、パターン1〜10は三次合成で (f1, f2, f3) に係数を掛ける。
+# 書式の {0}, {1}, {2} には f1 などの名前、またはチャネル名付きの周波数が入る。
+IMD_PATTERNS = [
+    ("二次合成", (2, -1), "{0}*2 - {1}"),
+    ("三次合成(パターン1)", (1, -1, 1), "{0} - {1} + {2}"),
+    ("三次合成(パターン2)", (1, 1, -1), "{0} + {1} - {2}"),
+    ("三次合成(パターン3)", (2, -1, -1), "2*{0} - {1} - {2}"),
+    ("三次合成(パターン4)", (1, 1, 1), "{0} + {1} + {2}"),
+    ("三次合成(パターン5)", (-1, 1, 1), "-{0} + {1} + {2}"),
+    ("三次合成(パターン6)", (2, 1, -1), "2*{0} + {1} - {2}"),
+    ("三次合成(パターン7)", (2, -1, 1), "2*{0} - {1} + {2}"),
+    ("三次合成(パターン8)", (1, -2, 1), "{0} - 2*{1} + {2}"),
+    ("三次合成(パターン9)", (1, 2, -1), "{0} + 2*{1} - {2}"),
+    ("三次合成(パターン10)", (-1, 2, 1), "-{0} + 2*{1} + {2}"),
+]
+THIRD_ORDER_COEFFICIENTS = [coefficients for _, coefficients, _ in IMD_PATTERNS[1:]]
+
+# 合成波の次数（係数の絶対値の合計）の上限の既定値と最大値
+# 既定の3はIMD_PATTERNSのみ（従来の評価）。5を指定すると五次の合成波を追加する。
+# 表示範囲内に出る合成波は係数の合計が1のものだけなので、偶数次では追加される合成波はない。
+DEFAULT_MAX_ORDER = 3
+MAX_ORDER_LIMIT = 5
+ORDER_NAMES = {5: "五次合成"}
+
+# explainが返す合成波の記録
+# pattern: IMD_PATTERNSの番号、indices: 係数を掛ける周波数の番号（0始まり）、product: 合成周波数、
+# nearest: 最近接周波数、difference: 差、contribution: 減点（calcRatingのtotalへの加算値）
+IMDTerm = namedtuple('IMDTerm', ['pattern', 'indices', 'product', 'nearest', 'difference', 'contribution'])
+
+
+def orderCoefficients(order: int):
+    """係数の絶対値の合計がorderで係数の合計が1の係数の組（各組は降順、2周波数以上）を列挙"""
+    results = []
+
+    def extend(prefix, remaining):
+        if remaining == 0:
+            if len(prefix) >= 2 and sum(prefix) == 1:
+                results.append(tuple(prefix))
+            return
+        largest = min(prefix[-1], remaining) if prefix else remaining
+        for c in range(largest, -remaining - 1, -1):
+            if c != 0:
+                extend(prefix + [c], remaining - abs(c))
+
+    extend([], order)
+    # 周波数の数が少ない順、同じ数なら係数の大きい順
+    return sorted(results, key=lambda coefficients: (len(coefficients), [-c for c in coefficients]))
+
+
+def expressionFormat(coefficients):
+    """係数の組から式の書式（例: (3, -2) -> "3*{0} - 2*{1}"）を作成"""
+    expression = ""
+    for i, c in enumerate(coefficients):
+        term = ("" if abs(c) == 1 else f"{abs(c)}*") + "{" + str(i) + "}"
+        if i == 0:
+            expression = term if c > 0 else "-" + term
+        else:
+            expression += (" + " if c > 0 else " - ") + term
+    return expression
+
+
+@functools.lru_cache(maxsize=None)
+def imdPatterns(max_order: int = DEFAULT_MAX_ORDER):
+    """次数max_order以下の合成パターン（IMD_PATTERNSの後に五次の合成パターンを追加したもの）
+
+    max_orderが小さい場合の一覧は大きい場合の先頭部分と一致するため、パターン番号は次数によらない。
+    """
+    if not DEFAULT_MAX_ORDER <= max_order <= MAX_ORDER_LIMIT:
+        raise ValueError(f"合成波の次数は{DEFAULT_MAX_ORDER}〜{MAX_ORDER_LIMIT}で指定してください: {max_order}")
+    patterns = list(IMD_PATTERNS)
+    for order in range(DEFAULT_MAX_ORDER + 2, max_order + 1, 2):
+        for number, coefficients in enumerate(orderCoefficients(order), 1):
+            patterns.append((f"{ORDER_NAMES[order]}(パターン{number})", coefficients, expressionFormat(coefficients)))
+    return tuple(patterns)
+
+
+@functools.lru_cache(maxsize=None)
+def higherOrderSlots(n: int, max_order: int = DEFAULT_MAX_ORDER):
+    """IMD_PATTERNSより後の合成パターンをn周波数に適用する (パターン番号, 周波数の番号) の一覧
+
+    同じ合成波を重複して数えないよう、係数が同じ周波数は番号の昇順の並びだけを使う。
+    """
+    patterns = imdPatterns(max_order)
+    slots = []
+    for pattern in range(len(IMD_PATTERNS), len(patterns)):
+        coefficients = patterns[pattern][1]
+        for indices in itertools.permutations(range(n), len(coefficients)):
+            if all(indices[i] < indices[i + 1] for i in range(len(coefficients) - 1)
+                   if coefficients[i] == coefficients[i + 1]):
+                slots.append((pattern, indices))
+    return tuple(slots)
+
+
+def calcRating(frequencies: list, *, max_order: int = DEFAULT_MAX_ORDER):
     n = len(frequencies)
     total = 0
     for row in range(n):
+        f1 = frequencies[row]
         for column in range(n):
             if row == column:
                 continue
+            f2 = frequencies[column]
             # 二次合成
-            thirdFrequency = frequencies[row] * 2 - frequencies[column]
-            if isValidFrequency(thirdFrequency):
-                nearest = findNearestFrequency(thirdFrequency, frequencies)
-                difference = abs(thirdFrequency - nearest)
+            product = f1 * 2 - f2
+            if isValidFrequency(product):
+                difference = abs(product - findNearestFrequency(product, frequencies))
                 if difference <= RATING_DIFF_LIMIT:
-                    value = RATING_DIFF_LIMIT - difference
-                    if debug:
-                        print(f"二次合成: f{row+1}*2 - f{column+1} = {getFrequencyWithChannel(frequencies[row], vtx_table)}*2 - {getFrequencyWithChannel(frequencies[column], vtx_table)} = {getFrequencyWithChannel(thirdFrequency, vtx_table)}")
-                        print(f"  対象周波数: {getFrequencyWithChannel(thirdFrequency, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                        print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                    total += value * value
-            
-            # 三次合成パターン
-            # 考えられる三次合成パターン:
-            # 1. f1 - f2 + f3 (現在実装済み)
-            # 2. f1 + f2 - f3
-            # 3. 2*f1 - f2 - f3
-            # 4. f1 + f2 + f3
-            # 5. -f1 + f2 + f3
-            # 6. 2*f1 + f2 - f3
-            # 7. 2*f1 - f2 + f3
-            # 8. f1 - 2*f2 + f3
-            # 9. f1 + 2*f2 - f3
-            # 10. -f1 + 2*f2 + f3
+                    total += (RATING_DIFF_LIMIT - difference) ** 2
             
+            # 三次合成パターン1〜10
             for k in range(n):
                 if k == row or k == column:
                     continue
-                
-                # パターン1: f1 - f2 + f3 (現在実装済み)
-                third_order = frequencies[row] - frequencies[column] + frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン1): f{row+1} - f{column+1} + f{k+1} = {getFrequencyWithChannel(frequencies[row], vtx_table)} - {getFrequencyWithChannel(frequencies[column], vtx_table)} + {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
-                
-                # パターン2: f1 + f2 - f3
-                third_order = frequencies[row] + frequencies[column] - frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン2): f{row+1} + f{column+1} - f{k+1} = {getFrequencyWithChannel(frequencies[row], vtx_table)} + {getFrequencyWithChannel(frequencies[column], vtx_table)} - {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
-                
-                # パターン3: 2*f1 - f2 - f3
-                third_order = 2 * frequencies[row] - frequencies[column] - frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン3): 2*f{row+1} - f{column+1} - f{k+1} = 2*{getFrequencyWithChannel(frequencies[row], vtx_table)} - {getFrequencyWithChannel(frequencies[column], vtx_table)} - {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
-                
-                # パターン4: f1 + f2 + f3
-                third_order = frequencies[row] + frequencies[column] + frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン4): f{row+1} + f{column+1} + f{k+1} = {getFrequencyWithChannel(frequencies[row], vtx_table)} + {getFrequencyWithChannel(frequencies[column], vtx_table)} + {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
-                
-                # パターン5: -f1 + f2 + f3
-                third_order = -frequencies[row] + frequencies[column] + frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン5): -f{row+1} + f{column+1} + f{k+1} = -{getFrequencyWithChannel(frequencies[row], vtx_table)} + {getFrequencyWithChannel(frequencies[column], vtx_table)} + {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
-                
-                # パターン6: 2*f1 + f2 - f3
-                third_order = 2 * frequencies[row] + frequencies[column] - frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン6): 2*f{row+1} + f{column+1} - f{k+1} = 2*{getFrequencyWithChannel(frequencies[row], vtx_table)} + {getFrequencyWithChannel(frequencies[column], vtx_table)} - {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
-                
-                # パターン7: 2*f1 - f2 + f3
-                third_order = 2 * frequencies[row] - frequencies[column] + frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン7): 2*f{row+1} - f{column+1} + f{k+1} = 2*{getFrequencyWithChannel(frequencies[row], vtx_table)} - {getFrequencyWithChannel(frequencies[column], vtx_table)} + {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
-                
-                # パターン8: f1 - 2*f2 + f3
-                third_order = frequencies[row] - 2 * frequencies[column] + frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン8): f{row+1} - 2*f{column+1} + f{k+1} = {getFrequencyWithChannel(frequencies[row], vtx_table)} - 2*{getFrequencyWithChannel(frequencies[column], vtx_table)} + {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
-                
-                # パターン9: f1 + 2*f2 - f3
-                third_order = frequencies[row] + 2 * frequencies[column] - frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン9): f{row+1} + 2*f{column+1} - f{k+1} = {getFrequencyWithChannel(frequencies[row], vtx_table)} + 2*{getFrequencyWithChannel(frequencies[column], vtx_table)} - {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
-                
-                # パターン10: -f1 + 2*f2 + f3
-                third_order = -frequencies[row] + 2 * frequencies[column] + frequencies[k]
-                if isValidFrequency(third_order):
-                    nearest = findNearestFrequency(third_order, frequencies)
-                    difference = abs(third_order - nearest)
-                    if difference <= RATING_DIFF_LIMIT:
-                        value = RATING_DIFF_LIMIT - difference
-                        if debug:
-                            print(f"三次合成(パターン10): -f{row+1} + 2*f{column+1} + f{k+1} = -{getFrequencyWithChannel(frequencies[row], vtx_table)} + 2*{getFrequencyWithChannel(frequencies[column], vtx_table)} + {getFrequencyWithChannel(frequencies[k], vtx_table)} = {getFrequencyWithChannel(third_order, vtx_table)}")
-                            print(f"  対象周波数: {getFrequencyWithChannel(third_order, vtx_table)}, 最近接周波数: {getFrequencyWithChannel(nearest, vtx_table)}, 差: {difference}")
-                            print(f"  評価値: {RATING_DIFF_LIMIT} - {difference} = {value}")
-                        total += value * value
+                f3 = frequencies[k]
+                for a, b, c in THIRD_ORDER_COEFFICIENTS:
+                    product = a * f1 + b * f2 + c * f3
+                    if isValidFrequency(product):
+                        difference = abs(product - findNearestFrequency(product, frequencies))
+                        if difference <= RATING_DIFF_LIMIT:
+                            total += (RATING_DIFF_LIMIT - difference) ** 2
+    
+    # 五次以上の合成パターン（max_order指定時）
+    if max_order > DEFAULT_MAX_ORDER:
+        patterns = imdPatterns(max_order)
+        for pattern, indices in higherOrderSlots(n, max_order):
+            product = sum(c * frequencies[i] for c, i in zip(patterns[pattern][1], indices))
+            if isValidFrequency(product):
+                difference = abs(product - findNearestFrequency(product, frequencies))
+                if difference <= RATING_DIFF_LIMIT:
+                    total += (RATING_DIFF_LIMIT - difference) ** 2
     return round(RATING_MAX_VALUE - total / 5 / n)
 
 
+def patternSlots(n: int, max_order: int = DEFAULT_MAX_ORDER):
+    """calcRatingの列挙順で (パターン番号, 周波数の番号) を返す"""
+    for row in range(n):
+        for column in range(n):
+            if row == column:
+                continue
+            yield 0, (row, column)
+            for k in range(n):
+                if k == row or k == column:
+                    continue
+                for pattern in range(1, len(IMD_PATTERNS)):
+                    yield pattern, (row, column, k)
+    yield from higherOrderSlots(n, max_order)
+
+
+def explain(frequencies: list, *, max_order: int = DEFAULT_MAX_ORDER):
+    """calcRatingと同じ順序で合成波を列挙し、表示範囲内のものをIMDTermとして1つずつ返す
+
+    contributionの合計はcalcRatingのtotalと一致する（差がRATING_DIFF_LIMITを超えるものはcontribution=0）。
+    """
+    patterns = imdPatterns(max_order)
+    for pattern, indices in patternSlots(len(frequencies), max_order):
+        product = sum(c * frequencies[i] for c, i in zip(patterns[pattern][1], indices))
+        if not isValidFrequency(product):
+            continue
+        nearest = findNearestFrequency(product, frequencies)
+        difference = abs(product - nearest)
+        contribution = (RATING_DIFF_LIMIT - difference) ** 2 if difference <= RATING_DIFF_LIMIT else 0
+        yield IMDTerm(pattern, indices, product, nearest, difference, contribution)
+
+
+def patternName(pattern: int, indices):
+    """合成パターンの名前と式（例: 三次合成(パターン1): f1 - f2 + f3）"""
+    name, _, expression = imdPatterns(MAX_ORDER_LIMIT)[pattern]
+    return f"{name}: " + expression.format(*(f"f{i+1}" for i in indices))
+
+
+def formatExplanation(frequencies: list, vtx_table: dict, max_order: int = DEFAULT_MAX_ORDER):
+    """explainの記録から、減点の対象になる合成波ごとの説明（--debugの出力）を1行ずつ返す"""
+    patterns = imdPatterns(max_order)
+    for term in explain(frequencies, max_order=max_order):
+        if term.difference > RATING_DIFF_LIMIT:
+            continue
+        values = patterns[term.pattern][2].format(
+            *(getFrequencyWithChannel(frequencies[i], vtx_table) for i in term.indices))
+        product = getFrequencyWithChannel(term.product, vtx_table)
+        yield f"{patternName(term.pattern, term.indices)} = {values} = {product}"
+        yield f"  対象周波数: {product}, 最近接周波数: {getFrequencyWithChannel(term.nearest, vtx_table)}, 差: {term.difference}"
+        yield f"  評価値: {RATING_DIFF_LIMIT} - {term.difference} = {RATING_DIFF_LIMIT - term.difference}"
+
+
 if __name__ == "__main__":
     import sys
     
     debug_mode = "--debug" in sys.argv
+    profile_mode = "--profile" in sys.argv
     
     # コマンドライン引数から周波数を取得
+    # （--metrics FILE で計測結果をJSONファイルに保存、--max-order N で次数Nまでの合成波を評価）
     frequencies = []
-    for arg in sys.argv[1:]:
-        if arg != "--debug":
+    metrics_file = None
+    max_order = DEFAULT_MAX_ORDER
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "--metrics":
+            metrics_file = next(args, None)
+            if metrics_file is None:
+                print("エラー: --metrics には保存先のファイル名を指定してください")
+                sys.exit(1)
+        elif arg == "--max-order":
+            try:
+                max_order = int(next(args, ""))
+                imdPatterns(max_order)
+            except ValueError:
+                print(f"エラー: --max-order には{DEFAULT_MAX_ORDER}〜{MAX_ORDER_LIMIT}の次数を指定してください")
+                sys.exit(1)
+        elif arg not in ("--debug", "--profile"):
             try:
                 freq = int(arg)
                 frequencies.append(freq)
@@ -239,6 +260,9 @@ if __name__ == "__main__":
         print("周波数が指定されていません。デフォルト値を使用します:")
         print(f"周波数: {frequencies}")
     
+    if metrics_file:
+        metrics.enable()
+    
     # VTXテーブルを読み込んで周波数にバンド名を付けて表示
     vtx_table = loadVtxTable()
     freq_with_band = []
@@ -246,6 +270,16 @@ if __name__ == "__main__":
         freq_with_band.append(getFrequencyWithChannel(freq, vtx_table))
     
     print(f"評価対象周波数: {freq_with_band}")
-    rating = calcRating(frequencies, debug=debug_mode)
+    if debug_mode:
+        for line in formatExplanation(frequencies, vtx_table, max_order):
+            print(line)
+    with metrics.profiled("profile" if profile_mode else None):
+        with metrics.stage('calcRating', combos=1):
+            rating = calcRating(frequencies, max_order=max_order)
     print(f"最終評価: {rating}")
-
+    
+    if metrics_file:
+        # 合成波の数は評価エンジンで同じ組み合わせを評価して数える（calcRatingの処理には計測を入れない）
+        from imd_engine import calcTotals
+        calcTotals([frequencies], max_order)
+        metrics.write_json(metrics_file)
@@ -0,0 +1,321 @@
+import argparse
+
+import numpy as np
+
+from imd import MAX_DISPLAY_FREQUENCY, MIN_DISPLAY_FREQUENCY, RATING_MAX_VALUE
+from imd_engine import NO_DIFFERENCE, canonicalTerms, revolvingDoorCombinations, termPenalties, totalsToRatings
+from channel_plan import get_channel_plan
+
+
+class DeltaScorer:
+    """周波数の組み合わせと合成波ごとの減点を保持し、1チャネルの変更による評価値の変化を求める
+
+    合成波ごとに値・各スロットの周波数との距離・最近接周波数との差・減点（重み込み）を保持する。
+    入れ替え・追加・削除では、変更するスロットを含む合成波だけを作り直し、それ以外の合成波は
+    最近接周波数との差が変わるもの（最近接がそのスロットだったもの、新しい周波数の方が近いもの）だけを
+    更新して、減点合計を差分で更新する。評価値はimd.calcRatingと完全に一致する。
+    """
+
+    def __init__(self, frequencies):
+        self._frequencies = np.asarray(frequencies, dtype=np.int32).copy()
+        k = len(self._frequencies)
+        if k >= 2:
+            self._coefficients, self._weights, _, _ = canonicalTerms(k)
+        else:
+            self._coefficients = np.zeros((0, k), dtype=np.int32)
+            self._weights = np.zeros(0, dtype=np.int64)
+        # 合成波[U]、各スロットの周波数との距離[U, k]、最近接周波数との差[U]、合成波ごとの減点（重み込み）[U]
+        self._products = self._coefficients @ self._frequencies
+        self._distances = np.abs(self._products[:, None] - self._frequencies[None, :])
+        self._nearest = self._distances.min(axis=1, initial=NO_DIFFERENCE)
+        self._penalties = self._weighted(self._products, self._nearest)
+        self.total = int(self._penalties.sum())
+        # スロットごとの (含む合成波の番号, 含まない合成波の番号, slotに掛かる係数, 重み)（_slotTermsで作成）
+        self._slot_terms = {}
+        # スロットごとの入れ替え前の状態（_keptTermsで作成、周波数の変更で破棄）
+        self._kept_terms = {}
+
+    def _weighted(self, products, differences, weights=None):
+        weights = self._weights if weights is None else weights
+        return termPenalties(products, differences) * weights
+
+    def _slotTerms(self, slot: int):
+        """slotを含む合成波の番号、含まない合成波の番号、slotに掛かる係数と重み（含む合成波のみ）"""
+        terms = self._slot_terms.get(slot)
+        if terms is None:
+            involved = self._coefficients[:, slot] != 0
+            terms = (np.flatnonzero(involved), np.flatnonzero(~involved), self._coefficients[involved, slot],
+                     self._weights[involved])
+            self._slot_terms[slot] = terms
+        return terms
+
+    def _withoutSlot(self, slot: int, uninvolved):
+        """slotを含まない合成波について、slotを除いた場合の最近接周波数との差を返す
+
+        最近接がslotだった合成波だけ残りのスロットとの距離から求め直す。
+        """
+        nearest = self._nearest[uninvolved]
+        lost = self._distances[uninvolved, slot] == nearest
+        if lost.any():
+            rows = uninvolved[lost]
+            distances = self._distances[rows]
+            distances[:, slot] = NO_DIFFERENCE
+            nearest[lost] = distances.min(axis=1)
+        return nearest
+
+    def _keptTerms(self, slot: int):
+        """slotを含まない合成波のうち表示範囲内のもの（範囲外は減点されない）の値・重みと、
+        slotを除いた場合の最近接周波数との差を返す
+
+        入れ替え候補を1件ずつ評価する場合（焼きなまし法など）に同じslotで作り直さないよう、
+        周波数を変更するまで保持する。
+        """
+        terms = self._kept_terms.get(slot)
+        if terms is None:
+            uninvolved = self._slotTerms(slot)[1]
+            products = self._products[uninvolved]
+            in_window = (products >= MIN_DISPLAY_FREQUENCY) & (products <= MAX_DISPLAY_FREQUENCY)
+            rows = uninvolved[in_window]
+            terms = (self._products[rows], self._weights[rows], self._withoutSlot(slot, rows))
+            self._kept_terms[slot] = terms
+        return terms
+
+    @property
+    def frequencies(self):
+        return self._frequencies.tolist()
+
+    @property
+    def rating(self):
+        return self._rating(self.total, len(self._frequencies))
+
+    @staticmethod
+    def _rating(total, n):
+        # calcRatingと同じ式
+        return round(RATING_MAX_VALUE - total / 5 / n)
+
+    def swapTotals(self, slot: int, candidates):
+        """slotの周波数をcandidatesの各周波数に入れ替えた場合の減点合計の配列を返す"""
+        candidates = np.asarray(candidates, dtype=np.int32)
+        involved, _, coefficient, weights = self._slotTerms(slot)
+
+        # slotを含まない合成波: 値は変わらず、最近接周波数との差だけが新しい周波数で更新される
+        products, kept_weights, kept = self._keptTerms(slot)
+        differences = np.minimum(kept[None, :], np.abs(products[None, :] - candidates[:, None]))
+        totals = self._weighted(products[None, :], differences, kept_weights).sum(axis=1)
+
+        # slotを含む合成波: 新しい周波数で作り直す
+        base = self._products[involved] - coefficient * self._frequencies[slot]
+        products = base[None, :] + coefficient[None, :] * candidates[:, None]
+        differences = np.abs(products - candidates[:, None])
+        for j, f in enumerate(self._frequencies.tolist()):
+            if j != slot:
+                np.minimum(differences, np.abs(products - f), out=differences)
+        totals += self._weighted(products, differences, weights).sum(axis=1)
+        return totals
+
+    def swapDelta(self, slot: int, frequency: int):
+        """slotの周波数をfrequencyに入れ替えた場合の評価値の変化量"""
+        total = int(self.swapTotals(slot, [frequency])[0])
+        return self._rating(total, len(self._frequencies)) - self.rating
+
+    def _addition(self, frequency: int):
+        """frequencyを追加した場合の (既存の合成波の最近接周波数との差, 追加するスロットを含む合成波の
+        係数[V, k+1]・重み[V]・値[V]・各スロットとの距離[V, k+1]) を返す"""
+        k = len(self._frequencies)
+        # 既存の合成波はそのまま残り、追加した周波数の方が近いものだけ差が小さくなる
+        nearest = np.minimum(self._nearest, np.abs(self._products - frequency))
+        if k + 1 < 2:
+            empty = np.zeros((0, k + 1), dtype=np.int32)
+            return nearest, empty, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), empty
+        # 追加したスロットを含む合成波だけを新しく作る
+        coefficients, weights, _, _ = canonicalTerms(k + 1)
+        involved = coefficients[:, k] != 0
+        coefficients, weights = coefficients[involved], weights[involved]
+        frequencies = np.append(self._frequencies, np.int32(frequency))
+        products = coefficients @ frequencies
+        distances = np.abs(products[:, None] - frequencies[None, :])
+        return nearest, coefficients, weights, products, distances
+
+    def addTotal(self, frequency: int):
+        """frequencyを追加した場合の減点合計"""
+        nearest, _, weights, products, distances = self._addition(frequency)
+        return (int(self._weighted(self._products, nearest).sum())
+                + int(self._weighted(products, distances.min(axis=1), weights).sum()))
+
+    def addDelta(self, frequency: int):
+        """frequencyを追加した場合の評価値の変化量"""
+        return self._rating(self.addTotal(frequency), len(self._frequencies) + 1) - self.rating
+
+    def removeTotal(self, slot: int):
+        """slotの周波数を外した場合の減点合計"""
+        uninvolved = self._slotTerms(slot)[1]
+        # slotを含む合成波は消え、残りは最近接がslotだったものだけ差を求め直す
+        nearest = self._withoutSlot(slot, uninvolved)
+        return int(self._weighted(self._products[uninvolved], nearest, self._weights[uninvolved]).sum())
+
+    def removeDelta(self, slot: int):
+        """slotの周波数を外した場合の評価値の変化量"""
+        return self._rating(self.removeTotal(slot), len(self._frequencies) - 1) - self.rating
+
+    def swap(self, slot: int, frequency: int):
+        """slotの周波数をfrequencyに入れ替える"""
+        involved, uninvolved, coefficient, weights = self._slotTerms(slot)
+        change = frequency - int(self._frequencies[slot])
+        self._frequencies[slot] = frequency
+
+        # slotを含む合成波: 値と全スロットとの距離を作り直す
+        products = self._products[involved] + coefficient * change
+        distances = np.abs(products[:, None] - self._frequencies[None, :])
+        nearest = distances.min(axis=1)
+        penalties = termPenalties(products, nearest) * weights
+        change = int(penalties.sum() - self._penalties[involved].sum())
+        self._products[involved] = products
+        self._distances[involved] = distances
+        self._nearest[involved] = nearest
+        self._penalties[involved] = penalties
+
+        # slotを含まない合成波: slotとの距離を更新し、最近接周波数との差が変わったもの
+        # （新しい周波数の方が近いもの、最近接がslotだったため残りのスロットとの距離から求め直すもの）だけを更新
+        previous = self._nearest[uninvolved]
+        lost = self._distances[uninvolved, slot] == previous
+        column = np.abs(self._products[uninvolved] - frequency)
+        self._distances[uninvolved, slot] = column
+        nearest = np.minimum(previous, column)
+        if lost.any():
+            nearest[lost] = self._distances[uninvolved[lost]].min(axis=1)
+        changed = nearest != previous
+        if changed.any():
+            rows = uninvolved[changed]
+            penalties = self._weighted(self._products[rows], nearest[changed], self._weights[rows])
+            change += int(penalties.sum() - self._penalties[rows].sum())
+            self._nearest[rows] = nearest[changed]
+            self._penalties[rows] = penalties
+        self.total += change
+        self._kept_terms = {}
+
+    def add(self, frequency: int):
+        """frequencyを追加する（addTotalと同じく、追加するスロットを含む合成波だけを作る）"""
+        nearest, coefficients, weights, products, distances = self._addition(frequency)
+        k = len(self._frequencies)
+        old_distances = np.hstack([self._distances, np.abs(self._products - frequency)[:, None]])
+        old_coefficients = np.hstack([self._coefficients, np.zeros((len(self._products), 1), dtype=np.int32)])
+        self._frequencies = np.append(self._frequencies, np.int32(frequency))
+        new_nearest = distances.min(axis=1, initial=NO_DIFFERENCE)
+        new_penalties = self._weighted(products, new_nearest, weights)
+        old_penalties = self._weighted(self._products, nearest)
+        self._coefficients = np.concatenate([old_coefficients, coefficients.astype(np.int32)]).reshape(-1, k + 1)
+        self._weights = np.concatenate([self._weights, weights])
+        self._products = np.concatenate([self._products, products]).astype(np.int32)
+        self._distances = np.concatenate([old_distances, distances]).reshape(-1, k + 1)
+        self._nearest = np.concatenate([nearest, new_nearest])
+        self._penalties = np.concatenate([old_penalties, new_penalties])
+        self.total = int(self._penalties.sum())
+        self._slot_terms = {}
+        self._kept_terms = {}
+
+    def remove(self, slot: int):
+        """slotの周波数を外す（removeTotalと同じく、残る合成波は最近接がslotだったものだけ差を求め直す）"""
+        uninvolved = self._slotTerms(slot)[1]
+        nearest = self._withoutSlot(slot, uninvolved)
+        changed = nearest != self._nearest[uninvolved]
+        penalties = self._penalties[uninvolved]
+        penalties[changed] = self._weighted(self._products[uninvolved[changed]], nearest[changed],
+                                            self._weights[uninvolved[changed]])
+        self._frequencies = np.delete(self._frequencies, slot)
+        self._coefficients = np.delete(self._coefficients[uninvolved], slot, axis=1)
+        self._weights = self._weights[uninvolved]
+        self._products = self._products[uninvolved]
+        self._distances = np.delete(self._distances[uninvolved], slot, axis=1)
+        self._nearest = nearest
+        self._penalties = penalties
+        self.total = int(penalties.sum())
+        self._slot_terms = {}
+        self._kept_terms = {}
+
+    def bestSwaps(self, slot: int, pool):
+        """slotの入れ替え候補としてpoolの各周波数を評価し、(周波数, 評価値, 変化量) を良い順に返す
+
+        他のスロットで使用中の周波数は候補から除く。
+        """
+        in_use = set(np.delete(self._frequencies, slot).tolist())
+        candidates = np.array(sorted(set(pool) - in_use), dtype=np.int32)
+        if len(candidates) == 0:
+            return []
+        ratings = totalsToRatings(self.swapTotals(slot, candidates), len(self._frequencies))
+        order = np.lexsort((candidates, -ratings))
+        current = self.rating
+        return [(int(candidates[i]), int(ratings[i]), int(ratings[i]) - current) for i in order]
+
+
+def grayCodeRanking(pool, k: int):
+    """回転ドア順に全組み合わせを列挙し、1チャネルの入れ替えごとに差分で評価して順位リストを作成
+
+    回転ドア順では同じスロットの入れ替えが続くことが多い（他のスロットは変わらない）ため、
+    同じスロットが続く区間の組み合わせはswapTotalsでまとめて評価し、区間の最後の周波数だけをswapで反映する。
+
+    戻り値はcreate_secondary_rankingと同じ並び（評価値の降順、同じ評価値なら組み合わせの辞書順）の
+    [(周波数のリスト, 評価値), ...] 。
+    """
+    pool = sorted(set(pool))
+    results = []
+    scorer = None
+    slot_of = {}  # プールの添字 -> DeltaScorerのスロット
+    run_slot = None
+    run = []  # 同じスロットの入れ替えが続く区間の (組み合わせ, 加えた周波数)
+
+    def flush():
+        if not run:
+            return
+        added = [frequency for _, frequency in run]
+        ratings = totalsToRatings(scorer.swapTotals(run_slot, added), k).tolist()
+        results.extend(([pool[i] for i in combo], rating) for (combo, _), rating in zip(run, ratings))
+        scorer.swap(run_slot, added[-1])
+        run.clear()
+
+    for combo, removed, added in revolvingDoorCombinations(len(pool), k):
+        if scorer is None:
+            scorer = DeltaScorer([pool[i] for i in combo])
+            slot_of = {index: slot for slot, index in enumerate(combo)}
+            results.append(([pool[i] for i in combo], scorer.rating))
+            continue
+        slot = slot_of.pop(removed)
+        slot_of[added] = slot
+        if slot != run_slot:
+            flush()
+            run_slot = slot
+        run.append((combo, pool[added]))
+    flush()
+    results.sort(key=lambda x: (-x[1], x[0]))
+    return results
+
+
+def main(argv=None):
+    # コマンドライン引数のパース
+    parser = argparse.ArgumentParser(description="1チャネルの入れ替え候補を評価値順に表示")
+    parser.add_argument('frequencies', type=int, nargs='+', help='現在の周波数の組み合わせ')
+    parser.add_argument('--replace', type=int, required=True, help='入れ替えたい周波数（組み合わせに含まれるもの）')
+    parser.add_argument('--top', type=int, default=10, help='表示する候補数（デフォルト: 10）')
+    parser.add_argument('--freq-file', default='freq.txt', help='候補周波数ファイル（デフォルト: freq.txt）')
+    args = parser.parse_args(argv)
+
+    if args.replace not in args.frequencies:
+        parser.error(f"{args.replace} は組み合わせに含まれていません")
+
+    plan = get_channel_plan()
+    scorer = DeltaScorer(args.frequencies)
+    slot = args.frequencies.index(args.replace)
+    print(f"現在の組み合わせ: {[plan.label_with_led(f) for f in scorer.frequencies]} -> 評価値: {scorer.rating}")
+    print(f"{plan.label_with_led(args.replace)} の入れ替え候補:")
+    print("-" * 80)
+
+    # create_secondary_rankingはこのモジュール（grayCodeRanking）を読み込むため、ここで読み込む
+    from create_secondary_ranking import read_frequencies_from_file
+    pool = read_frequencies_from_file(args.freq_file)
+    candidates = scorer.bestSwaps(slot, pool)
+    for i, (frequency, rating, delta) in enumerate(candidates[:args.top], 1):
+        print(f"{i:3d}. {plan.label_with_led(frequency)} -> 評価値: {rating} ({delta:+d})")
+    return candidates
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+import functools
+
+import numpy as np
+
+import metrics
+from imd import (MIN_DISPLAY_FREQUENCY, MAX_DISPLAY_FREQUENCY, RATING_MAX_VALUE, RATING_DIFF_LIMIT,
+                 DEFAULT_MAX_ORDER, THIRD_ORDER_COEFFICIENTS, higherOrderSlots, imdPatterns, patternName)
+
+# 三次合成パターン（imd.calcRatingのパターン1〜10と同じ順序）
+# 各要素は (f1, f2, f3) に掛かる係数
+THIRD_ORDER_PATTERNS = THIRD_ORDER_COEFFICIENTS
+
+# 評価方法のバージョン（評価値や合成波の扱いが変わる変更をした場合は更新し、保存済みの結果を無効にする）
+ENGINE_VERSION = 1
+
+# 表示範囲内の合成波が一つもない組み合わせの最小差
+NO_DIFFERENCE = np.iinfo(np.int32).max
+
+# 一度に評価する組み合わせ数（中間配列のメモリ量を抑えるため）
+CHUNK_SIZE = 8192
+
+# 合成波テーブルファイルの形式バージョン（形式を変えた場合は更新して古いファイルを再作成させる）
+PRODUCT_TABLES_VERSION = 1
+
+
+def buildCoefficients(n: int, max_order: int = DEFAULT_MAX_ORDER):
+    """n周波数の組み合わせで発生する全合成波の係数行列を作成（calcRatingと同じ列挙順、max_order: 合成波の次数の上限）"""
+    rows = []
+    for row in range(n):
+        for column in range(n):
+            if row == column:
+                continue
+            # 二次合成: 2*f1 - f2
+            vector = [0] * n
+            vector[row] += 2
+            vector[column] -= 1
+            rows.append(vector)
+
+            # 三次合成パターン
+            for k in range(n):
+                if k == row or k == column:
+                    continue
+                for a, b, c in THIRD_ORDER_PATTERNS:
+                    vector = [0] * n
+                    vector[row] += a
+                    vector[column] += b
+                    vector[k] += c
+                    rows.append(vector)
+    
+    # 五次以上の合成パターン（係数の表から作る）
+    patterns = imdPatterns(max_order)
+    for pattern, indices in higherOrderSlots(n, max_order):
+        vector = [0] * n
+        for c, i in zip(patterns[pattern][1], indices):
+            vector[i] += c
+        rows.append(vector)
+    return np.array(rows, dtype=np.int32).reshape(-1, n)
+
+
+def buildTermLabels(n: int, max_order: int = DEFAULT_MAX_ORDER):
+    """buildCoefficientsの各行に対応する合成パターン名（例: 三次合成(パターン1): f1 - f2 + f3）を作成"""
+    labels = []
+    for row in range(n):
+        for column in range(n):
+            if row == column:
+                continue
+            labels.append(patternName(0, (row, column)))
+            for k in range(n):
+                if k == row or k == column:
+                    continue
+                for pattern in range(1, len(THIRD_ORDER_PATTERNS) + 1):
+                    labels.append(patternName(pattern, (row, column, k)))
+    labels.extend(patternName(pattern, indices) for pattern, indices in higherOrderSlots(n, max_order))
+    return labels
+
+
+def buildTableTerms(n: int):
+    """buildCoefficientsの各行を、合成波テーブルを引くための (パターン番号, スロット番号) で表す
+
+    パターン番号 -1 は二次合成（スロットは先頭2つを使用）、0〜9 は三次合成パターン1〜10。
+    """
+    patterns = []
+    slots = []
+    for row in range(n):
+        for column in range(n):
+            if row == column:
+                continue
+            patterns.append(-1)
+            slots.append((row, column, 0))
+            for k in range(n):
+                if k == row or k == column:
+                    continue
+                for pattern in range(len(THIRD_ORDER_PATTERNS)):
+                    patterns.append(pattern)
+                    slots.append((row, column, k))
+    return np.array(patterns, dtype=np.intp), np.array(slots, dtype=np.intp).reshape(-1, 3)
+
+
+@functools.lru_cache(maxsize=None)
+def canonicalTerms(n: int, max_order: int = DEFAULT_MAX_ORDER):
+    """同じ合成波になる係数ベクトルを一つにまとめ、重み（重複数）付きの合成波一覧を作成
+
+    例えば f1 + f2 - f3 は (row, column) を入れ替えても同じ合成波になり、パターン8〜10は
+    同じ三つ組に対するパターン7〜5の並べ替えになる。各合成波を一度だけ評価して重みを掛ければ、
+    calcRatingのtotalと完全に一致する。
+
+    戻り値は (係数行列[U, n], 重み[U], 各合成波の代表となるbuildCoefficientsの行番号[U],
+    buildCoefficientsの各行に対応する合成波番号[T]) 。
+    """
+    coefficients, first_index, inverse, weights = np.unique(
+        buildCoefficients(n, max_order), axis=0, return_index=True, return_inverse=True, return_counts=True)
+    terms = (coefficients, weights.astype(np.int64), first_index, inverse.reshape(-1))
+    for array in terms:
+        array.flags.writeable = False
+    return terms
+
+
+def combinationIndexArray(n: int, k: int):
+    """itertools.combinations(range(n), k)と同じ順序の組み合わせを添字配列[M, k]として返す"""
+    tails = {}
+
+    def tail(m, j):
+        # 末尾m個の添字 (n-m 〜 n-1) からj個を選ぶ組み合わせ（辞書順）
+        if j == 0:
+            return np.zeros((1, 0), dtype=np.intp)
+        if (m, j) not in tails:
+            blocks = []
+            for t in range(m - j + 1):
+                rest = tail(m - t - 1, j - 1)
+                block = np.empty((len(rest), j), dtype=np.intp)
+                block[:, 0] = n - m + t
+                block[:, 1:] = rest
+                blocks.append(block)
+            tails[(m, j)] = np.concatenate(blocks) if blocks else np.zeros((0, j), dtype=np.intp)
+        return tails[(m, j)]
+
+    return tail(n, k)
+
+
+def revolvingDoorCombinations(n: int, k: int):
+    """range(n)からk個を選ぶ全組み合わせを、隣り合う組み合わせが1要素の入れ替えだけで異なる順序で列挙する
+
+    Knuthの回転ドア（revolving door）アルゴリズム。(組み合わせ（昇順のタプル）, 外した添字, 加えた添字) を返す
+    （最初の組み合わせでは外した添字・加えた添字はNone）。
+    """
+    if k < 0 or k > n:
+        return
+    if k == 0 or k == n:
+        yield tuple(range(k)), None, None
+        return
+    # c[1..k] は昇順の添字、c[k+1] = n は番兵（c[0]は未使用）
+    c = [0] + list(range(k)) + [n]
+    removed = added = None
+    while True:
+        yield tuple(c[1:k + 1]), removed, added
+        if k % 2 == 1:
+            if c[1] + 1 < c[2]:
+                removed = c[1]
+                c[1] += 1
+                added = c[1]
+                continue
+            j = 2
+            increase = False
+        else:
+            if c[1] > 0:
+                removed = c[1]
+                c[1] -= 1
+                added = c[1]
+                continue
+            j = 2
+            increase = True
+        while True:
+            if j > k:
+                return  # 全ての組み合わせを列挙した
+            if not increase:
+                # c[j]を減らせるか（このとき c[j] = c[j-1] + 1）
+                if c[j] >= j:
+                    removed, added = c[j], j - 2
+                    c[j] = c[j - 1]
+                    c[j - 1] = j - 2
+                    break
+                j += 1
+                increase = True
+                continue
+            # c[j]を増やせるか（このとき c[j-1] = j - 2）
+            if c[j] + 1 < c[j + 1]:
+                removed, added = j - 2, c[j] + 1
+                c[j - 1] = c[j]
+                c[j] += 1
+                break
+            j += 1
+            increase = False
+
+
+def combinationArray(frequencies: list, k: int):
+    """itertools.combinationsと同じ順序でk周波数の組み合わせを配列[M, k]として返す"""
+    return np.asarray(frequencies, dtype=np.int32)[combinationIndexArray(len(frequencies), k)]
+
+
+def _productTotals(products, block, weights):
+    """合成波[b, U]と組み合わせブロック[b, n]から組み合わせごとの減点合計（calcRatingのtotal）を計算"""
+    # 最近接周波数との差（n列を順に比較して最小値を取る）
+    differences = np.abs(products - block[:, :1])
+    for column in range(1, block.shape[1]):
+        np.minimum(differences, np.abs(products - block[:, column:column + 1]), out=differences)
+    if metrics.enabled():
+        _countProducts(products, differences, weights)
+    return termPenalties(products, differences) @ weights
+
+
+def _countProducts(products, differences, weights, threshold=None):
+    """計測が有効な場合に、合成波の数（calcRatingの列挙順で重複を含む）を段階ごとに数える
+
+    products_generated: 生成した合成波、products_in_window: 表示範囲内、
+    products_within_limit: 表示範囲内で最近接周波数との差がRATING_DIFF_LIMIT以下（減点の対象）、
+    products_below_threshold: 表示範囲内で差がthreshold未満（thresholdを指定した場合のみ）
+    """
+    in_window = (products >= MIN_DISPLAY_FREQUENCY) & (products <= MAX_DISPLAY_FREQUENCY)
+    metrics.count('combos_evaluated', len(products))
+    metrics.count('products_generated', len(products) * weights.sum())
+    metrics.count('products_in_window', in_window.sum(axis=0) @ weights)
+    metrics.count('products_within_limit', (in_window & (differences <= RATING_DIFF_LIMIT)).sum(axis=0) @ weights)
+    if threshold is not None:
+        metrics.count('products_below_threshold', (in_window & (differences < threshold)).sum(axis=0) @ weights)
+
+
+def termPenalties(products, differences):
+    """合成波ごとの減点（表示範囲内かつ差がRATING_DIFF_LIMIT以下なら (RATING_DIFF_LIMIT - 差)^2、それ以外は0）"""
+    valid = ((products >= MIN_DISPLAY_FREQUENCY) & (products <= MAX_DISPLAY_FREQUENCY)
+             & (differences <= RATING_DIFF_LIMIT))
+    values = np.where(valid, RATING_DIFF_LIMIT - differences, 0).astype(np.int64)
+    return values * values
+
+
+def _ratingTotals(block, coefficients, weights):
+    """組み合わせブロック[b, n]ごとの減点合計（calcRatingのtotal）を計算"""
+    return _productTotals(block @ coefficients.T, block, weights)
+
+
+def _totalsToRatings(totals, n):
+    """減点合計からcalcRatingと同じ浮動小数点演算順序・丸め（偶数丸め）で評価値を求める"""
+    return np.round(RATING_MAX_VALUE - totals / 5 / n).astype(np.int64)
+
+
+def calcTotals(combos, max_order: int = DEFAULT_MAX_ORDER):
+    """組み合わせ配列[M, k]の減点合計（calcRatingのtotal）の配列[M]を返す（max_order: 合成波の次数の上限）
+
+    組み合わせに周波数を追加しても既存の合成波はそのまま残り、最近接周波数との差は
+    小さくなる一方なので、totalは周波数の追加に対して単調非減少になる。
+    """
+    combos = np.asarray(combos, dtype=np.int32)
+    if combos.ndim != 2:
+        raise ValueError(f"組み合わせ配列は2次元である必要があります: shape={combos.shape}")
+    m, n = combos.shape
+    totals = np.zeros(m, dtype=np.int64)
+    if n < 2:
+        return totals
+    coefficients, weights, _, _ = canonicalTerms(n, max_order)
+    for start in range(0, m, CHUNK_SIZE):
+        block = combos[start:start + CHUNK_SIZE]
+        totals[start:start + len(block)] = _ratingTotals(block, coefficients, weights)
+    return totals
+
+
+def totalsToRatings(totals, n: int):
+    """減点合計の配列からn周波数の組み合わせとしての評価値の配列を求める"""
+    return _totalsToRatings(np.asarray(totals, dtype=np.int64), n)
+
+
+def calcRatings(combos, max_order: int = DEFAULT_MAX_ORDER):
+    """組み合わせ配列[M, k]の全組み合わせをまとめて評価し、calcRatingと同じ評価値の配列[M]を返す"""
+    combos = np.asarray(combos, dtype=np.int32)
+    if combos.ndim != 2:
+        raise ValueError(f"組み合わせ配列は2次元である必要があります: shape={combos.shape}")
+    return _totalsToRatings(calcTotals(combos, max_order), combos.shape[1])
+
+
+def evaluateCombos(combos, threshold=None, max_order: int = DEFAULT_MAX_ORDER):
+    """合成波を一度だけ列挙して、評価値・最小IMD差・閾値未満のIMD差一覧をまとめて求める
+
+    戻り値は (評価値の配列[M], 表示範囲内の合成波と最近接周波数の最小差の配列[M], 違反リスト) 。
+    違反リストは組み合わせごとの [(合成周波数, 最近接周波数, 差, パターン名), ...] で、
+    thresholdを指定しない場合はNone。
+    """
+    combos = np.asarray(combos, dtype=np.int32)
+    if combos.ndim != 2:
+        raise ValueError(f"組み合わせ配列は2次元である必要があります: shape={combos.shape}")
+    m, n = combos.shape
+    if n < 2:
+        # 合成波がないため最高の評価値で、違反もない（calcTotalsと同じ扱い）
+        return (_totalsToRatings(np.zeros(m, dtype=np.int64), n), np.full(m, NO_DIFFERENCE, dtype=np.int32),
+                [[] for _ in range(m)] if threshold is not None else None)
+    coefficients, weights, _, inverse = canonicalTerms(n, max_order)
+    labels = buildTermLabels(n, max_order) if threshold is not None else None
+    totals = np.empty(m, dtype=np.int64)
+    min_differences = np.empty(m, dtype=np.int32)
+    violations = [] if threshold is not None else None
+    for start in range(0, m, CHUNK_SIZE):
+        block = combos[start:start + CHUNK_SIZE]
+        products = block @ coefficients.T
+        distances = np.abs(products[:, :, None] - block[:, None, :])
+        differences = distances.min(axis=2)
+        in_window = (products >= MIN_DISPLAY_FREQUENCY) & (products <= MAX_DISPLAY_FREQUENCY)
+        values = np.where(in_window & (differences <= RATING_DIFF_LIMIT),
+                          RATING_DIFF_LIMIT - differences, 0).astype(np.int64)
+        totals[start:start + len(block)] = (values * values) @ weights
+        min_differences[start:start + len(block)] = np.where(in_window, differences, NO_DIFFERENCE).min(axis=1)
+        if metrics.enabled():
+            _countProducts(products, differences, weights, threshold)
+
+        if threshold is not None:
+            block_violations = [[] for _ in range(len(block))]
+            # 違反一覧は元の列挙順（重複を含む）に展開する
+            violating = (in_window & (differences < threshold))[:, inverse]
+            combo_index, term_index = np.nonzero(violating)
+            unique_index = inverse[term_index]
+            # 最近接周波数は差が同じ場合に先頭側を採用（findNearestFrequencyと同じ）
+            nearest_slot = distances[combo_index, unique_index].argmin(axis=1)
+            nearest = block[combo_index, nearest_slot]
+            for c, t, near, diff, product in zip(combo_index.tolist(), term_index.tolist(), nearest.tolist(),
+                                                 differences[combo_index, unique_index].tolist(),
+                                                 products[combo_index, unique_index].tolist()):
+                block_violations[c].append((product, near, diff, labels[t]))
+            violations.extend(block_violations)
+    return _totalsToRatings(totals, n), min_differences, violations
+
+
+def differenceCounts(combos, max_order: int = DEFAULT_MAX_ORDER):
+    """組み合わせごとに、表示範囲内の合成波（calcRatingの列挙順で重複を含む）を最近接周波数との差ごとに数える
+
+    戻り値は配列[M, RATING_DIFF_LIMIT + 1]で、列dは差がdの合成波の数。閾値t（RATING_DIFF_LIMIT + 1以下）に
+    対するevaluateCombosの違反数は先頭t列の合計と一致する。
+    """
+    combos = np.asarray(combos, dtype=np.int32)
+    if combos.ndim != 2:
+        raise ValueError(f"組み合わせ配列は2次元である必要があります: shape={combos.shape}")
+    m, n = combos.shape
+    width = RATING_DIFF_LIMIT + 1
+    counts = np.zeros((m, width), dtype=np.int64)
+    if n < 2:
+        return counts
+    coefficients, weights, _, _ = canonicalTerms(n, max_order)
+    for start in range(0, m, CHUNK_SIZE):
+        block = combos[start:start + CHUNK_SIZE]
+        products = block @ coefficients.T
+        differences = np.abs(products - block[:, :1])
+        for column in range(1, n):
+            np.minimum(differences, np.abs(products - block[:, column:column + 1]), out=differences)
+        counted = ((products >= MIN_DISPLAY_FREQUENCY) & (products <= MAX_DISPLAY_FREQUENCY)
+                   & (differences <= RATING_DIFF_LIMIT))
+        rows = np.broadcast_to(np.arange(len(block))[:, None], products.shape)
+        bins = (rows * width + differences)[counted]
+        term_weights = np.broadcast_to(weights[None, :], products.shape)[counted]
+        counts[start:start + len(block)] = np.bincount(
+            bins, weights=term_weights, minlength=len(block) * width).reshape(len(block), width)
+    return counts
+
+
+class ProductTables:
+    """周波数プール全体の合成波を添字の組ごとに事前計算したテーブル
+
+    second[i, j]       = 2*f[i] - f[j]
+    third[p, i, j, l]  = 三次合成パターンp（THIRD_ORDER_PATTERNS）を f[i], f[j], f[l] に適用した値
+
+    テーブルからの添字参照は組み合わせごとに係数の表から合成波を求めるより遅いため、通常の評価には使わない
+    （benchmark.pyで比較用に計測する）。
+    """
+
+    def __init__(self, pool, second, third):
+        self.pool = pool
+        self.second = second
+        self.third = third
+        # テーブルは作成後に変更しない（並列評価のスレッドからコピーせずに参照する）
+        for array in (pool, second, third):
+            array.flags.writeable = False
+
+    @classmethod
+    def build(cls, pool):
+        """周波数プールから合成波テーブルを作成"""
+        f = np.asarray(pool, dtype=np.int32)
+        second = 2 * f[:, None] - f[None, :]
+        f1, f2, f3 = f[:, None, None], f[None, :, None], f[None, None, :]
+        third = np.stack([a * f1 + b * f2 + c * f3 for a, b, c in THIRD_ORDER_PATTERNS])
+        return cls(f, second, third)
+
+    def save(self, filename):
+        """合成波テーブルを.npzファイルに保存"""
+        with open(filename, 'wb') as f:
+            np.savez(f, version=PRODUCT_TABLES_VERSION, pool=self.pool,
+                     second=self.second, third=self.third)
+
+    @classmethod
+    def load(cls, filename):
+        """.npzファイルから合成波テーブルを読み込む（形式が異なる場合はNone）"""
+        with np.load(filename) as data:
+            if int(data['version']) != PRODUCT_TABLES_VERSION:
+                return None
+            return cls(data['pool'], data['second'], data['third'])
+
+    def calcRatings(self, index_combos):
+        """プール添字の組み合わせ配列[M, k]をテーブル参照で評価し、calcRatingと同じ評価値の配列[M]を返す"""
+        index_combos = np.asarray(index_combos, dtype=np.intp)
+        if index_combos.ndim != 2:
+            raise ValueError(f"組み合わせ配列は2次元である必要があります: shape={index_combos.shape}")
+        m, n = index_combos.shape
+        # 重複しない合成波ごとに代表の (パターン, スロット) を一つだけ引く
+        _, weights, first_index, _ = canonicalTerms(n)
+        patterns, slots = buildTableTerms(n)
+        patterns, slots = patterns[first_index], slots[first_index]
+        is_second = patterns < 0
+        pair_slots, weights_second = slots[is_second], weights[is_second]
+        triple_patterns, triple_slots, weights_third = patterns[~is_second], slots[~is_second], weights[~is_second]
+        weights = np.concatenate([weights_second, weights_third])
+        totals = np.empty(m, dtype=np.int64)
+        for start in range(0, m, CHUNK_SIZE):
+            indices = index_combos[start:start + CHUNK_SIZE]
+            second = self.second[indices[:, pair_slots[:, 0]], indices[:, pair_slots[:, 1]]]
+            third = self.third[triple_patterns, indices[:, triple_slots[:, 0]],
+                               indices[:, triple_slots[:, 1]], indices[:, triple_slots[:, 2]]]
+            products = np.concatenate([second, third], axis=1)
+            totals[start:start + len(indices)] = _productTotals(products, self.pool[indices], weights)
+        return _totalsToRatings(totals, n)
@@ -0,0 +1,162 @@
+import bisect
+import itertools
+
+import numpy as np
+
+# 一度に配列にまとめる組み合わせ数の目安（imd_stream.STREAM_CHUNK_SIZEと同じ）
+ENUMERATE_CHUNK_SIZE = 65536
+
+
+class CombinationConstraints:
+    """組み合わせの列挙で使う制約の集合（評価の前に枝刈りする）
+
+    min_separation: どの2つの周波数の間隔もこの値以上（MHz）
+    window: (下限, 上限) の周波数の範囲（両端を含む）
+    bands: 使ってよいバンド名の集合（band_namesは周波数 -> バンド名の集合を返す関数）
+    groups: 周波数 -> グループ（LED番号など）を返す関数。指定すると全ての周波数のグループが異なる組み合わせだけを
+            生成し、グループがNoneの周波数は使わない（group_nameは表示用の名前）
+    """
+
+    def __init__(self, min_separation=0, window=None, bands=None, band_names=None, groups=None, group_name='group'):
+        if bands is not None and band_names is None:
+            raise ValueError("bandsを指定する場合はband_namesも指定してください")
+        self.min_separation = min_separation
+        self.window = window
+        self.bands = None if bands is None else frozenset(bands)
+        self.band_names = band_names
+        self.groups = groups
+        self.group_name = group_name
+
+    def allows(self, frequency):
+        """周波数が範囲・バンド・グループの制約を満たすか（組み合わせに使えるか）"""
+        if self.window is not None and not self.window[0] <= frequency <= self.window[1]:
+            return False
+        if self.bands is not None and not self.bands.intersection(self.band_names(frequency)):
+            return False
+        if self.groups is not None and self.groups(frequency) is None:
+            return False
+        return True
+
+    def accepts(self, frequencies):
+        """列挙済みの組み合わせ（周波数のリスト）が全ての制約を満たすか"""
+        frequencies = sorted(frequencies)
+        if not all(self.allows(freq) for freq in frequencies):
+            return False
+        if any(b - a < self.min_separation for a, b in zip(frequencies, frequencies[1:])):
+            return False
+        if self.groups is not None:
+            groups = [self.groups(freq) for freq in frequencies]
+            if len(set(groups)) != len(groups):
+                return False
+        return True
+
+    def describe(self):
+        """制約の内容を表す文字列（表示と段階の指紋に使う）"""
+        parts = []
+        if self.min_separation > 0:
+            parts.append(f"間隔{self.min_separation}MHz以上")
+        if self.window is not None:
+            parts.append(f"範囲{self.window[0]}-{self.window[1]}MHz")
+        if self.bands is not None:
+            parts.append(f"バンド{','.join(sorted(self.bands))}")
+        if self.groups is not None:
+            parts.append(f"{self.group_name}が全て異なる")
+        return ", ".join(parts) if parts else "なし"
+
+
+def constrainedIndexCombinations(frequencies: list, k: int, constraints: CombinationConstraints):
+    """昇順の周波数リストから、constraintsを満たすk個の組み合わせを添字のタプルで辞書順に返す
+
+    範囲・バンドの制約は列挙の前に候補の周波数を絞り込み、間隔とグループの制約は1つ選ぶごとに確かめて、
+    満たさない枝には入らない。処理時間は条件を満たす組み合わせの数にほぼ比例する。
+    """
+    candidates = [i for i, freq in enumerate(frequencies) if constraints.allows(freq)]
+    values = [frequencies[i] for i in candidates]
+    m = len(values)
+    # 全ての周波数が候補なら位置がそのまま添字になる
+    identity = m == len(frequencies)
+    if k < 0 or k > m:
+        return
+    if k == 0:
+        yield ()
+        return
+    # next_index[j]: values[j]の次に選べる最小の位置
+    next_index = [bisect.bisect_left(values, values[j] + constraints.min_separation, j + 1) for j in range(m)]
+    # reach[j]: 位置j以降から選べる組み合わせの最大の長さ（jについて単調非増加）
+    reach = [0] * (m + 1)
+    for j in range(m - 1, -1, -1):
+        reach[j] = max(1 + reach[next_index[j]], reach[j + 1])
+    groups = None
+    if constraints.groups is not None:
+        groups = [constraints.groups(freq) for freq in values]
+        # グループが全て異なる必要があるので、位置j以降のグループの種類数も長さの上限になる
+        seen = set()
+        for j in range(m - 1, -1, -1):
+            seen.add(groups[j])
+            reach[j] = min(reach[j], len(seen))
+        used = set()
+
+    stack = [0]
+    while stack:
+        j = stack[-1]
+        if j >= m or reach[j] < k - len(stack) + 1:
+            # この位置に選べる周波数が残っていないので一つ前の位置を進める
+            stack.pop()
+            if stack:
+                if groups is not None:
+                    used.discard(groups[stack[-1]])
+                stack[-1] += 1
+            continue
+        if groups is not None and groups[j] in used:
+            stack[-1] += 1
+            continue
+        if len(stack) == k:
+            yield tuple(stack) if identity else tuple(map(candidates.__getitem__, stack))
+            stack[-1] += 1
+            continue
+        if groups is not None:
+            used.add(groups[j])
+        stack.append(next_index[j])
+
+
+def separatedIndexCombinations(frequencies: list, k: int, min_separation: int = 0):
+    """昇順の周波数リストから、どの2つの間隔もmin_separation以上になるk個の組み合わせを添字のタプルで辞書順に返す
+
+    次に選べる周波数はbisectで直接求め、残りの周波数で組み合わせを完成できない枝には入らないため、
+    処理時間は条件を満たす組み合わせの数に比例する（全組み合わせを生成して捨てることはしない）。
+    """
+    return constrainedIndexCombinations(frequencies, k, CombinationConstraints(min_separation=min_separation))
+
+
+def separatedCombinations(frequencies: list, k: int, min_separation: int = 0):
+    """separatedIndexCombinationsと同じ順序で、周波数のタプルを返す（frequenciesは昇順）"""
+    for indices in separatedIndexCombinations(frequencies, k, min_separation):
+        yield tuple(frequencies[i] for i in indices)
+
+
+def indexChunks(combinations, k: int, chunk_size: int = ENUMERATE_CHUNK_SIZE):
+    """添字のタプルの列を添字配列[b, k]のブロックに分けて順に返す"""
+    while True:
+        block = list(itertools.islice(combinations, chunk_size))
+        if not block:
+            return
+        yield np.array(block, dtype=np.intp).reshape(len(block), k)
+
+
+def separatedIndexChunks(frequencies: list, k: int, min_separation: int = 0, chunk_size: int = ENUMERATE_CHUNK_SIZE):
+    """separatedIndexCombinationsの組み合わせを添字配列[b, k]のブロックに分けて順に返す"""
+    return indexChunks(separatedIndexCombinations(frequencies, k, min_separation), k, chunk_size)
+
+
+def constrainedIndexChunks(frequencies: list, k: int, constraints: CombinationConstraints,
+                           chunk_size: int = ENUMERATE_CHUNK_SIZE):
+    """constrainedIndexCombinationsの組み合わせを添字配列[b, k]のブロックに分けて順に返す"""
+    return indexChunks(constrainedIndexCombinations(frequencies, k, constraints), k, chunk_size)
+
+
+def constrainedIndexArray(frequencies: list, k: int, constraints: CombinationConstraints):
+    """constraintsを満たす全ての組み合わせを辞書順の添字配列[N, k]で返す"""
+    blocks = list(constrainedIndexChunks(frequencies, k, constraints))
+    if not blocks:
+        return np.zeros((0, k), dtype=np.intp)
+    return np.concatenate(blocks)
@@ -0,0 +1,224 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from imd import DEFAULT_MAX_ORDER
+from imd_engine import calcRatings, evaluateCombos
+
+# ワーカー数の何倍の区間に分割するか（区間ごとの処理時間のばらつきを均すため）
+CHUNKS_PER_JOB = 4
+
+# ワーカープロセス側で共有メモリから参照している配列（名前 -> ndarray）と共有メモリのハンドル（名前 -> SharedMemory）
+_shared = {}
+_handles = {}
+
+
+class SharedArrays:
+    """NumPy配列を共有メモリに置き、ワーカープロセスから名前で参照できるようにする"""
+
+    def __init__(self, arrays: dict):
+        self.arrays = {}
+        self.specs = {}
+        self._blocks = []
+        try:
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                self._blocks.append(block)
+                shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+                shared[...] = array
+                self.arrays[name] = shared
+                self.specs[name] = (block.name, array.shape, array.dtype.str)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """共有メモリを解放"""
+        self.arrays = {}
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _attachShared(specs):
+    """ワーカープロセス側: 共有メモリ上の配列をコピーせずに参照する（同じ名前の配列が作り直されていれば付け替える）"""
+    for name, (block_name, shape, dtype) in specs.items():
+        handle = _handles.get(name)
+        if handle is not None and handle.name == block_name:
+            continue
+        _shared.pop(name, None)
+        if handle is not None:
+            handle.close()
+        block = shared_memory.SharedMemory(name=block_name)
+        _handles[name] = block
+        _shared[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _sharedTask(specs, task, start, stop, *args):
+    """ワーカープロセスでブロック用の共有メモリを参照してからtask(start, stop, *args)を実行"""
+    _attachShared(specs)
+    return task(start, stop, *args)
+
+
+def _splitRange(m: int, jobs: int):
+    """[0, m) を連続した区間のリストに分割"""
+    chunks = max(1, min(m, jobs * CHUNKS_PER_JOB))
+    bounds = np.linspace(0, m, chunks + 1).astype(np.int64).tolist()
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _ratingsTask(start, stop, max_order):
+    _shared['ratings'][start:stop] = calcRatings(_shared['combos'][start:stop], max_order)
+
+
+def _evaluateTask(start, stop, threshold, max_order):
+    ratings, min_differences, violations = evaluateCombos(_shared['combos'][start:stop], threshold, max_order)
+    _shared['ratings'][start:stop] = ratings
+    _shared['min_differences'][start:stop] = min_differences
+    return violations
+
+
+class ParallelScorer:
+    """評価のワーカー（jobs個のプロセスまたはthreads個のスレッド）を保持し、ブロックごとの評価で使い回す
+
+    ワーカーは最初の評価時に一度だけ起動する。プロセスで評価する場合、ブロックの入出力用の共有メモリも
+    使い回す（大きいブロックが来たときだけ作り直す）。
+    jobs, threadsがどちらも1以下ならワーカーを使わずにその場で評価する。with文で使い、終了時にワーカーと共有メモリを解放する。
+    """
+
+    def __init__(self, jobs: int = 1, threads: int = 1, max_order: int = DEFAULT_MAX_ORDER):
+        self.jobs = jobs
+        self.threads = threads
+        self.max_order = max_order
+        self._executor = None
+        self._buffers = {}
+
+    def _workers(self):
+        """ワーカーを返す（初回だけ起動）"""
+        if self._executor is None:
+            if self.threads > 1:
+                self._executor = ThreadPoolExecutor(max_workers=self.threads)
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self.jobs)
+        return self._executor
+
+    def _buffer(self, name: str, shape, dtype):
+        """ブロック用の共有メモリ上の配列の先頭shape[0]行を返す（形・型が合わないか容量が足りなければ作り直す）"""
+        dtype = np.dtype(dtype)
+        buffer = self._buffers.get(name)
+        if buffer is not None:
+            array = buffer.arrays[name]
+            if array.dtype == dtype and array.shape[1:] == tuple(shape[1:]) and len(array) >= shape[0]:
+                return array[:shape[0]]
+            buffer.close()
+        buffer = SharedArrays({name: np.zeros(shape, dtype=dtype)})
+        self._buffers[name] = buffer
+        return buffer.arrays[name]
+
+    def _runProcesses(self, inputs: dict, outputs: dict, m: int, task, *args):
+        """inputsを共有メモリに書き込み、[0, m) の区間ごとにtaskをワーカープロセスで実行する
+
+        taskは出力配列（outputs: 名前 -> dtype）の担当区間に直接書き込むため、
+        結果は逐次実行と同じ並び順になる。戻り値は (出力配列の辞書, 区間ごとのtaskの戻り値のリスト) 。
+        """
+        for name, array in inputs.items():
+            self._buffer(name, array.shape, array.dtype)[...] = array
+        arrays = {name: self._buffer(name, (m,), dtype) for name, dtype in outputs.items()}
+        specs = {name: self._buffers[name].specs[name] for name in list(inputs) + list(outputs)}
+        executor = self._workers()
+        futures = [executor.submit(_sharedTask, specs, task, start, stop, *args)
+                   for start, stop in _splitRange(m, self.jobs)]
+        results = [future.result() for future in futures]
+        return {name: array.copy() for name, array in arrays.items()}, results
+
+    def _runThreads(self, m: int, task):
+        """[0, m) の区間ごとにtask(start, stop)をスレッドで実行し、区間ごとの戻り値のリストを返す
+
+        入力の配列はコピーせずに全スレッドで共有する（読み出しのみ）。taskは出力配列の担当区間にだけ
+        書き込み、モジュールの可変な状態を使わないため、GILのないビルド（free-threaded）でもそのまま並列に動く。
+        GILのあるビルドでも、NumPyの演算・添字参照の間はGILが解放されるため並列に進む部分がある。
+        """
+        executor = self._workers()
+        futures = [executor.submit(task, start, stop) for start, stop in _splitRange(m, self.threads)]
+        return [future.result() for future in futures]
+
+    def calcRatings(self, combos):
+        """calcRatingsを分割して実行"""
+        combos = np.asarray(combos, dtype=np.int32)
+        max_order = self.max_order
+        if self.threads > 1 and len(combos) > 0:
+            ratings = np.empty(len(combos), dtype=np.int64)
+
+            def task(start, stop):
+                ratings[start:stop] = calcRatings(combos[start:stop], max_order)
+
+            self._runThreads(len(combos), task)
+            return ratings
+        if self.jobs <= 1 or len(combos) == 0:
+            return calcRatings(combos, max_order)
+        outputs, _ = self._runProcesses({'combos': combos}, {'ratings': np.int64}, len(combos), _ratingsTask,
+                                        max_order)
+        return outputs['ratings']
+
+    def evaluateCombos(self, combos, threshold=None):
+        """evaluateCombosを分割して実行"""
+        combos = np.asarray(combos, dtype=np.int32)
+        max_order = self.max_order
+        if self.threads > 1 and len(combos) > 0:
+            ratings = np.empty(len(combos), dtype=np.int64)
+            min_differences = np.empty(len(combos), dtype=np.int32)
+
+            def task(start, stop):
+                ratings[start:stop], min_differences[start:stop], violations = evaluateCombos(
+                    combos[start:stop], threshold, max_order)
+                return violations
+
+            results = self._runThreads(len(combos), task)
+        elif self.jobs <= 1 or len(combos) == 0:
+            return evaluateCombos(combos, threshold, max_order)
+        else:
+            outputs, results = self._runProcesses({'combos': combos},
+                                                  {'ratings': np.int64, 'min_differences': np.int32},
+                                                  len(combos), _evaluateTask, threshold, max_order)
+            ratings, min_differences = outputs['ratings'], outputs['min_differences']
+        violations = None
+        if threshold is not None:
+            violations = [combo_violations for chunk in results for combo_violations in chunk]
+        return ratings, min_differences, violations
+
+    def close(self):
+        """ワーカーを終了し、共有メモリを解放"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for buffer in self._buffers.values():
+            buffer.close()
+        self._buffers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def parallelCalcRatings(combos, jobs: int = 1, max_order: int = DEFAULT_MAX_ORDER, threads: int = 1):
+    """calcRatingsをjobs個のプロセス（threadsを指定した場合はthreads個のスレッド）で分割して実行"""
+    with ParallelScorer(jobs, threads, max_order) as scorer:
+        return scorer.calcRatings(combos)
+
+
+def parallelEvaluateCombos(combos, threshold=None, jobs: int = 1, max_order: int = DEFAULT_MAX_ORDER,
+                           threads: int = 1):
+    """evaluateCombosをjobs個のプロセス（threadsを指定した場合はthreads個のスレッド）で分割して実行"""
+    with ParallelScorer(jobs, threads, max_order) as scorer:
+        return scorer.evaluateCombos(combos, threshold)
@@ -0,0 +1,439 @@
+import argparse
+import heapq
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from imd_delta import DeltaScorer
+from imd_engine import calcTotals, totalsToRatings
+from channel_plan import get_channel_plan
+from create_secondary_ranking import read_frequencies_from_file
+
+
+class _Deadline(Exception):
+    """制限時間に達したことを探索の呼び出し元に伝える"""
+
+
+class TopK:
+    """評価値の上位top件（同じ評価値なら周波数の組み合わせの辞書順）を保持する
+
+    並び順は全組み合わせを評価して評価値で安定ソートした場合と同じになる。
+    """
+
+    def __init__(self, top: int):
+        self.top = top
+        # 最小ヒープの先頭が最も悪い要素: (評価値, 添字を符号反転した組) の小さい方が悪い
+        self._heap = []
+
+    @staticmethod
+    def _key(rating, indices):
+        return (rating, tuple(-i for i in indices))
+
+    def full(self):
+        return len(self._heap) >= self.top
+
+    def canImprove(self, rating_bound, best_indices):
+        """評価値の上限rating_bound・辞書順で最小の組best_indicesの部分木が上位に入り得るか"""
+        return not self.full() or self._key(rating_bound, best_indices) > self._heap[0]
+
+    def push(self, rating, indices):
+        """評価済みの組み合わせを追加（上位に入らなければ捨てる）"""
+        key = self._key(rating, indices)
+        if not self.full():
+            heapq.heappush(self._heap, key)
+        elif key > self._heap[0]:
+            heapq.heapreplace(self._heap, key)
+
+    def results(self):
+        """上位の (添字の組, 評価値) を良い順に返す"""
+        ordered = sorted(self._heap, reverse=True)
+        return [(tuple(-i for i in negated), rating) for rating, negated in ordered]
+
+
+def topKSearch(pool, k: int, top: int = 10, deadline=None):
+    """分枝限定法で評価値の上位top件のk周波数の組み合わせを求める
+
+    周波数を一つずつ選んで組み合わせを作り、途中の組み合わせの減点合計を
+    最終的な減点合計の下限（totalは周波数の追加で減らないため）として枝刈りする。
+    結果は全組み合わせを評価して順位付けした場合の上位top件と完全に一致する。
+    deadline（秒）を指定すると、時間切れの時点で見つかっている上位を返す。
+
+    戻り値は ([(周波数のリスト, 評価値), ...], 探索を完了したか) 。
+    """
+    pool = np.asarray(sorted(set(pool)), dtype=np.int32)
+    n = len(pool)
+    best = TopK(top)
+    if top <= 0 or k <= 0 or k > n:
+        return [], True
+    end_time = None if deadline is None else time.monotonic() + deadline
+
+    def expand(prefix):
+        m = len(prefix)
+        last = prefix[-1] if prefix else -1
+        # 残りの枠を埋められる範囲の候補だけを子とする
+        candidates = np.arange(last + 1, n - (k - m - 1))
+        combos = np.empty((len(candidates), m + 1), dtype=np.int32)
+        combos[:, :m] = pool[list(prefix)]
+        combos[:, m] = pool[candidates]
+        bounds = totalsToRatings(calcTotals(combos), k)
+
+        # 上限の高い子から順に調べる（良い解が早く見つかり、枝刈りが効きやすくなる）
+        for j in np.lexsort((candidates, -bounds)).tolist():
+            if end_time is not None and time.monotonic() > end_time:
+                raise _Deadline()
+            child = prefix + (int(candidates[j]),)
+            bound = int(bounds[j])
+            if m + 1 == k:
+                best.push(bound, child)
+                continue
+            if best.full() and bound < best._heap[0][0]:
+                break  # 以降の子は上限がさらに低い
+            best_completion = child + tuple(range(child[-1] + 1, child[-1] + k - m))
+            if best.canImprove(bound, best_completion):
+                expand(child)
+
+    complete = True
+    try:
+        expand(())
+    except _Deadline:
+        complete = False
+    return [(pool[list(indices)].tolist(), rating) for indices, rating in best.results()], complete
+
+
+def assignmentSearch(domains, top: int = 10, deadline=None):
+    """パイロット（スロット）ごとに使える周波数のリストdomainsから、評価値の上位top件の割り当てを分枝限定法で求める
+
+    チャネルが固定されたスロットは要素が1つのリストで指定する。探索するのは各スロットの候補の直積
+    （同じ周波数を2つのスロットに割り当てるものは除く）だけで、topKSearchと同じく途中までの割り当ての
+    減点合計を最終的な減点合計の下限として枝刈りする。候補の少ないスロット（固定したスロット）から
+    割り当てるため、固定したスロットが多いほど探索は小さくなる。
+
+    同じ周波数の組で割り当て方だけが異なるものは評価値が同じなので、最初に見つかった割り当てだけを返す
+    （候補が同じスロットどうしは周波数の昇順に割り当てる）。
+    並び順は評価値の降順（同じ評価値なら周波数の組の辞書順）で、評価値はimd.calcRatingと同じ。
+    戻り値は ([(スロット順の周波数のリスト, 評価値), ...], 探索を完了したか) 。
+    """
+    domains = [sorted(set(domain)) for domain in domains]
+    k = len(domains)
+    if top <= 0 or k == 0 or any(not domain for domain in domains):
+        return [], True
+    end_time = None if deadline is None else time.monotonic() + deadline
+    # 候補の少ないスロットから割り当てる（候補が同じスロットは隣に並べる）
+    order = sorted(range(k), key=lambda slot: (len(domains[slot]), domains[slot], slot))
+    best = TopK(top)
+    # 周波数の組（昇順） -> 最初に見つかった割り当て（orderの順）
+    assignments = {}
+
+    def expand(prefix):
+        m = len(prefix)
+        used = set(prefix)
+        # 候補が前のスロットと同じなら、入れ替えただけの割り当てを避けるため前のスロットより大きい周波数だけを選ぶ
+        low = prefix[-1] if m > 0 and domains[order[m]] == domains[order[m - 1]] else 0
+        candidates = np.array([freq for freq in domains[order[m]] if freq not in used and freq > low],
+                              dtype=np.int32)
+        if len(candidates) == 0:
+            return
+        combos = np.empty((len(candidates), m + 1), dtype=np.int32)
+        combos[:, :m] = prefix
+        combos[:, m] = candidates
+        bounds = totalsToRatings(calcTotals(combos), k)
+
+        # 上限の高い子から順に調べる
+        for j in np.lexsort((candidates, -bounds)).tolist():
+            if end_time is not None and time.monotonic() > end_time:
+                raise _Deadline()
+            child = prefix + (int(candidates[j]),)
+            bound = int(bounds[j])
+            if m + 1 == k:
+                key = tuple(sorted(child))
+                if key not in assignments and best.canImprove(bound, key):
+                    assignments[key] = child
+                    best.push(bound, key)
+                continue
+            if best.full() and bound < best._heap[0][0]:
+                break  # 以降の子は上限がさらに低い
+            expand(child)
+
+    complete = True
+    try:
+        expand(())
+    except _Deadline:
+        complete = False
+    results = []
+    for key, rating in best.results():
+        assignment = [0] * k
+        for slot, freq in zip(order, assignments[key]):
+            assignment[slot] = freq
+        results.append((assignment, rating))
+    return results, complete
+
+
+def _betterThan(total, indices, best_total, best_indices):
+    """減点合計が小さい方（同じなら添字の組が辞書順で前の方）を良い解とする"""
+    return (total, tuple(indices)) < (best_total, tuple(best_indices))
+
+
+def _anneal(pool, k, iterations, rng, start):
+    """焼きなまし法: ランダムな1チャネル入れ替えを温度に応じて受理する
+
+    入れ替え後の減点合計はDeltaScorerで差分として求め、受理した入れ替えだけをDeltaScorerに反映する。
+    """
+    n = len(pool)
+    # currentはスロット順の添字（DeltaScorerのスロットと対応）。最良解は昇順に並べて保持する
+    current = rng.choice(n, k, replace=False)
+    in_set = np.zeros(n, dtype=bool)
+    in_set[current] = True
+    scorer = DeltaScorer(pool[current])
+    best, best_total = np.sort(current), scorer.total
+    history = [(time.monotonic() - start, 0, best_total)]
+    if k == n:
+        return best, best_total, history  # 入れ替え候補がない
+
+    def neighbor():
+        return int(rng.integers(k)), int(rng.choice(np.flatnonzero(~in_set)))
+
+    # 初期温度はランダムな入れ替えによる減点合計の変化量の平均、最終温度はその1/1000
+    deltas = [abs(int(scorer.swapTotals(slot, [pool[index]])[0]) - scorer.total)
+              for slot, index in (neighbor() for _ in range(32))]
+    temperature = max(float(np.mean(deltas)), 1.0)
+    cooling = 1e-3 ** (1.0 / max(iterations, 1))
+
+    for iteration in range(1, iterations + 1):
+        slot, index = neighbor()
+        total = int(scorer.swapTotals(slot, [pool[index]])[0])
+        delta = total - scorer.total
+        if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+            in_set[current[slot]] = False
+            in_set[index] = True
+            current[slot] = index
+            scorer.swap(slot, int(pool[index]))
+            candidate = np.sort(current)
+            if _betterThan(scorer.total, candidate, best_total, best):
+                best, best_total = candidate, scorer.total
+                history.append((time.monotonic() - start, iteration, best_total))
+        temperature *= cooling
+    return best, best_total, history
+
+
+def _tabu(pool, k, iterations, rng, start, tenure=None):
+    """タブー探索: 全ての1チャネル入れ替えをまとめて評価し、タブーでない最良の入れ替えを選ぶ
+
+    入れ替えの評価はスロットごとにDeltaScorer.swapTotalsで行い、選んだ入れ替えをDeltaScorerに反映する。
+    """
+    n = len(pool)
+    if tenure is None:
+        # 外したチャネルは少なくともk反復の間は戻さない（候補が少ない場合は全て塞がない長さに抑える）
+        tenure = max(1, min(n - k - 1, max(k, (n - k) // 4)))
+    # currentはスロット順の添字（DeltaScorerのスロットと対応）。最良解は昇順に並べて保持する
+    current = rng.choice(n, k, replace=False)
+    scorer = DeltaScorer(pool[current])
+    best, best_total = np.sort(current), scorer.total
+    history = [(time.monotonic() - start, 0, best_total)]
+    # 添字ごとに、外したあと再び選べるようになる反復番号
+    tabu_until = np.zeros(n, dtype=np.int64)
+
+    for iteration in range(1, iterations + 1):
+        outside = np.setdiff1d(np.arange(n), current)
+        if len(outside) == 0:
+            break
+        slots = np.repeat(np.arange(k), len(outside))
+        added = np.tile(outside, k)
+        totals = np.concatenate([scorer.swapTotals(slot, pool[outside]) for slot in range(k)])
+        # タブーの入れ替えは最良解を更新する場合のみ許可（アスピレーション基準）
+        allowed = (tabu_until[added] <= iteration) | (totals < best_total)
+        if not allowed.any():
+            allowed[:] = True
+        choice = int(np.flatnonzero(allowed)[np.argmin(totals[allowed])])
+        slot, index = int(slots[choice]), int(added[choice])
+        tabu_until[current[slot]] = iteration + tenure
+        current[slot] = index
+        scorer.swap(slot, int(pool[index]))
+        candidate = np.sort(current)
+        if _betterThan(scorer.total, candidate, best_total, best):
+            best, best_total = candidate, scorer.total
+            history.append((time.monotonic() - start, iteration, best_total))
+    return best, best_total, history
+
+
+METAHEURISTICS = {'anneal': _anneal, 'tabu': _tabu}
+
+
+def _runRestart(pool, k, method, iterations, seed, start):
+    """メタヒューリスティクスを1回実行し (添字の組, 減点合計, 改善履歴) を返す
+
+    改善履歴の経過秒はstart（探索全体の開始時刻、time.monotonic）から測る。
+    """
+    rng = np.random.default_rng(seed)
+    best, best_total, history = METAHEURISTICS[method](pool, k, iterations, rng, start)
+    return best.tolist(), best_total, history
+
+
+def metaheuristicSearch(pool, k: int, method: str = 'anneal', iterations: int = 20000, restarts: int = 4,
+                        seed: int = 0, jobs: int = 1):
+    """焼きなまし法（anneal）またはタブー探索（tabu）でk周波数の良い組み合わせを探す
+
+    restarts回の独立した探索（シード seed, seed+1, ...）をjobs個のプロセスで並列に実行する。
+    評価値はimd.calcRatingと同じ。最適解の保証はないが、全組み合わせの評価が
+    現実的でない6〜8チャネルでも短時間で良い解が得られる。
+
+    戻り値は ([(周波数のリスト, 評価値), ...]（リスタートごとの最良解、良い順）,
+    [(経過秒, リスタート番号, 反復回数, その時点の最良評価値), ...]（全体の最良評価値の推移）) 。
+    """
+    if method not in METAHEURISTICS:
+        raise ValueError(f"不明な探索方法です: {method}")
+    pool = np.asarray(sorted(set(pool)), dtype=np.int32)
+    if k <= 0 or k > len(pool):
+        return [], []
+    seeds = [seed + restart for restart in range(restarts)]
+    # 全リスタートの経過時間を同じ時刻から測り、逐次実行でも並列実行でも推移を比べられるようにする
+    start = time.monotonic()
+    args = ([pool] * restarts, [k] * restarts, [method] * restarts, [iterations] * restarts, seeds,
+            [start] * restarts)
+    if jobs > 1 and restarts > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            runs = list(executor.map(_runRestart, *args))
+    else:
+        runs = list(map(_runRestart, *args))
+
+    results = sorted(((total, indices) for indices, total, _ in runs))
+    results = [(pool[indices].tolist(), int(totalsToRatings([total], k)[0])) for total, indices in results]
+
+    # 各リスタートの改善履歴を経過時間順に並べ、全体の最良が更新された時点だけを残す
+    events = sorted((elapsed, restart, iteration, total)
+                    for restart, (_, _, history) in enumerate(runs)
+                    for elapsed, iteration, total in history)
+    progress = []
+    for elapsed, restart, iteration, total in events:
+        if not progress or total < progress[-1][3]:
+            progress.append((elapsed, restart, iteration, total))
+    progress = [(elapsed, restart, iteration, int(totalsToRatings([total], k)[0]))
+                for elapsed, restart, iteration, total in progress]
+    return results, progress
+
+
+def parse_slot(text, plan, pool):
+    """スロットの候補の指定（例: "5705", "5740,5800", "R,F", "hdzero"）を周波数のリスト（昇順）に変換
+
+    周波数はそのまま候補にし、バンド名・モード名はそのチャネルのうち候補周波数poolに含まれるものに展開する。
+    """
+    frequencies = set()
+    for token in (token.strip() for token in text.split(',')):
+        if not token:
+            continue
+        if token.isdigit():
+            frequencies.add(int(token))
+        elif token.lower() in plan.fpv_bands:
+            frequencies.update(freq for freq in plan.frequencies_of(token.lower()) if freq in pool)
+        elif plan.frequencies_of(token.upper()):
+            frequencies.update(freq for freq in plan.frequencies_of(token.upper()) if freq in pool)
+        else:
+            raise ValueError(f"不明なバンド名・モード名です: {token}")
+    if not frequencies:
+        raise ValueError(f"候補の周波数がありません: {text}")
+    return sorted(frequencies)
+
+
+def main(argv=None):
+    # コマンドライン引数のパース
+    parser = argparse.ArgumentParser(description="評価値上位の周波数組み合わせを探索")
+    parser.add_argument('--channels', type=int, default=4, help='同時に使用するチャネル数（デフォルト: 4）')
+    parser.add_argument('--method', choices=['exact'] + list(METAHEURISTICS), default='exact',
+                        help='探索方法: exact（分枝限定法）, anneal（焼きなまし法）, tabu（タブー探索）（デフォルト: exact）')
+    parser.add_argument('--top', type=int, default=10, help='表示する上位件数（デフォルト: 10）')
+    parser.add_argument('--deadline', type=float, default=None, help='exactの制限時間（秒）。時間切れ時はそれまでの最良結果を表示')
+    parser.add_argument('--iterations', type=int, default=None, help='anneal/tabuの反復回数（デフォルト: anneal 20000, tabu 200）')
+    parser.add_argument('--restarts', type=int, default=4, help='anneal/tabuの独立した探索の回数（デフォルト: 4）')
+    parser.add_argument('--seed', type=int, default=0, help='anneal/tabuの乱数シード（デフォルト: 0）')
+    parser.add_argument('--jobs', type=int, default=1, help='anneal/tabuのリスタートを並列実行するプロセス数（デフォルト: 1）')
+    parser.add_argument('--freq-file', default='freq.txt', help='候補周波数ファイル（デフォルト: freq.txt）')
+    parser.add_argument('--slot', action='append', metavar='SPEC',
+                        help='パイロットごとに使える周波数（例: 5705, 5740,5800, R,F, hdzero）。スロットの数だけ繰り返し指定し、'
+                             '1つの周波数を指定したスロットはそのチャネルに固定する（--channelsは無視）')
+    args = parser.parse_args(argv)
+    if args.slot and args.method != 'exact':
+        parser.error("--slot は --method exact でのみ指定できます")
+
+    frequencies = sorted(set(read_frequencies_from_file(args.freq_file)))
+    print(f"読み込まれた周波数: {frequencies}")
+    if args.slot:
+        try:
+            domains = [parse_slot(slot, get_channel_plan(), frequencies) for slot in args.slot]
+        except ValueError as e:
+            parser.error(str(e))
+        return run_assignment(domains, args)
+    if args.method != 'exact':
+        return run_metaheuristic(frequencies, args)
+    print(f"{args.channels}周波数の組み合わせから上位{args.top}件を探索します")
+    print("-" * 80)
+
+    start = time.monotonic()
+    results, complete = topKSearch(frequencies, args.channels, args.top, args.deadline)
+    elapsed = time.monotonic() - start
+
+    plan = get_channel_plan()
+    for i, (combo, rating) in enumerate(results, 1):
+        freq_str = ", ".join(plan.label_with_led(freq) for freq in combo)
+        print(f"{i:3d}. {freq_str} -> 評価値: {rating}")
+    print("-" * 80)
+    if complete:
+        print(f"探索完了（{elapsed:.2f}秒）")
+    else:
+        print(f"制限時間に達したため、それまでに見つかった上位を表示しています（{elapsed:.2f}秒）")
+    return results
+
+
+def run_assignment(domains, args):
+    """パイロットごとの候補から評価値上位の割り当てを探索して表示"""
+    plan = get_channel_plan()
+    for slot, domain in enumerate(domains, 1):
+        state = "固定" if len(domain) == 1 else f"{len(domain)}候補"
+        print(f"パイロット{slot}（{state}）: {domain}")
+    print(f"{len(domains)}人のパイロットへの割り当てから上位{args.top}件を探索します")
+    print("-" * 80)
+
+    start = time.monotonic()
+    results, complete = assignmentSearch(domains, args.top, args.deadline)
+    elapsed = time.monotonic() - start
+
+    for i, (assignment, rating) in enumerate(results, 1):
+        freq_str = ", ".join(f"P{slot}={plan.label_with_led(freq)}" for slot, freq in enumerate(assignment, 1))
+        print(f"{i:3d}. {freq_str} -> 評価値: {rating}")
+    print("-" * 80)
+    if complete:
+        print(f"探索完了（{elapsed * 1000:.1f}ミリ秒）")
+    else:
+        print(f"制限時間に達したため、それまでに見つかった上位を表示しています（{elapsed:.2f}秒）")
+    return results
+
+
+def run_metaheuristic(frequencies, args):
+    """焼きなまし法・タブー探索を実行して結果と最良評価値の推移を表示"""
+    iterations = args.iterations if args.iterations is not None else {'anneal': 20000, 'tabu': 200}[args.method]
+    print(f"{args.channels}周波数の組み合わせを{args.method}で探索します"
+          f"（反復{iterations}回 x {args.restarts}リスタート, シード{args.seed}）")
+    print("-" * 80)
+
+    start = time.monotonic()
+    results, progress = metaheuristicSearch(frequencies, args.channels, args.method, iterations,
+                                            args.restarts, args.seed, args.jobs)
+    elapsed = time.monotonic() - start
+
+    plan = get_channel_plan()
+    print("リスタートごとの最良解:")
+    for i, (combo, rating) in enumerate(results, 1):
+        freq_str = ", ".join(plan.label_with_led(freq) for freq in combo)
+        print(f"{i:3d}. {freq_str} -> 評価値: {rating}")
+
+    print("\n最良評価値の推移:")
+    print("  経過秒 | リスタート | 反復 | 最良評価値")
+    for seconds, restart, iteration, rating in progress:
+        print(f"{seconds:8.3f} | {restart:10d} | {iteration:4d} | {rating}")
+    print("-" * 80)
+    print(f"探索終了（{elapsed:.2f}秒）")
+    return results
+
+
+if __name__ == "__main__":
+    main()
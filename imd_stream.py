@@ -0,0 +1,122 @@
+import math
+
+import numpy as np
+
+from imd_engine import calcRatings, combinationIndexArray
+from imd_enumerate import constrainedIndexChunks, separatedIndexChunks
+
+# ストリームで一度に生成・評価する組み合わせ数の目安
+STREAM_CHUNK_SIZE = 65536
+
+
+def combinationIndexChunks(n: int, k: int, chunk_size: int = STREAM_CHUNK_SIZE):
+    """itertools.combinations(range(n), k)と同じ順序の組み合わせを、添字配列[b, k]のブロックに分けて順に返す
+
+    先頭の添字を固定した部分ごとに生成するため、全組み合わせを一度にメモリ上に作らない。
+    """
+    if k < 0 or k > n:
+        return
+
+    def chunks(prefix, start, remaining):
+        if math.comb(n - start, remaining) <= chunk_size or remaining == 0:
+            tail = combinationIndexArray(n - start, remaining) + start
+            block = np.empty((len(tail), len(prefix) + remaining), dtype=np.intp)
+            block[:, :len(prefix)] = prefix
+            block[:, len(prefix):] = tail
+            yield block
+            return
+        for i in range(start, n - remaining + 1):
+            yield from chunks(prefix + [i], i + 1, remaining - 1)
+
+    yield from chunks([], 0, k)
+
+
+def streamRatings(pool, k: int, score=None, chunk_size: int = STREAM_CHUNK_SIZE, min_separation: int = 0,
+                  constraints=None):
+    """k周波数の全組み合わせを辞書順のブロックごとに評価し、(添字配列[b, k], 評価値[b]) を順に返す
+
+    scoreは添字配列を受け取って評価値の配列を返す関数（省略時はcalcRatingsで評価）。
+    min_separationを指定すると、どの2つの間隔もmin_separation以上の組み合わせだけを生成して評価する
+    （poolは昇順）。constraints（imd_enumerate.CombinationConstraints）を指定すると、その制約を満たす
+    組み合わせだけを生成して評価する。
+    """
+    pool = np.asarray(pool, dtype=np.int32)
+    if score is None:
+        def score(indices):
+            return calcRatings(pool[indices])
+    if constraints is not None:
+        chunks = constrainedIndexChunks(pool.tolist(), k, constraints, chunk_size)
+    elif min_separation > 0:
+        chunks = separatedIndexChunks(pool.tolist(), k, min_separation, chunk_size)
+    else:
+        chunks = combinationIndexChunks(len(pool), k, chunk_size)
+    for indices in chunks:
+        yield indices, score(indices)
+
+
+class TopRanking:
+    """評価値の上位top件だけを保持する順位リスト（メモリ使用量はtop件分）"""
+
+    def __init__(self, top: int):
+        self.top = top
+        self.indices = None
+        self.ratings = None
+        self.count = 0
+
+    def add(self, indices, ratings):
+        """辞書順で前のブロックから順に評価結果を追加"""
+        self.count += len(ratings)
+        if self.ratings is not None and len(self.ratings) >= self.top:
+            # 現在の最下位と同じ評価値は辞書順で後になるため入らない
+            keep = ratings > self.ratings[-1]
+            indices, ratings = indices[keep], ratings[keep]
+        if len(ratings) == 0 or self.top <= 0:
+            return
+        if self.ratings is not None:
+            indices = np.concatenate([self.indices, indices])
+            ratings = np.concatenate([self.ratings, ratings])
+        # 安定ソートなので同じ評価値は追加順（組み合わせの辞書順）のまま残る
+        order = np.argsort(-ratings, kind='stable')[:self.top]
+        self.indices, self.ratings = indices[order], ratings[order]
+
+    def results(self, pool):
+        """(周波数のリスト, 評価値) のリストを評価値の降順で返す"""
+        if self.ratings is None:
+            return []
+        pool = np.asarray(pool)
+        return list(zip(pool[self.indices].tolist(), self.ratings.tolist()))
+
+
+class ThresholdRanking:
+    """評価値がmin_rating以上の組み合わせだけを保持する順位リスト"""
+
+    def __init__(self, min_rating: int):
+        self.min_rating = min_rating
+        self._indices = []
+        self._ratings = []
+        self.count = 0
+
+    def add(self, indices, ratings):
+        """辞書順で前のブロックから順に評価結果を追加"""
+        self.count += len(ratings)
+        keep = ratings >= self.min_rating
+        if keep.any():
+            self._indices.append(indices[keep])
+            self._ratings.append(ratings[keep])
+
+    def results(self, pool):
+        """(周波数のリスト, 評価値) のリストを評価値の降順で返す"""
+        if not self._ratings:
+            return []
+        indices = np.concatenate(self._indices)
+        ratings = np.concatenate(self._ratings)
+        order = np.argsort(-ratings, kind='stable')
+        pool = np.asarray(pool)
+        return list(zip(pool[indices[order]].tolist(), ratings[order].tolist()))
+
+
+def rankStream(stream, sink):
+    """(添字配列, 評価値) のストリームを順位リストに流し込む"""
+    for indices, ratings in stream:
+        sink.add(indices, ratings)
+    return sink
@@ -0,0 +1,85 @@
+import math
+
+import numpy as np
+
+from imd import DEFAULT_MAX_ORDER, MAX_DISPLAY_FREQUENCY, MIN_DISPLAY_FREQUENCY, RATING_DIFF_LIMIT, RATING_MAX_VALUE
+from imd_engine import ENGINE_VERSION, calcRatings, combinationIndexArray
+
+
+def is_full_ranking(ranking, max_order=DEFAULT_MAX_ORDER):
+    """保存済みの順位リストがプールの全組み合わせを含み、現在の評価パラメータ・合成波の次数・評価方法のバージョンで作られたものか"""
+    parameters = {
+        'rating_diff_limit': RATING_DIFF_LIMIT,
+        'min_frequency': MIN_DISPLAY_FREQUENCY,
+        'max_frequency': MAX_DISPLAY_FREQUENCY,
+        'rating_max': RATING_MAX_VALUE,
+        'max_order': max_order,
+        'engine_version': ENGINE_VERSION,
+    }
+    return ranking.parameters == parameters and len(ranking) == math.comb(len(ranking.pool), ranking.k)
+
+
+def combinations_with_added(n_existing: int, n_added: int, k: int):
+    """既存の周波数n_existing個と追加の周波数n_added個から、追加の周波数を1つ以上含むk個の組み合わせを作る
+
+    戻り値は既存の周波数を0〜n_existing-1、追加の周波数をn_existing〜の番号とした添字配列[M, k]。
+    """
+    blocks = []
+    for j in range(1, min(k, n_added) + 1):
+        existing = combinationIndexArray(n_existing, k - j)
+        added = combinationIndexArray(n_added, j) + n_existing
+        block = np.empty((len(existing) * len(added), k), dtype=np.intp)
+        block[:, :k - j] = np.repeat(existing, len(added), axis=0)
+        block[:, k - j:] = np.tile(added, (len(existing), 1))
+        blocks.append(block)
+    if not blocks:
+        return np.zeros((0, k), dtype=np.intp)
+    return np.concatenate(blocks)
+
+
+def _sort_keys(index_combos, ratings):
+    """順位リストの並び（評価値の降順、同じ評価値なら組み合わせの辞書順）の比較キー"""
+    k = index_combos.shape[1]
+    keys = np.empty(len(ratings), dtype=[('rating', '<i8')] + [(f'i{j}', '<i8') for j in range(k)])
+    keys['rating'] = -np.asarray(ratings, dtype=np.int64)
+    for j in range(k):
+        keys[f'i{j}'] = index_combos[:, j]
+    return keys
+
+
+def rerank(ranking, new_pool, score=calcRatings):
+    """保存済みの順位リスト（RankingFile）を新しい周波数プールに合わせて更新
+
+    削除された周波数を含む組み合わせは取り除き、追加された周波数を含む組み合わせだけを
+    score（周波数の組み合わせ配列[M, k]から評価値の配列を返す関数）で評価して、並び順を保ったまま挿入する。
+    結果は新しいプールで全組み合わせを評価して順位付けした場合と一致する。
+
+    戻り値は (新しいプール, 添字配列[M, k], 評価値[M], 削除した組み合わせ数, 追加した組み合わせ数) 。
+    """
+    old_pool = ranking.pool
+    new_pool = np.array(sorted(set(new_pool)), dtype=np.int32)
+    k = ranking.k
+
+    # 残る組み合わせ: 削除された周波数を含まないもの（プールは昇順なので添字の付け替えで辞書順は変わらない）
+    indices = np.asarray(ranking.records['indices'], dtype=np.intp)
+    ratings = np.asarray(ranking.records['rating'], dtype=np.int64)
+    kept_frequency = np.isin(old_pool, new_pool)
+    kept_rows = kept_frequency[indices].all(axis=1) if len(indices) else np.zeros(0, dtype=bool)
+    kept_indices = np.searchsorted(new_pool, old_pool)[indices[kept_rows]]
+    kept_ratings = ratings[kept_rows]
+
+    # 追加された周波数を1つ以上含む組み合わせだけを評価
+    existing = np.flatnonzero(np.isin(new_pool, old_pool))
+    added = np.flatnonzero(~np.isin(new_pool, old_pool))
+    local = combinations_with_added(len(existing), len(added), k)
+    new_indices = np.sort(np.concatenate([existing, added])[local], axis=1)
+    new_ratings = np.asarray(score(new_pool[new_indices]), dtype=np.int64) if len(new_indices) else np.zeros(0, dtype=np.int64)
+
+    # 追加分だけを並べ替えてから、並び順を保ったまま既存の順位リストに挿入する
+    new_keys = _sort_keys(new_indices, new_ratings)
+    order = np.argsort(new_keys, kind='stable')
+    new_indices, new_ratings, new_keys = new_indices[order], new_ratings[order], new_keys[order]
+    positions = np.searchsorted(_sort_keys(kept_indices, kept_ratings), new_keys)
+    merged_indices = np.insert(kept_indices, positions, new_indices, axis=0)
+    merged_ratings = np.insert(kept_ratings, positions, new_ratings)
+    return new_pool, merged_indices, merged_ratings, int((~kept_rows).sum()), len(new_indices)
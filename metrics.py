@@ -0,0 +1,130 @@
+import cProfile
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# 計測の有効・無効（無効時はstage/countが何もしないので、評価処理への影響はほぼない）
+_enabled = False
+_stages = {}
+_counters = {}
+_profile = {}
+# 評価をスレッドで並列に行う場合の計測値の更新用（計測が無効なら使わない）
+_lock = threading.Lock()
+
+
+def enable():
+    """計測を有効にし、これまでの計測値を消去"""
+    global _enabled
+    _enabled = True
+    reset()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    _stages.clear()
+    _counters.clear()
+    _profile.clear()
+
+
+class stage:
+    """with文で囲んだ処理の経過時間・CPU時間を段階名ごとに積算する（combos: 処理した組み合わせ数）"""
+
+    __slots__ = ('name', 'combos', '_wall', '_cpu')
+
+    def __init__(self, name, combos=0):
+        self.name = name
+        self.combos = combos
+
+    def __enter__(self):
+        if _enabled:
+            self._wall = time.perf_counter()
+            self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if _enabled:
+            wall = time.perf_counter() - self._wall
+            cpu = time.process_time() - self._cpu
+            with _lock:
+                record = _stages.setdefault(self.name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'combos': 0})
+                record['calls'] += 1
+                record['wall_seconds'] += wall
+                record['cpu_seconds'] += cpu
+                record['combos'] += self.combos
+
+
+def count(name, value=1):
+    """カウンタnameにvalueを加算"""
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + int(value)
+
+
+def report():
+    """段階ごとの時間・組み合わせ数/秒、カウンタ、プロファイル結果の辞書"""
+    stages = {}
+    for name, record in _stages.items():
+        stages[name] = dict(record)
+        if record['combos'] and record['wall_seconds'] > 0:
+            stages[name]['combos_per_second'] = record['combos'] / record['wall_seconds']
+    return {'stages': stages, 'counters': dict(_counters), 'profile': dict(_profile)}
+
+
+def write_json(filename):
+    """計測結果をJSONファイルに保存"""
+    with open(filename, 'w') as f:
+        json.dump(report(), f, ensure_ascii=False, indent=2)
+    print(f"計測結果を {filename} に保存しました", file=sys.stderr)
+
+
+class profiled:
+    """with文で囲んだ処理をcProfileとtracemallocで計測する（prefix=Noneなら何もしない）
+
+    prefix.profにcProfileの統計を保存し、累積時間の上位と最大メモリ使用量を標準エラー出力に表示する。
+    """
+
+    def __init__(self, prefix, top=20):
+        self.prefix = prefix
+        self.top = top
+        self._profiler = None
+
+    def __enter__(self):
+        if self.prefix is not None:
+            tracemalloc.start()
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._profiler is None:
+            return
+        self._profiler.disable()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        filename = f"{self.prefix}.prof"
+        self._profiler.dump_stats(filename)
+        stream = io.StringIO()
+        pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative').print_stats(self.top)
+        _profile.update({'stats_file': filename, 'peak_memory_mb': peak / 1024 / 1024,
+                         'final_memory_mb': current / 1024 / 1024})
+        print(stream.getvalue(), file=sys.stderr)
+        print(f"最大メモリ使用量: {peak / 1024 / 1024:.1f} MB, プロファイルを {filename} に保存しました", file=sys.stderr)
+
+
+def add_arguments(parser):
+    """--metrics と --profile のコマンドライン引数を追加"""
+    parser.add_argument('--metrics', metavar='FILE', help='段階ごとの時間・合成波の数などの計測結果をJSONファイルに保存')
+    parser.add_argument('--profile', nargs='?', const='profile', metavar='PREFIX',
+                        help='cProfileとtracemallocで計測し、PREFIX.profに保存（省略時: profile）')
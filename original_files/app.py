@@ -1,5 +1,10 @@
-import imd
+import argparse
 import sys
+from channel_plan import get_channel_plan
+from imd_enumerate import CombinationConstraints
+from imd_parallel import ParallelScorer
+from imd_stream import TopRanking, rankStream, streamRatings
+from score_cache import SCORE_CACHE_FILE, SCORE_CACHE_MAX_ENTRIES, ScoreCache, cachedCalcRatings
 
 # Configuration options
 BANDWIDTH_OPTIONS = {
@@ -10,8 +15,19 @@ BANDWIDTH_OPTIONS = {
 }
 
 # Parse command line arguments
-if len(sys.argv) > 1:
-    bandwidth_mode = sys.argv[1].lower()
+parser = argparse.ArgumentParser(description="FPV frequency combination finder")
+parser.add_argument('mode', nargs='?', help=f"bandwidth mode ({', '.join(BANDWIDTH_OPTIONS.keys())})")
+parser.add_argument('--jobs', type=int, default=1, help='number of worker processes for rating (default: 1)')
+parser.add_argument('--score-cache', nargs='?', const=SCORE_CACHE_FILE,
+                    help=f'reuse ratings from an SQLite score cache (default file: {SCORE_CACHE_FILE})')
+parser.add_argument('--score-cache-size', type=int, default=SCORE_CACHE_MAX_ENTRIES,
+                    help=f'maximum number of combinations kept in the score cache (default: {SCORE_CACHE_MAX_ENTRIES})')
+parser.add_argument('--distinct-led', action='store_true',
+                    help='only consider combinations whose LED numbers (LED.txt) are all different')
+args = parser.parse_args()
+
+if args.mode is not None:
+    bandwidth_mode = args.mode.lower()
     if bandwidth_mode in BANDWIDTH_OPTIONS:
         channel_width = BANDWIDTH_OPTIONS[bandwidth_mode]
         print(f"Using {bandwidth_mode} mode with {channel_width} MHz bandwidth")
@@ -24,7 +40,7 @@ else:
     bandwidth_mode = 'analog'
     channel_width = 17
     print(f"Using default analog mode with {channel_width} MHz bandwidth")
-    print(f"Usage: python app.py [mode]")
+    print(f"Usage: python app.py [mode] [--jobs N] [--score-cache [FILE]] [--distinct-led]")
     print(f"Available modes: {', '.join(BANDWIDTH_OPTIONS.keys())}")
 
 # FPV Band Frequencies (in MHz) with channel numbers
@@ -74,46 +90,49 @@ segments_needed = 4
 all_segments = filtered_frequencies
 
 
-# Function to check if two frequencies are too close
-def do_segments_overlap(seg1, seg2):
-    min_separation = channel_width + 1  # Minimum separation = channel width + 1 MHz gap
-    return abs(seg1 - seg2) < min_separation
+# Minimum separation = channel width + 1 MHz gap; with --distinct-led every channel must also show a different LED
+min_separation = channel_width + 1
+constraints = CombinationConstraints(min_separation=min_separation,
+                                     groups=get_channel_plan().led_number if args.distinct_led else None)
+if args.distinct_led:
+    print("Only combinations with four different LED numbers are considered")
 
 
-# Recursive function to find valid combinations of segments
-def find_combinations(segments, needed, current_combination=[]):
-    if needed == 0:
-        return [current_combination]
+# Score a block of combinations (indices into all_segments) with the same values as imd.calcRating
+def score_combinations(index_combos, scorer, cache=None):
+    combinations = [[all_segments[i] for i in indices] for indices in index_combos.tolist()]
+    if cache is not None:
+        return cachedCalcRatings(combinations, cache, scorer=scorer)
+    return scorer.calcRatings(combinations)
 
-    if not segments:
-        return []
 
-    combinations = []
-    for i in range(len(segments)):
-        # Check if the current segment overlaps with any segment in the current combination
-        if any(do_segments_overlap(segments[i], seg) for seg in current_combination):
-            continue
-        # Recursive call to find further combinations with the remaining segments
-        combinations.extend(find_combinations(segments[i + 1 :], needed - 1, current_combination + [segments[i]]))
-    return combinations
+# Enumerate valid combinations lazily in ascending order (the next segment is found with bisect, so
+# overlapping segments and repeated LED numbers are never generated) and stream them into the scorer,
+# keeping only the top 10 (the worker processes are started once and reused for every block)
+def rank_combinations(cache=None):
+    with ParallelScorer(args.jobs) as scorer:
+        def score(index_combos):
+            return score_combinations(index_combos, scorer, cache)
 
+        stream = streamRatings(all_segments, segments_needed, score=score, constraints=constraints)
+        return rankStream(stream, TopRanking(10))
 
-# Find all valid combinations of the required number of segments
-valid_combinations = find_combinations(all_segments, segments_needed)
 
-# Display the count of combinations and the first 5 combinations for verification
-print(f"Total combinations: {len(valid_combinations)}")
-# print("First 5 combinations:", valid_combinations[:5])
+if args.score_cache:
+    with ScoreCache(args.score_cache, args.score_cache_size) as cache:
+        ranking = rank_combinations(cache)
+        cache_stats = f"Score cache {cache.filename}: {cache.hits} hits, {cache.misses} scored, {len(cache)} stored"
+else:
+    ranking = rank_combinations()
+    cache_stats = None
 
-# calc rating for all combinations
-ratings = []
-for combination in valid_combinations:
-    rating = imd.calcRating(combination)
-    ratings.append((rating, combination))
-    # print(f"Rating: {rating} - {combination}")
+# Display the count of combinations
+print(f"Total combinations: {ranking.count}")
+if cache_stats and ranking.count:
+    print(cache_stats)
 
-# sort ratings
-ratings.sort(key=lambda x: x[0], reverse=True)
+# top 10 ratings, sorted by rating (ties keep the enumeration order)
+ratings = [(rating, combination) for combination, rating in ranking.results(all_segments)]
 
 # Create frequency to band/channel mapping for display
 freq_to_band_ch = {}
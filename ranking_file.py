@@ -0,0 +1,190 @@
+import argparse
+import os
+
+import numpy as np
+
+from imd import DEFAULT_MAX_ORDER, MAX_DISPLAY_FREQUENCY, MIN_DISPLAY_FREQUENCY, RATING_DIFF_LIMIT, RATING_MAX_VALUE
+from imd_engine import ENGINE_VERSION
+from channel_plan import get_channel_plan
+
+RANKING_MAGIC = b'IMDRANK1'
+RANKING_VERSION = 2
+RANKING_FILE = 'secondary_ranking.bin'
+
+# ファイル先頭の固定長ヘッダ（続いて周波数プール int32[pool_size]、その後に固定長レコードが並ぶ）
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('k', '<u4'),
+    ('pool_size', '<u4'),
+    ('count', '<u8'),
+    ('rating_diff_limit', '<i4'),
+    ('min_frequency', '<i4'),
+    ('max_frequency', '<i4'),
+    ('rating_max', '<i4'),
+    ('max_order', '<i4'),
+    ('engine_version', '<i4'),
+])
+
+
+def record_dtype(k: int):
+    """k周波数の組み合わせ1件分のレコード（プールの添字、評価値、二次合成の順位）"""
+    return np.dtype([('indices', '<u2', (k,)), ('rating', '<i4'), ('rank', '<u4')])
+
+
+def write_ranking(filename, pool, index_combos, ratings, ranks=None, max_order=DEFAULT_MAX_ORDER):
+    """順位リストをバイナリ形式で保存（index_combos: プールの添字[M, k]、ranks省略時は1からの連番、max_order: 評価した合成波の次数の上限）"""
+    pool = np.asarray(pool, dtype=np.int32)
+    index_combos = np.asarray(index_combos)
+    ratings = np.asarray(ratings)
+    k = index_combos.shape[1] if index_combos.ndim == 2 else 0
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = RANKING_MAGIC
+    header['version'] = RANKING_VERSION
+    header['k'] = k
+    header['pool_size'] = len(pool)
+    header['count'] = len(ratings)
+    header['rating_diff_limit'] = RATING_DIFF_LIMIT
+    header['min_frequency'] = MIN_DISPLAY_FREQUENCY
+    header['max_frequency'] = MAX_DISPLAY_FREQUENCY
+    header['rating_max'] = RATING_MAX_VALUE
+    header['max_order'] = max_order
+    header['engine_version'] = ENGINE_VERSION
+    records = np.zeros(len(ratings), dtype=record_dtype(k))
+    records['indices'] = index_combos.reshape(len(ratings), k)
+    records['rating'] = ratings
+    records['rank'] = np.arange(1, len(ratings) + 1) if ranks is None else ranks
+    # 一時ファイルに書いてから置き換える（メモリマップで開いている読み手が壊れたファイルを見ないように）
+    temporary = f"{filename}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(pool.astype('<i4').tobytes())
+        f.write(records.tobytes())
+    os.replace(temporary, filename)
+
+
+def write_ranking_results(filename, results, pool=None, max_order=DEFAULT_MAX_ORDER):
+    """[(周波数のリスト, 評価値), ...] の順位リストをバイナリ形式で保存（pool省略時は結果に含まれる周波数）"""
+    if pool is None:
+        pool = sorted({freq for combo, _ in results for freq in combo})
+    pool = np.asarray(pool, dtype=np.int32)
+    combos = np.array([combo for combo, _ in results], dtype=np.int32)
+    index_combos = np.searchsorted(pool, combos) if len(results) else np.zeros((0, 0), dtype=np.intp)
+    write_ranking(filename, pool, index_combos, [rating for _, rating in results], max_order=max_order)
+
+
+class RankingFile:
+    """バイナリ形式の順位リストをメモリマップで開き、順位を指定して直接参照する
+
+    順位は1から始まる（ranking[1]が最上位）。レコードはファイル上で固定長のため、
+    任意の順位・範囲の読み出しに全体の読み込みや文字列の解析は不要。
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        header = np.fromfile(filename, dtype=HEADER_DTYPE, count=1)
+        if len(header) != 1 or header['magic'][0] != RANKING_MAGIC:
+            raise ValueError(f"{filename} は順位リストのバイナリファイルではありません")
+        if int(header['version'][0]) != RANKING_VERSION:
+            raise ValueError(f"{filename} の形式のバージョンが異なります")
+        self.header = header[0]
+        self.k = int(self.header['k'])
+        pool_size = int(self.header['pool_size'])
+        self.pool = np.fromfile(filename, dtype='<i4', count=pool_size, offset=HEADER_DTYPE.itemsize).astype(np.int32)
+        offset = HEADER_DTYPE.itemsize + 4 * pool_size
+        count = int(self.header['count'])
+        if count:
+            self.records = np.memmap(filename, dtype=record_dtype(self.k), mode='r', offset=offset, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=record_dtype(self.k))
+
+    @property
+    def parameters(self):
+        """保存時の評価パラメータ"""
+        return {name: int(self.header[name]) for name in
+                ('rating_diff_limit', 'min_frequency', 'max_frequency', 'rating_max', 'max_order', 'engine_version')}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, rank: int):
+        """順位rankの (二次合成の順位, 周波数のリスト, 評価値)"""
+        if not 1 <= rank <= len(self.records):
+            raise IndexError(rank)
+        record = self.records[rank - 1]
+        return int(record['rank']), self.pool[record['indices']].tolist(), int(record['rating'])
+
+    def slice(self, start: int = 1, stop: int = None):
+        """順位start以上stop未満のレコード配列（メモリマップのビュー）"""
+        stop = len(self.records) + 1 if stop is None else stop
+        return self.records[max(start, 1) - 1:max(stop, 1) - 1]
+
+    def frequencies(self, start: int = 1, stop: int = None):
+        """順位start以上stop未満の組み合わせの周波数配列[b, k]"""
+        return self.pool[self.slice(start, stop)['indices']]
+
+    def iter_blocks(self, block_size: int = 65536, start: int = 1, stop: int = None):
+        """順位start以上stop未満（省略時は先頭から最後まで）を順に (二次合成の順位[b], 周波数[b, k], 評価値[b]) のブロックで返す"""
+        records = self.slice(start, stop)
+        for offset in range(0, len(records), block_size):
+            block = records[offset:offset + block_size]
+            yield np.asarray(block['rank']), self.pool[block['indices']], np.asarray(block['rating'])
+
+    def __iter__(self):
+        """先頭から順に (二次合成の順位, 周波数のリスト, 評価値) を返す"""
+        for ranks, combos, ratings in self.iter_blocks():
+            yield from zip(ranks.tolist(), combos.tolist(), ratings.tolist())
+
+    def results(self):
+        """[(周波数のリスト, 評価値), ...] の順位リスト"""
+        return [(combo, rating) for _, combo, rating in self]
+
+
+def render_ranking_text(ranking: RankingFile, filename="secondary_ranking.txt", start: int = 1, stop: int = None):
+    """バイナリ形式の順位リストをテキスト形式（secondary_ranking.txtと同じ書式）で書き出す"""
+    plan = get_channel_plan()
+    labels = {freq: plan.label_with_led(freq) for freq in ranking.pool.tolist()}
+    columns = ", ".join(f"周波数{i}(チャネル)[LED]" for i in range(1, ranking.k + 1))
+
+    with open(filename, 'w') as f:
+        f.write(f"# 二次合成による{ranking.k}周波数組み合わせ順位リスト\n")
+        f.write(f"# 形式: 順位, {columns}, 評価値\n")
+        f.write("-" * 120 + "\n")
+
+        # 範囲外のレコードは読まない（メモリマップのスライスだけをブロックごとに読む）
+        for ranks, combos, ratings in ranking.iter_blocks(start=start, stop=stop):
+            for rank, combo, rating in zip(ranks.tolist(), combos.tolist(), ratings.tolist()):
+                freq_str = ", ".join(labels[freq] for freq in combo)
+                f.write(f"{rank:4d}, {freq_str}, {rating}\n")
+    # 書き出したテキスト形式がバイナリ形式より新しくならないようにする（読み手はテキスト形式の方が新しければ
+    # バイナリ形式を古いものとして扱うため）
+    os.utime(ranking.filename)
+
+
+def main(argv=None):
+    # コマンドライン引数のパース
+    parser = argparse.ArgumentParser(description="バイナリ形式の順位リストの表示・テキスト出力")
+    parser.add_argument('filename', nargs='?', default=RANKING_FILE, help=f'順位リストファイル（デフォルト: {RANKING_FILE}）')
+    parser.add_argument('--start', type=int, default=1, help='表示・出力する最初の順位（デフォルト: 1）')
+    parser.add_argument('--stop', type=int, help='表示・出力する範囲の終わり（この順位は含まない）')
+    parser.add_argument('--text', help='指定したファイルにテキスト形式で書き出す')
+    args = parser.parse_args(argv)
+
+    ranking = RankingFile(args.filename)
+    if args.text:
+        render_ranking_text(ranking, args.text, args.start, args.stop)
+        print(f"順位リストを {args.text} に保存しました")
+        return
+
+    plan = get_channel_plan()
+    print(f"周波数プール: {ranking.pool.tolist()}")
+    print(f"組み合わせ数: {len(ranking)}, パラメータ: {ranking.parameters}")
+    print("-" * 80)
+    stop = args.start + 20 if args.stop is None else args.stop
+    for record in ranking.slice(args.start, stop):
+        combo = ranking.pool[record['indices']].tolist()
+        print(f"{int(record['rank']):4d}. 周波数: {[plan.label_with_led(f) for f in combo]} -> 評価値: {int(record['rating'])}")
+
+
+if __name__ == "__main__":
+    main()
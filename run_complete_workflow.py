@@ -7,10 +7,28 @@
 3. 最終結果の表示
 """
 
+import argparse
 import os
 import sys
-from create_secondary_ranking import main as create_secondary_ranking
-from apply_tertiary_filter import main as apply_tertiary_filter
+import metrics
+import numpy as np
+from create_secondary_ranking import (add_constraint_arguments, add_max_order_argument, constraints_from_args,
+                                      print_pool_summary, print_ranking_results, read_frequencies_from_file,
+                                      save_ranking_to_file)
+from apply_tertiary_filter import print_filtered_details, print_summary, save_filtered_results
+from ranking_file import RANKING_FILE, RANKING_VERSION, RankingFile
+from stage_cache import CHANNEL_PLAN_FILES, is_stage_fresh, record_stage, stage_fingerprint
+from workflow_pipeline import PipelineCollector, ranking_file_stream, run_in_background, secondary_stream
+
+# 各段階の出力ファイル（先頭のファイルの隣に入力の指紋を保存する）
+SECONDARY_OUTPUTS = ['secondary_ranking.txt', RANKING_FILE]
+TERTIARY_OUTPUTS = ['filtered_ranking.txt']
+# 出力ファイルの説明（ステップ3で今回書き出したファイルの一覧に表示する）
+OUTPUT_DESCRIPTIONS = {
+    'secondary_ranking.txt': "二次合成による順位リスト",
+    RANKING_FILE: "二次合成による順位リスト（バイナリ形式）",
+    'filtered_ranking.txt': "三次合成評価とフィルタリング結果",
+}
 
 def check_required_files():
     """必要なファイルの存在をチェック"""
@@ -29,8 +47,30 @@ def check_required_files():
     
     return True
 
-def main():
+def main(argv=None):
     """完全なワークフローを実行"""
+    # コマンドライン引数のパース
+    parser = argparse.ArgumentParser(description="IMD評価完全ワークフロー")
+    parser.add_argument('--imd-diff-threshold', type=int, default=20, help='IMD差フィルタの閾値（MHz未満で排除, デフォルト: 20）')
+    parser.add_argument('--jobs', type=int, default=1, help='評価に使う並列プロセス数（デフォルト: 1）')
+    parser.add_argument('--force', action='store_true', help='入力が前回と同じでも全ての段階を実行し直す')
+    parser.add_argument('--save-secondary', action='store_true',
+                        help='二次合成の順位リスト（secondary_ranking.txt/.bin）も保存する（次回、入力が同じなら二次合成を省略できる）')
+    add_max_order_argument(parser)
+    add_constraint_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    args.constraints = constraints_from_args(args)
+    
+    if args.metrics:
+        metrics.enable()
+    with metrics.profiled(args.profile):
+        run_workflow(args)
+    if args.metrics:
+        metrics.write_json(args.metrics)
+
+def run_workflow(args):
+    """コマンドライン引数に従って二次合成・三次合成の各段階を実行"""
     print("=" * 80)
     print("IMD評価完全ワークフロー")
     print("=" * 80)
@@ -42,39 +82,102 @@ def main():
     print("\nステップ1: 二次合成による評価と順位リスト作成")
     print("-" * 60)
     
-    try:
-        # 二次合成による評価を実行
-        secondary_results = create_secondary_ranking()
-        
-        if not secondary_results:
-            print("エラー: 二次合成による評価が失敗しました")
-            sys.exit(1)
-        
+    constraints = None if args.constraints is None else args.constraints.describe()
+    secondary_fingerprint = stage_fingerprint('secondary', ['freq.txt'] + CHANNEL_PLAN_FILES, max_order=args.max_order,
+                                              constraints=constraints, ranking_version=RANKING_VERSION)
+    tertiary_fingerprint = stage_fingerprint('tertiary', ['freq.txt'] + CHANNEL_PLAN_FILES,
+                                             imd_diff_threshold=args.imd_diff_threshold, max_order=args.max_order,
+                                             constraints=constraints)
+    secondary_fresh = not args.force and is_stage_fresh(secondary_fingerprint, SECONDARY_OUTPUTS)
+    tertiary_fresh = not args.force and is_stage_fresh(tertiary_fingerprint, TERTIARY_OUTPUTS)
+    
+    # 二次合成の評価結果はブロックごとにメモリ上で三次合成の評価に渡す（ファイルの書き出し・再読み込みは不要）
+    collector = PipelineCollector(None if tertiary_fresh else args.imd_diff_threshold, jobs=args.jobs,
+                                  max_order=args.max_order)
+    # 順位順の結果はcollector.results()で一度だけ作り、二次合成・三次合成の出力で共有する
+    filtered_results = None
+    # 今回の実行で書き出したファイル
+    written_files = []
+    
+    if tertiary_fresh and (secondary_fresh or not args.save_secondary):
+        # 三次合成の結果を再利用し、二次合成の順位リストも保存し直さないので二次合成は不要
+        print("入力が前回と同じため、二次合成による評価を省略します（--force で再実行）")
+    elif secondary_fresh:
+        # 入力が前回と同じなので保存済みの順位リストを再利用
+        print(f"入力が前回と同じため、保存済みの {SECONDARY_OUTPUTS[0]} を使用します（--force で再実行）")
+        ranking = RankingFile(RANKING_FILE)
+        if not tertiary_fresh:
+            with metrics.stage('pipeline'):
+                collector.consume(ranking_file_stream(ranking))
         print(f"\n✅ 二次合成による評価が完了しました")
-        print(f"   結果: {len(secondary_results)}個の組み合わせを評価")
-        
-    except Exception as e:
-        print(f"エラー: 二次合成による評価中にエラーが発生しました: {e}")
-        sys.exit(1)
+        print(f"   結果: {len(ranking)}個の組み合わせを評価")
+    else:
+        try:
+            frequencies = read_frequencies_from_file('freq.txt')
+            unique_frequencies = sorted(set(frequencies))
+            print_pool_summary(unique_frequencies)
+            if args.constraints is not None:
+                print(f"組み合わせの制約: {constraints}")
+            pool = np.asarray(unique_frequencies, dtype=np.int32)
+            
+            # 二次合成の評価を別スレッドで進めながら、評価済みのブロックから三次合成の評価を行う
+            with metrics.stage('pipeline'):
+                collector.consume(run_in_background(secondary_stream(pool, args.jobs, args.max_order, args.constraints)))
+            with metrics.stage('sort'):
+                secondary_results, filtered_results = collector.results()
+            
+            if not secondary_results:
+                print("エラー: 二次合成による評価が失敗しました")
+                sys.exit(1)
+            
+            print_ranking_results(secondary_results)
+            if args.save_secondary:
+                with metrics.stage('save_ranking', combos=len(secondary_results)):
+                    save_ranking_to_file(secondary_results, pool=unique_frequencies, max_order=args.max_order)
+                written_files.extend(SECONDARY_OUTPUTS)
+            
+            print(f"\n✅ 二次合成による評価が完了しました")
+            print(f"   結果: {len(secondary_results)}個の組み合わせを評価")
+            
+        except Exception as e:
+            print(f"エラー: 二次合成による評価中にエラーが発生しました: {e}")
+            sys.exit(1)
+        if args.save_secondary:
+            record_stage(secondary_fingerprint, SECONDARY_OUTPUTS)
     
     print("\nステップ2: 三次合成による評価と近接周波数フィルタリング")
     print("-" * 60)
     
-    try:
-        # 三次合成による評価とフィルタリングを実行
-        apply_tertiary_filter()
-        
-        print(f"\n✅ 三次合成による評価とフィルタリングが完了しました")
-        
-    except Exception as e:
-        print(f"エラー: 三次合成による評価中にエラーが発生しました: {e}")
-        sys.exit(1)
+    if tertiary_fresh:
+        # 入力と閾値が前回と同じなので保存済みのフィルタリング結果を再利用
+        print(f"入力が前回と同じため、保存済みの {TERTIARY_OUTPUTS[0]} を使用します（--force で再実行）")
+    else:
+        try:
+            # 評価済みの三次合成の結果を二次合成の順位順に並べて出力（二次合成を評価した場合は並べ替え済み）
+            if filtered_results is None:
+                with metrics.stage('sort'):
+                    _, filtered_results = collector.results()
+            
+            print(f"三次合成による評価とIMD差{args.imd_diff_threshold}MHz未満チェックを実行中...")
+            print("-" * 80)
+            print_filtered_details(filtered_results, args.imd_diff_threshold)
+            with metrics.stage('save_filtered', combos=len(filtered_results)):
+                save_filtered_results(filtered_results)
+            written_files.extend(TERTIARY_OUTPUTS)
+            print_summary(filtered_results)
+            
+            print(f"\n✅ 三次合成による評価とフィルタリングが完了しました")
+            
+        except Exception as e:
+            print(f"エラー: 三次合成による評価中にエラーが発生しました: {e}")
+            sys.exit(1)
+        record_stage(tertiary_fingerprint, TERTIARY_OUTPUTS)
     
     print("\nステップ3: 最終結果の確認")
     print("-" * 60)
     
-    # 生成されたファイルの確認
-    output_files = ['secondary_ranking.txt', 'filtered_ranking.txt']
+    # 今回の実行で書き出したファイルの確認
+    output_files = written_files
     
     for file in output_files:
         if os.path.exists(file):
@@ -86,9 +189,12 @@ def main():
     print("\n" + "=" * 80)
     print("ワークフロー完了!")
     print("=" * 80)
-    print("\n生成されたファイル:")
-    print("- secondary_ranking.txt: 二次合成による順位リスト")
-    print("- filtered_ranking.txt: 三次合成評価とフィルタリング結果")
+    if output_files:
+        print("\n生成されたファイル:")
+        for file in output_files:
+            print(f"- {file}: {OUTPUT_DESCRIPTIONS[file]}")
+    else:
+        print("\n今回の実行で生成されたファイルはありません（保存済みの結果を使用）")
     print("\n次のステップ:")
     print("1. filtered_ranking.txtを確認して採用候補を選択")
     print("2. 必要に応じて追加の分析を実行")
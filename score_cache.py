@@ -0,0 +1,279 @@
+import sqlite3
+import time
+
+import numpy as np
+
+from imd import DEFAULT_MAX_ORDER, MAX_DISPLAY_FREQUENCY, MIN_DISPLAY_FREQUENCY, RATING_DIFF_LIMIT
+from imd_engine import ENGINE_VERSION, buildTermLabels, differenceCounts
+from imd_parallel import ParallelScorer
+
+SCORE_CACHE_FILE = 'score_cache.sqlite'
+# キャッシュに保持する組み合わせ数の上限（超えたら最後に使われた時刻が古いものから削除）
+SCORE_CACHE_MAX_ENTRIES = 1000000
+# 一度のSQL文で照会する組み合わせ数（SQLiteのパラメータ数の上限より小さくする）
+LOOKUP_BATCH_SIZE = 500
+# 違反の一覧（合成周波数, 最近接周波数, 差, 合成波番号）を保存するIMD差の上限（この値未満、閾値がこれ以下ならキャッシュから答える）
+VIOLATION_LIMIT = RATING_DIFF_LIMIT + 1
+# キャッシュファイルの形式（PRAGMA user_version）。異なる形式のファイルは作り直す
+SCORE_CACHE_FORMAT = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    frequencies TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    rating INTEGER NOT NULL,
+    min_difference INTEGER,
+    difference_counts BLOB,
+    violations BLOB,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (frequencies, parameters)
+);
+CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used);
+"""
+
+
+def score_parameters(max_order=DEFAULT_MAX_ORDER):
+    """評価値に影響するパラメータ（キャッシュのキーの一部、合成波の次数は既定値以外の場合のみ含める）"""
+    parameters = (f"limit={RATING_DIFF_LIMIT};window={MIN_DISPLAY_FREQUENCY}-{MAX_DISPLAY_FREQUENCY};"
+                  f"engine={ENGINE_VERSION}")
+    if max_order != DEFAULT_MAX_ORDER:
+        parameters += f";order={max_order}"
+    return parameters
+
+
+def encode_violations(violations, label_index):
+    """1つの組み合わせの違反リストのうちIMD差がVIOLATION_LIMIT未満のものを保存用のバイト列にする"""
+    rows = [(product, nearest, difference, label_index[pattern])
+            for product, nearest, difference, pattern in violations if difference < VIOLATION_LIMIT]
+    return np.array(rows, dtype='<i4').reshape(-1, 4).tobytes()
+
+
+def decode_violations(blobs, threshold, labels):
+    """保存した違反リストのバイト列のリストから、組み合わせごとにIMD差がthreshold未満のものを
+    (合成周波数, 最近接周波数, 差, パターン名) のリストで返す（全組み合わせ分をまとめて変換する）
+    """
+    rows = np.frombuffer(b''.join(blobs), dtype='<i4').reshape(-1, 4)
+    owners = np.repeat(np.arange(len(blobs)), [len(blob) // rows.itemsize // 4 for blob in blobs])
+    keep = rows[:, 2] < threshold
+    ends = np.cumsum(np.bincount(owners[keep], minlength=len(blobs))).tolist()
+    kept = rows[keep]
+    decoded = list(zip(kept[:, 0].tolist(), kept[:, 1].tolist(), kept[:, 2].tolist(),
+                       map(labels.__getitem__, kept[:, 3].tolist())))
+    return [decoded[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+def combo_keys(combos):
+    """組み合わせ配列[M, k]をキャッシュのキー（昇順に並べた周波数のカンマ区切り）のリストに変換"""
+    return [",".join(map(str, combo)) for combo in np.sort(np.asarray(combos), axis=1).tolist()]
+
+
+class ScoreCache:
+    """周波数の組み合わせごとの評価値・最小IMD差・IMD差ごとの合成波数・違反の一覧を保存するSQLiteキャッシュ
+
+    キーは昇順に並べた周波数の組み合わせと評価パラメータ（RATING_DIFF_LIMIT、表示範囲、評価方法のバージョン、合成波の次数）。
+    評価値だけを求めた組み合わせは評価値だけを保存し（最小IMD差・合成波数・違反の一覧はNULL）、それらが必要になった時点で評価し直す。
+    組み合わせ数がmax_entriesを超えたら最後に使われた時刻が古いものから削除する（開くときにも、上限を小さくした場合に備えて削除する）。
+    """
+
+    def __init__(self, filename=SCORE_CACHE_FILE, max_entries=SCORE_CACHE_MAX_ENTRIES, max_order=DEFAULT_MAX_ORDER):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.max_order = max_order
+        self.parameters = score_parameters(max_order)
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(filename)
+        (version,) = self._connection.execute("PRAGMA user_version").fetchone()
+        if version != SCORE_CACHE_FORMAT:
+            with self._connection:
+                self._connection.execute("DROP TABLE IF EXISTS scores")
+            self._connection.execute(f"PRAGMA user_version = {SCORE_CACHE_FORMAT}")
+        self._connection.executescript(_SCHEMA)
+        self.evict()
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def lookup(self, combos):
+        """組み合わせ配列[M, k]をまとめて照会
+
+        戻り値は (キャッシュにあるか[M], 最小IMD差と合成波数を保存済みか[M], 評価値[M], 最小IMD差[M],
+        IMD差ごとの合成波数[M, RATING_DIFF_LIMIT + 1], 保存した違反の一覧のバイト列のリスト[M]（保存していなければNone）) 。
+        ヒット数・評価数は呼び出し側で数える。
+        """
+        keys = combo_keys(combos)
+        m = len(keys)
+        found = np.zeros(m, dtype=bool)
+        complete = np.zeros(m, dtype=bool)
+        ratings = np.zeros(m, dtype=np.int64)
+        min_differences = np.zeros(m, dtype=np.int32)
+        counts = np.zeros((m, RATING_DIFF_LIMIT + 1), dtype=np.int64)
+        details = [None] * m
+        positions = {}
+        for i, key in enumerate(keys):
+            positions.setdefault(key, []).append(i)
+        unique_keys = list(positions)
+        # 見つかった行はまとめて配列に書き込む（行ごとのNumPyの代入は遅いため）
+        hit_index, hit_ratings = [], []
+        complete_index, hit_min_differences, hit_counts = [], [], []
+        for start in range(0, len(unique_keys), LOOKUP_BATCH_SIZE):
+            batch = unique_keys[start:start + LOOKUP_BATCH_SIZE]
+            rows = self._connection.execute(
+                f"SELECT frequencies, rating, min_difference, difference_counts, violations FROM scores "
+                f"WHERE parameters = ? AND frequencies IN ({','.join('?' * len(batch))})",
+                [self.parameters] + batch)
+            for key, rating, min_difference, blob, violations in rows:
+                for i in positions[key]:
+                    hit_index.append(i)
+                    hit_ratings.append(rating)
+                    details[i] = violations
+                    if blob is not None:
+                        complete_index.append(i)
+                        hit_min_differences.append(min_difference)
+                        hit_counts.append(blob)
+        if hit_index:
+            found[hit_index] = True
+            ratings[hit_index] = hit_ratings
+        if complete_index:
+            complete[complete_index] = True
+            min_differences[complete_index] = hit_min_differences
+            counts[complete_index] = np.frombuffer(b''.join(hit_counts), dtype='<i8').reshape(len(complete_index), -1)
+        hit_keys = [key for key in unique_keys if found[positions[key][0]]]
+        if hit_keys:
+            now = time.time_ns()
+            with self._connection:
+                for start in range(0, len(hit_keys), LOOKUP_BATCH_SIZE):
+                    batch = hit_keys[start:start + LOOKUP_BATCH_SIZE]
+                    self._connection.execute(
+                        f"UPDATE scores SET last_used = ? WHERE parameters = ? "
+                        f"AND frequencies IN ({','.join('?' * len(batch))})",
+                        [now, self.parameters] + batch)
+        return found, complete, ratings, min_differences, counts, details
+
+    def store(self, combos, ratings, min_differences=None, counts=None, details=None):
+        """組み合わせ配列[M, k]の評価結果をまとめて保存し、上限を超えた分を削除（details: 違反の一覧のバイト列のリスト）
+
+        min_differences, countsを省略した場合は評価値だけを保存する。
+        """
+        now = time.time_ns()
+        keys = combo_keys(combos)
+        ratings = np.asarray(ratings).tolist()
+        if details is None:
+            details = [None] * len(keys)
+        if counts is None:
+            rows = [(key, self.parameters, rating, None, None, None, now) for key, rating in zip(keys, ratings)]
+        else:
+            counts = np.asarray(counts, dtype='<i8')
+            rows = [(key, self.parameters, rating, min_difference, counts[i].tobytes(), details[i], now)
+                    for i, (key, rating, min_difference) in enumerate(zip(
+                        keys, ratings, np.asarray(min_differences).tolist()))]
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.evict()
+
+    def evict(self):
+        """保存数がmax_entriesを超えていれば、最後に使われた時刻が古いものから削除"""
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM scores").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM scores WHERE rowid IN (SELECT rowid FROM scores ORDER BY last_used LIMIT ?)",
+                    (excess,))
+
+    def print_stats(self):
+        """今回の照会のヒット数と保存数を表示"""
+        print(f"スコアキャッシュ {self.filename}: ヒット {self.hits}件, 新規評価 {self.misses}件, 保存数 {len(self)}件")
+
+    def __len__(self):
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM scores").fetchone()
+        return count
+
+
+def cachedEvaluateCombos(combos, cache: ScoreCache, threshold=None, jobs: int = 1, max_order=DEFAULT_MAX_ORDER,
+                         threads: int = 1, scorer=None):
+    """evaluateCombosと同じ結果を、キャッシュにある組み合わせは評価を省略して求める
+
+    評価値だけを保存した組み合わせ（cachedCalcRatingsで保存したもの）は評価し直して最小IMD差などとともに保存し直す。
+    threshold指定時は、キャッシュに違反の一覧（IMD差VIOLATION_LIMIT未満）を保存済みで、thresholdがVIOLATION_LIMIT以下、
+    周波数が昇順に並んでいる組み合わせだけをキャッシュから答え、それ以外は評価して違反の一覧とともに保存し直す。
+    キャッシュの照会・保存は呼び出したスレッドだけで行い、評価だけをjobs個のプロセスかthreads個のスレッドで分割する。
+    scorer（ParallelScorer）を指定した場合はjobs, threadsの代わりにそのワーカーで評価する。
+    """
+    if scorer is None:
+        with ParallelScorer(jobs, threads, max_order) as scorer:
+            return cachedEvaluateCombos(combos, cache, threshold, max_order=max_order, scorer=scorer)
+    if scorer.max_order != max_order:
+        raise ValueError(f"ParallelScorerの合成波の次数（{scorer.max_order}）が評価の次数（{max_order}）と異なります")
+    combos = np.asarray(combos, dtype=np.int32)
+    if cache is None:
+        return scorer.evaluateCombos(combos, threshold)
+    if cache.max_order != max_order:
+        raise ValueError(f"キャッシュの合成波の次数（{cache.max_order}）が評価の次数（{max_order}）と異なります")
+    found, complete, ratings, min_differences, counts, details = cache.lookup(combos)
+    m, n = combos.shape
+
+    violations = None
+    usable = complete
+    if threshold is not None:
+        # 違反の一覧のパターン名は周波数の並び順に依存するため、昇順の組み合わせだけを保存・再利用する
+        ascending = np.all(np.diff(combos, axis=1) > 0, axis=1)
+        has_details = np.array([blob is not None for blob in details], dtype=bool)
+        usable = complete & ascending & has_details & (threshold <= VIOLATION_LIMIT)
+        labels = buildTermLabels(n, max_order)
+        violations = [[] for _ in range(m)]
+        hits = np.flatnonzero(usable).tolist()
+        for i, combo_violations in zip(hits, decode_violations([details[i] for i in hits], threshold, labels)):
+            violations[i] = combo_violations
+
+    missing = np.flatnonzero(~usable)
+    cache.hits += m - len(missing)
+    cache.misses += len(missing)
+    if len(missing):
+        missing_combos = combos[missing]
+        evaluate_threshold = None if threshold is None else max(threshold, VIOLATION_LIMIT)
+        ratings[missing], min_differences[missing], missing_violations = scorer.evaluateCombos(
+            missing_combos, evaluate_threshold)
+        counts[missing] = differenceCounts(missing_combos, max_order)
+        missing_details = None
+        if threshold is not None:
+            label_index = {label: term for term, label in enumerate(labels)}
+            missing_details = [encode_violations(combo_violations, label_index) if ascending[i] else None
+                               for i, combo_violations in zip(missing.tolist(), missing_violations)]
+            for i, combo_violations in zip(missing.tolist(), missing_violations):
+                violations[i] = [violation for violation in combo_violations if violation[2] < threshold]
+        cache.store(missing_combos, ratings[missing], min_differences[missing], counts[missing], missing_details)
+    return ratings, min_differences, violations
+
+
+def cachedCalcRatings(combos, cache: ScoreCache, jobs: int = 1, max_order=DEFAULT_MAX_ORDER, threads: int = 1,
+                      scorer=None):
+    """calcRatingsと同じ評価値の配列を、キャッシュにある組み合わせは評価を省略して求める
+
+    キャッシュにない組み合わせは評価値だけを求めて（evaluateCombos, differenceCountsは使わない）評価値だけを保存する。
+    """
+    if scorer is None:
+        with ParallelScorer(jobs, threads, max_order) as scorer:
+            return cachedCalcRatings(combos, cache, max_order=max_order, scorer=scorer)
+    if scorer.max_order != max_order:
+        raise ValueError(f"ParallelScorerの合成波の次数（{scorer.max_order}）が評価の次数（{max_order}）と異なります")
+    combos = np.asarray(combos, dtype=np.int32)
+    if cache is None:
+        return scorer.calcRatings(combos)
+    if cache.max_order != max_order:
+        raise ValueError(f"キャッシュの合成波の次数（{cache.max_order}）が評価の次数（{max_order}）と異なります")
+    found, _, ratings, _, _, _ = cache.lookup(combos)
+    missing = np.flatnonzero(~found)
+    cache.hits += len(combos) - len(missing)
+    cache.misses += len(missing)
+    if len(missing):
+        missing_combos = combos[missing]
+        ratings[missing] = scorer.calcRatings(missing_combos)
+        cache.store(missing_combos, ratings[missing])
+    return ratings
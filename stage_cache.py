@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+
+from imd import MAX_DISPLAY_FREQUENCY, MIN_DISPLAY_FREQUENCY, RATING_DIFF_LIMIT, RATING_MAX_VALUE
+from imd_engine import ENGINE_VERSION
+
+# 各段階の入力ファイル（チャネル名・LED番号は出力ファイルに含まれるため入力として扱う）
+CHANNEL_PLAN_FILES = ['vtxtable.txt', 'LED.txt']
+
+
+def file_digest(filename):
+    """ファイル内容のSHA-256（ファイルがなければNone）"""
+    if not os.path.exists(filename):
+        return None
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stage_fingerprint(stage, input_files, **parameters):
+    """段階の入力（ファイルの内容、評価の定数、パラメータ）をまとめた指紋"""
+    return {
+        'stage': stage,
+        'engine_version': ENGINE_VERSION,
+        'constants': {
+            'RATING_DIFF_LIMIT': RATING_DIFF_LIMIT,
+            'RATING_MAX_VALUE': RATING_MAX_VALUE,
+            'MIN_DISPLAY_FREQUENCY': MIN_DISPLAY_FREQUENCY,
+            'MAX_DISPLAY_FREQUENCY': MAX_DISPLAY_FREQUENCY,
+        },
+        'parameters': parameters,
+        'inputs': {filename: file_digest(filename) for filename in input_files},
+    }
+
+
+def fingerprint_filename(output_file):
+    """出力ファイルの隣に置く指紋ファイル名"""
+    return output_file + '.fingerprint.json'
+
+
+def is_stage_fresh(fingerprint, output_files):
+    """前回の実行と入力が同じで、出力ファイルもその時のまま残っているか"""
+    try:
+        with open(fingerprint_filename(output_files[0]), 'r') as f:
+            record = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    if record.get('fingerprint') != fingerprint:
+        return False
+    outputs = record.get('outputs', {})
+    for filename in output_files:
+        digest = file_digest(filename)
+        if digest is None or outputs.get(filename) != digest:
+            return False
+    return True
+
+
+def record_stage(fingerprint, output_files):
+    """段階の入力の指紋と出力ファイルのハッシュを保存"""
+    record = {
+        'fingerprint': fingerprint,
+        'outputs': {filename: file_digest(filename) for filename in output_files},
+    }
+    with open(fingerprint_filename(output_files[0]), 'w') as f:
+        json.dump(record, f, ensure_ascii=False, indent=2)
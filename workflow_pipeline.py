@@ -0,0 +1,149 @@
+import queue
+import threading
+
+import numpy as np
+
+import metrics
+from imd import DEFAULT_MAX_ORDER
+from imd_parallel import ParallelScorer
+from imd_stream import streamRatings
+from apply_tertiary_filter import make_filtered_result
+
+# 二次合成の評価スレッドと三次合成の評価の間で待たせておくブロック数
+PIPELINE_QUEUE_SIZE = 2
+
+_DONE = object()
+
+
+def run_in_background(stream, maxsize=PIPELINE_QUEUE_SIZE):
+    """streamを別スレッドで進め、生成されたブロックを順に返す（ストリーム内の例外は呼び出し側で再送出）"""
+    blocks = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for block in stream:
+                if stop.is_set():
+                    return
+                blocks.put(block)
+            blocks.put(_DONE)
+        except BaseException as e:
+            blocks.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is _DONE:
+                return
+            if isinstance(block, BaseException):
+                raise block
+            yield block
+    finally:
+        # 途中で打ち切られた場合は生成側を止める
+        stop.set()
+        while thread.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def secondary_stream(pool, jobs=1, max_order=DEFAULT_MAX_ORDER, constraints=None):
+    """プール（昇順の周波数の配列）の全4周波数組み合わせを辞書順のブロックごとに二次合成で評価し、
+    (周波数[b, 4], 評価値[b], None) を順に返す
+
+    constraintsを指定すると制約を満たす組み合わせだけを列挙して評価する。
+    ワーカーは全ブロックの評価で使い回す。
+    """
+    with ParallelScorer(jobs, max_order=max_order) as scorer:
+        def score(index_combos):
+            with metrics.stage('secondary_evaluation', combos=len(index_combos)):
+                return scorer.calcRatings(pool[index_combos])
+        
+        for index_combos, ratings in streamRatings(pool, 4, score=score, constraints=constraints):
+            yield pool[index_combos], ratings, None
+
+
+def ranking_file_stream(ranking):
+    """保存済みの順位リスト（RankingFile）を (周波数[b, k], 評価値[b], 二次合成の順位[b]) のブロックで順に返す"""
+    for ranks, combos, ratings in ranking.iter_blocks():
+        yield combos, ratings, ranks
+
+
+class PipelineCollector:
+    """二次合成の評価結果をブロックごとに受け取り、その場で三次合成の評価を行う
+
+    順位付け（二次合成の評価値による並べ替え）は全ブロックを受け取った後に一度だけ行う。
+    imd_diff_threshold=Noneなら三次合成の評価は行わず二次合成の結果だけを集める。
+    三次合成の評価のワーカーは全ブロックで使い回し、consumeの終了時（addだけを使う場合はclose）に終了する。
+    """
+
+    def __init__(self, imd_diff_threshold=None, jobs=1, max_order=DEFAULT_MAX_ORDER):
+        self.imd_diff_threshold = imd_diff_threshold
+        self.jobs = jobs
+        self.max_order = max_order
+        self._scorer = ParallelScorer(jobs, max_order=max_order)
+        self._combos = []
+        self._ratings = []
+        self._ranks = []
+        self._tertiary_ratings = []
+        self._min_differences = []
+        self._imd_differences = []
+
+    def add(self, combos, ratings, ranks=None):
+        """辞書順（または順位順）に並んだ1ブロック分の二次合成の評価結果を追加"""
+        self._combos.append(np.asarray(combos))
+        self._ratings.append(np.asarray(ratings))
+        self._ranks.append(None if ranks is None else np.asarray(ranks))
+        if self.imd_diff_threshold is not None:
+            with metrics.stage('tertiary_evaluation', combos=len(combos)):
+                tertiary_ratings, min_differences, imd_differences = self._scorer.evaluateCombos(
+                    combos, threshold=self.imd_diff_threshold)
+            self._tertiary_ratings.append(tertiary_ratings)
+            self._min_differences.append(min_differences)
+            self._imd_differences.extend(imd_differences)
+
+    def consume(self, stream):
+        """(周波数, 評価値, 順位) のブロックのストリームを全て受け取る"""
+        with self._scorer:
+            for combos, ratings, ranks in stream:
+                self.add(combos, ratings, ranks)
+        return self
+
+    def close(self):
+        """三次合成の評価のワーカーを終了"""
+        self._scorer.close()
+
+    def _order(self):
+        if not self._ratings:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.int64)
+        if all(ranks is not None for ranks in self._ranks):
+            # 保存済みの順位リストから受け取った場合はその順位に従う
+            ranks = np.concatenate(self._ranks)
+            order = np.argsort(ranks, kind='stable')
+            return order, ranks[order]
+        # create_secondary_rankingと同じ並び（評価値の降順、同じ評価値なら受け取った順）
+        order = np.argsort(-np.concatenate(self._ratings), kind='stable')
+        return order, np.arange(1, len(order) + 1)
+
+    def results(self):
+        """(二次合成の順位リスト [(周波数のリスト, 評価値), ...], 三次合成の評価結果のリスト) を順位順で返す"""
+        order, ranks = self._order()
+        if len(order) == 0:
+            return [], []
+        combos = np.concatenate(self._combos)[order].tolist()
+        ratings = np.concatenate(self._ratings)[order].tolist()
+        secondary_results = list(zip(combos, ratings))
+        if self.imd_diff_threshold is None:
+            return secondary_results, []
+
+        tertiary_ratings = np.concatenate(self._tertiary_ratings)[order].tolist()
+        min_differences = np.concatenate(self._min_differences)[order].tolist()
+        filtered_results = [
+            make_filtered_result(rank, combo, rating, tertiary_rating, min_difference, self._imd_differences[i])
+            for i, rank, combo, rating, tertiary_rating, min_difference in zip(
+                order.tolist(), ranks.tolist(), combos, ratings, tertiary_ratings, min_differences)
+        ]
+        return secondary_results, filtered_results